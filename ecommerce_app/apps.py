@@ -1,6 +1,13 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 
 
 class EcommerceAppConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'ecommerce_app'
+
+    def ready(self):
+        from . import search, sharding, signals  # noqa: F401
+
+        post_migrate.connect(search.ensure_index, sender=self)
+        post_migrate.connect(sharding.reserve_id_ranges, sender=self)
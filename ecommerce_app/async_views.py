@@ -0,0 +1,82 @@
+from asgiref.sync import sync_to_async
+from django.core.exceptions import ValidationError
+from django.http import Http404
+from rest_framework.response import Response
+
+from .conditional import AsyncConditionalGetMixin
+from .views import CustomerProductDetailView, CustomerProductListView, OrderHistoryView, ProductReviewListView
+
+
+class AsyncAPIViewMixin:
+    """
+    Serves a DRF view with coroutine handlers, for the ASGI deployment (see
+    ecommerce_project/urls_asgi.py). dispatch() is APIView.dispatch() with
+    the authentication, permission and throttle checks run through
+    sync_to_async, since the JWT user lookup can hit the database; handlers
+    read through the async ORM and must not touch lazy relations.
+    """
+
+    async def dispatch(self, request, *args, **kwargs):
+        self.args = args
+        self.kwargs = kwargs
+        request = self.initialize_request(request, *args, **kwargs)
+        self.request = request
+        self.headers = self.default_response_headers
+
+        try:
+            await sync_to_async(self.initial)(request, *args, **kwargs)
+            if request.method.lower() in self.http_method_names:
+                handler = getattr(self, request.method.lower(), self.http_method_not_allowed)
+            else:
+                handler = self.http_method_not_allowed
+            response = handler(request, *args, **kwargs)
+            # OPTIONS and 405s come from APIView's sync handlers.
+            if hasattr(response, '__await__'):
+                response = await response
+        except Exception as exc:
+            response = self.handle_exception(exc)
+
+        self.response = self.finalize_response(request, response, *args, **kwargs)
+        return self.response
+
+    async def alist(self):
+        queryset = self.filter_queryset(self.get_queryset())
+        page = await self.paginator.apaginate_queryset(queryset, self.request, view=self)
+        return self.get_paginated_response(self.get_serializer(page, many=True).data)
+
+    async def aget_object(self):
+        queryset = self.filter_queryset(self.get_queryset())
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        try:
+            obj = await queryset.aget(**{self.lookup_field: self.kwargs[lookup_url_kwarg]})
+        except (queryset.model.DoesNotExist, TypeError, ValueError, ValidationError):
+            raise Http404
+        self.check_object_permissions(self.request, obj)
+        return obj
+
+    async def aretrieve(self):
+        return Response(self.get_serializer(await self.aget_object()).data)
+
+
+class AsyncCustomerProductListView(AsyncAPIViewMixin, AsyncConditionalGetMixin, CustomerProductListView):
+    async def get(self, request, *args, **kwargs):
+        return await self.aconditional(request, self.alist)
+
+
+class AsyncCustomerProductDetailView(AsyncAPIViewMixin, AsyncConditionalGetMixin, CustomerProductDetailView):
+    async def get(self, request, *args, **kwargs):
+        return await self.aconditional(request, self.aretrieve)
+
+
+class AsyncOrderHistoryView(AsyncAPIViewMixin, OrderHistoryView):
+    async def get(self, request, *args, **kwargs):
+        return await self.alist()
+
+
+class AsyncProductReviewListView(AsyncAPIViewMixin, AsyncConditionalGetMixin, ProductReviewListView):
+    def get_queryset(self):
+        # The serializer shows the user and the product name.
+        return super().get_queryset().select_related('user', 'product')
+
+    async def get(self, request, *args, **kwargs):
+        return await self.aconditional(request, self.alist)
@@ -0,0 +1,89 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+
+
+class UserCache:
+    """
+    Bounded, per-process LRU of user rows keyed by the token's user id.
+    Entries live for JWT_USER_CACHE_TTL seconds; saving or deleting a user
+    evicts it here right away, other processes catch up within the TTL.
+    Rows are stored as plain values, so every request gets its own instance.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._rows = OrderedDict()
+
+    def get_ttl(self):
+        return getattr(settings, 'JWT_USER_CACHE_TTL', 60)
+
+    def get_max_size(self):
+        return getattr(settings, 'JWT_USER_CACHE_SIZE', 10000)
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._rows.get(user_id)
+            if entry is None:
+                return None
+            expires_at, row = entry
+            if time.monotonic() >= expires_at:
+                del self._rows[user_id]
+                return None
+            self._rows.move_to_end(user_id)
+            return row
+
+    def put(self, user_id, row):
+        with self._lock:
+            self._rows[user_id] = (time.monotonic() + self.get_ttl(), row)
+            self._rows.move_to_end(user_id)
+            while len(self._rows) > self.get_max_size():
+                self._rows.popitem(last=False)
+
+    def evict(self, user_id):
+        with self._lock:
+            self._rows.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._rows.clear()
+
+
+user_cache = UserCache()
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """
+    JWTAuthentication that builds ``request.user`` from ``user_cache`` instead
+    of querying the user table on every request.
+    """
+
+    def get_user(self, validated_token):
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken(_("Token contained no recognizable user identification"))
+
+        row = user_cache.get(user_id)
+        if row is None:
+            field_names = [field.attname for field in self.user_model._meta.concrete_fields]
+            # From the primary: the token can be newer than the read replicas.
+            queryset = self.user_model.objects.using(DEFAULT_DB_ALIAS).filter(**{api_settings.USER_ID_FIELD: user_id})
+            values = queryset.values_list(*field_names).first()
+            if values is None:
+                raise AuthenticationFailed(_("User not found"), code="user_not_found")
+            row = (queryset.db, field_names, values)
+            user_cache.put(user_id, row)
+
+        user = self.user_model.from_db(*row)
+        if not user.is_active:
+            raise AuthenticationFailed(_("User is inactive"), code="user_inactive")
+
+        return user
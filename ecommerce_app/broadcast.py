@@ -0,0 +1,160 @@
+import mimetypes
+import uuid
+from datetime import timedelta
+from email import encoders
+from email.mime.base import MIMEBase
+
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives
+from django.db.models import F, Q
+from django.template.loader import render_to_string
+from django.utils import timezone
+
+from .models import BroadcastAttachment, BroadcastJob, CustomUser
+
+
+def get_batch_size():
+    return getattr(settings, 'BROADCAST_BATCH_SIZE', 100)
+
+
+def get_lease():
+    return timedelta(seconds=getattr(settings, 'BROADCAST_LEASE', 300))
+
+
+def recipients():
+    return CustomUser.objects.filter(is_staff=False, email__isnull=False)
+
+
+def create_job(subject, message, files, created_by=None, from_email='noreply@yourwebsite.com'):
+    context = {'subject': subject, 'message': message, "files": files}
+    job = BroadcastJob.objects.create(
+        subject=subject,
+        html_message=render_to_string('ecommerce_app/custom_email.html', context),
+        from_email=from_email,
+        created_by=created_by,
+        total_recipients=recipients().count(),
+    )
+    for file in files:
+        # FileField saves uploads chunk by chunk, so they never sit in memory.
+        BroadcastAttachment.objects.create(job=job, file=file, name=file.name, content_type=file.content_type or '')
+    return job
+
+
+def iter_recipient_batches(after_id, batch_size):
+    """
+    Yields lists of ``(id, email)`` in id order, seeking past the previous
+    batch, so neither the full recipient list nor a long-lived cursor is ever
+    held open.
+    """
+    while True:
+        batch = list(
+            recipients().filter(id__gt=after_id).order_by('id').values_list('id', 'email')[:batch_size]
+        )
+        if not batch:
+            return
+        yield batch
+        after_id = batch[-1][0]
+
+
+def encode_attachments(job):
+    parts = []
+    for attachment in job.attachments.all():
+        content_type = attachment.content_type or mimetypes.guess_type(attachment.name)[0] or 'application/octet-stream'
+        maintype, subtype = content_type.split('/', 1)
+        part = MIMEBase(maintype, subtype)
+        with attachment.file.open('rb') as f:
+            part.set_payload(f.read())
+        encoders.encode_base64(part)
+        part.add_header('Content-Disposition', 'attachment', filename=attachment.name)
+        parts.append(part)
+    return parts
+
+
+class BroadcastSender:
+    """
+    Works through broadcast jobs one batch per ``step()``, so a worker can
+    interleave them with transactional mail. Attachments are encoded once per
+    job and the same MIME parts go out with every batch.
+    """
+    max_batch_attempts = 3
+
+    def __init__(self, connection, batch_size=None):
+        self.connection = connection
+        self.batch_size = batch_size or get_batch_size()
+        self.token = uuid.uuid4()
+        self.job = None
+        self.attachments = None
+        self.batches = None
+
+    def claim(self):
+        now = timezone.now()
+        available = BroadcastJob.objects.filter(
+            Q(status='pending') | Q(status='running', lease_expires_at__lt=now)
+        ).order_by('id').values_list('id', flat=True)
+        for job_id in available[:5]:
+            claimed = BroadcastJob.objects.filter(
+                Q(status='pending') | Q(status='running', lease_expires_at__lt=now), pk=job_id,
+            ).update(status='running', claim_token=self.token, lease_expires_at=now + get_lease())
+            if claimed:
+                return BroadcastJob.objects.get(pk=job_id)
+        return None
+
+    def step(self):
+        """
+        Sends the next batch. Returns False when there was nothing to do.
+        """
+        if self.job is None:
+            self.job = self.claim()
+            if self.job is None:
+                return False
+            self.attachments = encode_attachments(self.job)
+            self.batches = iter_recipient_batches(self.job.last_user_id, self.batch_size)
+
+        batch = next(self.batches, None)
+        if batch is None:
+            self.finish()
+            return True
+
+        sent, failed, error = self.send_batch([email for _, email in batch])
+        still_ours = BroadcastJob.objects.filter(pk=self.job.pk, claim_token=self.token).update(
+            sent_count=F('sent_count') + sent,
+            failed_count=F('failed_count') + failed,
+            last_user_id=batch[-1][0],
+            last_error=error or F('last_error'),
+            lease_expires_at=timezone.now() + get_lease(),
+        )
+        if not still_ours:
+            # Our lease ran out and another worker took the job over.
+            self.job = None
+        return True
+
+    def send_batch(self, emails):
+        message = EmailMultiAlternatives(
+            subject=self.job.subject,
+            body=self.job.html_message,
+            from_email=self.job.from_email,
+            bcc=emails,
+            connection=self.connection,
+        )
+        message.content_subtype = 'html'
+        for part in self.attachments:
+            message.attach(part)
+
+        error = ''
+        for _ in range(self.max_batch_attempts):
+            try:
+                self.connection.open()
+                self.connection.send_messages([message])
+                return len(emails), 0, ''
+            except Exception as e:
+                self.connection.close()
+                error = repr(e)
+        return 0, len(emails), error
+
+    def finish(self):
+        BroadcastJob.objects.filter(pk=self.job.pk, claim_token=self.token).update(
+            status='done', finished_at=timezone.now(), lease_expires_at=None,
+        )
+        self.job = None
+        self.attachments = None
+        self.batches = None
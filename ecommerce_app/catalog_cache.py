@@ -0,0 +1,158 @@
+import hashlib
+import time
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework.exceptions import ValidationError
+
+from . import catalog_filters, routers
+
+ALL_GENERATION = 'catalog:gen:all'
+
+
+def get_cache():
+    return caches[getattr(settings, 'CATALOG_CACHE_ALIAS', 'default')]
+
+
+def get_timeout():
+    timeout = getattr(settings, 'CATALOG_CACHE_TIMEOUT', 300)
+    if routers.reading_from_replica():
+        # The replica may not have the write that bumped the generation yet;
+        # don't keep what it returned for longer than it takes to catch up.
+        return min(timeout, routers.get_pin_seconds())
+    return timeout
+
+
+def category_generation(category_id):
+    return f'catalog:gen:category:{category_id}'
+
+
+def product_generation(product_id):
+    return f'catalog:gen:product:{product_id}'
+
+
+def _new_generation():
+    # Generations start from the clock rather than 1 so that an evicted counter
+    # can never come back at a value that matches an old, stale entry.
+    return time.time_ns()
+
+
+def get_generations(keys):
+    cache = get_cache()
+    generations = cache.get_many(keys)
+    for key in keys:
+        if key not in generations:
+            cache.add(key, _new_generation(), None)
+            generations[key] = cache.get(key)
+    return [generations[key] for key in keys]
+
+
+def bump(keys):
+    cache = get_cache()
+    for key in set(keys):
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, _new_generation(), None)
+
+
+def normalize_filters(query_params):
+    """
+    Returns a dict of the catalog filters in ``query_params`` in canonical form,
+    or None when they can't be parsed (those requests skip the cache). Params
+    the catalog doesn't read are left out.
+    """
+    try:
+        filters = catalog_filters.parse(query_params)
+    except ValidationError:
+        return None
+    params = {}
+    for name, value in filters.items():
+        if value is None:
+            continue
+        if name in ('name', 'q'):
+            value = value.lower()
+        elif isinstance(value, Decimal):
+            value = str(value.normalize())
+        params[name] = value
+    return params
+
+
+def normalize_list_params(query_params):
+    """
+    Canonical tuple of the filters, ordering and page of a listing request, or
+    None when it shouldn't be cached.
+    """
+    params = normalize_filters(query_params)
+    if params is None:
+        return None
+
+    if query_params.get('ordering') == 'rating':
+        params['ordering'] = 'rating'
+
+    if 'cursor' in query_params:
+        params['cursor'] = query_params['cursor']
+    else:
+        page = query_params.get('page') or '1'
+        params['page'] = page if page == 'last' else page.lstrip('0') or '0'
+
+    page_size = query_params.get('page_size')
+    if page_size:
+        params['page_size'] = page_size
+
+    return tuple(sorted(params.items()))
+
+
+def _digest(value):
+    return hashlib.md5(repr(value).encode()).hexdigest()
+
+
+def list_key(request):
+    params = normalize_list_params(request.query_params)
+    if params is None:
+        return None
+    category = dict(params).get('category')
+    generation_key = category_generation(category) if category is not None else ALL_GENERATION
+    generation, = get_generations([generation_key])
+    return f'catalog:list:{generation}:{_digest((request.get_host(), params))}'
+
+
+def facets_key(request):
+    params = normalize_filters(request.query_params)
+    if params is None:
+        return None
+    # Facet counts span every category, so any catalog write invalidates them.
+    generation, = get_generations([ALL_GENERATION])
+    return f'catalog:facets:{generation}:{_digest((request.get_host(), tuple(sorted(params.items()))))}'
+
+
+def detail_key(request, pk):
+    generation, = get_generations([product_generation(pk)])
+    return f'catalog:detail:{pk}:{generation}:{_digest(request.get_host())}'
+
+
+def get_cached(key):
+    return get_cache().get(key)
+
+
+def store(key, data):
+    get_cache().set(key, data, get_timeout())
+
+
+def invalidate_products(products):
+    """
+    ``products`` is an iterable of ``(product_id, category_id)`` pairs. Only the
+    detail entries of those products, the listings filtered by their categories
+    and the unfiltered listing are invalidated.
+    """
+    keys = [ALL_GENERATION]
+    for product_id, category_id in products:
+        keys.append(product_generation(product_id))
+        if category_id is not None:
+            keys.append(category_generation(category_id))
+    bump(keys)
+
+
+def invalidate_category(category_id):
+    bump([ALL_GENERATION, category_generation(category_id)])
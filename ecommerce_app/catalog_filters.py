@@ -0,0 +1,144 @@
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+from django.db.models import BooleanField, Case, Count, F, IntegerField, Q, Value, When
+from rest_framework.exceptions import ValidationError
+
+from . import search
+
+DEFAULT_PRICE_BUCKETS = [25, 50, 100, 250, 500]
+
+TRUE_VALUES = {'1', 'true', 'yes'}
+FALSE_VALUES = {'0', 'false', 'no'}
+
+
+def get_price_buckets():
+    return [Decimal(str(bound)) for bound in getattr(settings, 'CATALOG_PRICE_BUCKETS', DEFAULT_PRICE_BUCKETS)]
+
+
+def parse(query_params):
+    """
+    Reads the catalog filters out of ``query_params``; raises ValidationError
+    for values that can't be parsed. Missing filters are None.
+    """
+    filters = {'category': None, 'min_price': None, 'max_price': None, 'in_stock': None, 'min_rating': None}
+
+    category = query_params.get('category')
+    if category:
+        try:
+            filters['category'] = int(category)
+        except ValueError:
+            raise ValidationError({'category': 'A valid integer is required.'})
+
+    # The price range only applies when both bounds are given.
+    min_price = query_params.get('min_price')
+    max_price = query_params.get('max_price')
+    if min_price and max_price:
+        try:
+            filters['min_price'], filters['max_price'] = Decimal(min_price), Decimal(max_price)
+        except InvalidOperation:
+            raise ValidationError({'price': 'min_price and max_price must be numbers.'})
+
+    in_stock = query_params.get('in_stock', '').lower()
+    if in_stock in TRUE_VALUES:
+        filters['in_stock'] = True
+    elif in_stock in FALSE_VALUES:
+        filters['in_stock'] = False
+
+    min_rating = query_params.get('min_rating')
+    if min_rating:
+        try:
+            filters['min_rating'] = float(min_rating)
+        except ValueError:
+            raise ValidationError({'min_rating': 'A valid number is required.'})
+
+    filters['name'] = query_params.get('name') or None
+    filters['q'] = query_params.get('q') or None
+    return filters
+
+
+def in_price_range(filters):
+    return Q(price__gte=filters['min_price'], price__lte=filters['max_price'])
+
+
+def apply(queryset, filters, faceted=True, rank=True):
+    """
+    Applies ``filters`` (from ``parse``) to a Product queryset. With
+    ``faceted=False`` the category, price and stock filters are left for the
+    caller. Matches for a search come back best first when ``rank`` is set.
+    """
+    if faceted:
+        if filters['category'] is not None:
+            queryset = queryset.filter(category_id=filters['category'])
+        if filters['min_price'] is not None:
+            queryset = queryset.filter(in_price_range(filters))
+        if filters['in_stock'] is not None:
+            # Units held by carts can't be bought, so a fully reserved product is out of stock.
+            in_stock = Q(quantity__gt=F('reserved'))
+            queryset = queryset.filter(in_stock if filters['in_stock'] else ~in_stock)
+    if filters['min_rating'] is not None:
+        queryset = queryset.filter(rating_average__gte=filters['min_rating'])
+    if filters['name'] or filters['q']:
+        queryset = search.search(queryset, q=filters['q'], name=filters['name'], rank=rank)
+    return queryset
+
+
+def facets(queryset, filters):
+    """
+    Counts the products matching ``filters`` per category, price bucket and
+    stock state in one grouped query. Each facet ignores its own filter, so
+    the other options of a facet keep their counts once one is picked.
+    """
+    bounds = get_price_buckets()
+    price_bucket = Case(
+        *[When(price__lt=bound, then=Value(index)) for index, bound in enumerate(bounds)],
+        default=Value(len(bounds)),
+        output_field=IntegerField(),
+    )
+    in_stock = Case(When(quantity__gt=F('reserved'), then=Value(True)), default=Value(False), output_field=BooleanField())
+    in_price = Value(True, output_field=BooleanField())
+    if filters['min_price'] is not None:
+        in_price = Case(When(in_price_range(filters), then=Value(True)), default=Value(False), output_field=BooleanField())
+
+    rows = (
+        apply(queryset, filters, faceted=False, rank=False)
+        .annotate(price_bucket=price_bucket, in_stock=in_stock, in_price=in_price)
+        .values('category_id', 'category__name', 'price_bucket', 'in_stock', 'in_price')
+        .annotate(count=Count('id'))
+        .order_by()
+    )
+
+    def matches(row, skip):
+        return (
+            (skip == 'category' or filters['category'] is None or row['category_id'] == filters['category'])
+            and (skip == 'price' or row['in_price'])
+            and (skip == 'in_stock' or filters['in_stock'] is None or row['in_stock'] == filters['in_stock'])
+        )
+
+    total = 0
+    categories = {}
+    buckets = [0] * (len(bounds) + 1)
+    stock = {'true': 0, 'false': 0}
+    for row in rows:
+        if matches(row, None):
+            total += row['count']
+        if matches(row, 'category'):
+            category = categories.setdefault(
+                row['category_id'], {'id': row['category_id'], 'name': row['category__name'], 'count': 0},
+            )
+            category['count'] += row['count']
+        if matches(row, 'price'):
+            buckets[row['price_bucket']] += row['count']
+        if matches(row, 'in_stock'):
+            stock['true' if row['in_stock'] else 'false'] += row['count']
+
+    edges = [None] + bounds + [None]
+    return {
+        'count': total,
+        'categories': sorted(categories.values(), key=lambda category: category['id']),
+        'price_buckets': [
+            {'min': str(edges[index] or 0), 'max': edges[index + 1] and str(edges[index + 1]), 'count': count}
+            for index, count in enumerate(buckets)
+        ],
+        'in_stock': stock,
+    }
@@ -0,0 +1,133 @@
+from django.db import transaction
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError
+
+from . import catalog_cache
+from .models import Cart, Category, Product
+from .serializers import ProductImportRowSerializer
+
+FIELDS = ['id', 'name', 'description', 'price', 'quantity', 'category']
+
+# How many rejected rows are reported back; the rest are only counted.
+MAX_REPORTED_ERRORS = 100
+
+
+def export_rows(chunk_size=2000):
+    """
+    Yields every product as a dict keyed by FIELDS, reading the table in
+    chunks so the catalog is never held in memory. The output can be fed back
+    to ``import_rows``.
+    """
+    rows = Product.objects.order_by('id').values_list(
+        'id', 'name', 'description', 'price', 'quantity', 'category__name',
+    )
+    for row in rows.iterator(chunk_size=chunk_size):
+        yield dict(zip(FIELDS, row))
+
+
+def clean_row(row):
+    # Blank CSV cells mean "not given", not an empty value.
+    return {key: value for key, value in row.items() if key in FIELDS and value not in ('', None)}
+
+
+def resolve_categories(names):
+    """
+    Maps category names to categories with one lookup, creating the missing
+    ones in a single insert. Duplicate names resolve to the oldest category.
+    """
+    categories = {}
+    for category in Category.objects.filter(name__in=names).order_by('-id'):
+        categories[category.name] = category
+    missing = sorted(set(names) - categories.keys())
+    for category in Category.objects.bulk_create([Category(name=name) for name in missing]):
+        categories[category.name] = category
+    return categories
+
+
+def write_batch(rows):
+    """
+    Upserts validated rows by id: rows whose id exists update that product,
+    the rest are inserted. Returns ``(created, updated)``.
+    """
+    categories = resolve_categories({row['category'] for row in rows})
+    products = {}
+    new_products = []
+    for row in rows:
+        product = Product(
+            name=row['name'],
+            description=row['description'],
+            price=row['price'],
+            quantity=row['quantity'],
+            category=categories[row['category']],
+        )
+        if 'id' in row:
+            product.pk = row['id']
+            # A repeated id within a batch: the last row wins.
+            products[product.pk] = product
+        else:
+            new_products.append(product)
+
+    # bulk_update() skips auto_now.
+    now = timezone.now()
+    for product in products.values():
+        product.updated_at = now
+
+    previous = {
+        pk: (price, category_id)
+        for pk, price, category_id in Product.objects.filter(pk__in=products).values_list('pk', 'price', 'category_id')
+    }
+    updated = [product for pk, product in products.items() if pk in previous]
+    created = [product for pk, product in products.items() if pk not in previous] + new_products
+
+    with transaction.atomic():
+        Product.objects.bulk_update(updated, ['name', 'description', 'price', 'quantity', 'category', 'updated_at'])
+        Product.objects.bulk_create(created)
+        # bulk writes skip the model signals, so keep cart totals and the
+        # catalog cache in step by hand.
+        for product in updated:
+            old_price = previous[product.pk][0]
+            if product.price != old_price:
+                Cart.reprice_product(product.pk, product.price - old_price)
+
+        affected = {(product.pk, product.category_id) for product in updated + created}
+        affected.update((pk, previous[pk][1]) for pk in products if pk in previous)
+        transaction.on_commit(lambda: catalog_cache.invalidate_products(affected))
+
+    return len(created), len(updated)
+
+
+def import_rows(rows, batch_size=1000):
+    """
+    Validates and writes ``(line_number, dict)`` rows (see
+    ``streaming.read_rows``) batch by batch. Each batch commits on its own;
+    invalid rows are skipped and reported with their line number.
+    """
+    result = {'created': 0, 'updated': 0, 'rejected': 0, 'errors': []}
+    validator = ProductImportRowSerializer()
+
+    def reject(line_number, detail):
+        result['rejected'] += 1
+        if len(result['errors']) < MAX_REPORTED_ERRORS:
+            result['errors'].append({'line': line_number, 'errors': detail})
+
+    def flush(batch):
+        created, updated = write_batch(batch)
+        result['created'] += created
+        result['updated'] += updated
+
+    batch = []
+    for line_number, row in rows:
+        if row is None:
+            reject(line_number, 'Malformed row.')
+            continue
+        try:
+            batch.append(validator.run_validation(clean_row(row)))
+        except ValidationError as e:
+            reject(line_number, e.detail)
+            continue
+        if len(batch) >= batch_size:
+            flush(batch)
+            batch = []
+    if batch:
+        flush(batch)
+    return result
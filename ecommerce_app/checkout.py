@@ -0,0 +1,130 @@
+from collections import defaultdict
+from functools import reduce
+from operator import or_
+
+from django.db import transaction
+from django.db.models import F, Q, prefetch_related_objects
+from django.utils import timezone
+
+from . import catalog_cache, coupons, reservations, sharding
+from .models import CartItem, Order, OrderItem, Product, VerifiedPurchase
+
+
+class CheckoutError(Exception):
+    pass
+
+
+def calculate_discount(coupon, cart_total):
+    discount_details = {
+        'discount_type': coupon.discount_type,
+        'discount_value': coupon.discount_value,
+        'discount_amount': 0,
+    }
+    if cart_total < coupon.min_purchase_amount:
+        return None  # The coupon doesn't apply to the cart
+    if coupon.discount_type == 'percentage':
+        discount_details['discount_amount'] = (coupon.discount_value / 100) * cart_total
+        return discount_details
+    elif coupon.discount_type == 'amount':
+        discount_details['discount_amount'] = coupon.discount_value
+        return discount_details
+    return None
+
+
+def decrement_stock(quantities, held=None):
+    """
+    Takes ``quantities`` ({product_id: quantity}) off the stock in a single
+    UPDATE that only touches products with enough stock left. Units in
+    ``held`` ({product_id: quantity}) were reserved by this cart and are
+    converted from reserved to sold; the rest must be unreserved stock. Raises
+    CheckoutError if any product is short, which rolls the checkout back.
+    """
+    held = held or {}
+    in_stock = reduce(or_, (
+        Q(pk=pk, quantity__gte=F('reserved') + (quantity - held.get(pk, 0)))
+        for pk, quantity in quantities.items()
+    ))
+    updated = Product.objects.filter(in_stock).update(
+        quantity=F('quantity') - reservations.per_product(quantities),
+        reserved=F('reserved') - reservations.per_product(held),
+        updated_at=timezone.now(),
+    )
+    if updated != len(quantities):
+        raise CheckoutError('Requested quantity exceeds available quantity')
+
+
+def place_order(user, shipping_address, payment_method, coupon_code=None):
+    """
+    Turns the user's cart into an order in one transaction (per database) with
+    a fixed number of queries, whatever the size of the cart. Returns the order
+    and its items.
+    """
+    shard = sharding.shard_for_user(user)
+    with sharding.atomic(shard):
+        cart_items = list(CartItem.objects.using(shard).filter(cart__user=user).select_related('cart'))
+        if not cart_items:
+            raise CheckoutError('No cart items found')
+        prefetch_related_objects(cart_items, 'product')
+
+        total_amount_without_coupon = sum(item.product.price * item.quantity for item in cart_items)
+        total_amount = total_amount_without_coupon
+        discount_amount = 0
+        coupon = None
+        if coupon_code:
+            coupon = coupons.get_active(coupon_code)
+            if coupon is None:
+                raise CheckoutError('Invalid or expired coupon code')
+
+            if coupon.max_usage is not None and coupon.max_usage <= 0:
+                raise CheckoutError('Coupon has reached its maximum usage limit')
+
+            discount_details = calculate_discount(coupon, total_amount_without_coupon)
+            if not discount_details:
+                raise CheckoutError('Coupon does not apply to the cart items')
+            discount_amount = discount_details['discount_amount']
+            total_amount = total_amount_without_coupon - discount_amount
+
+        quantities = defaultdict(int)
+        for item in cart_items:
+            quantities[item.product_id] += item.quantity
+        try:
+            held = reservations.take_cart_holds(cart_items[0].cart)
+        except reservations.ReservationChanged:
+            raise CheckoutError('Your cart changed during checkout, please try again')
+        # Holds on products that are no longer in the cart go back to the shelf.
+        reservations.release_stock({pk: units for pk, units in held.items() if pk not in quantities})
+        decrement_stock(quantities, {pk: units for pk, units in held.items() if pk in quantities})
+
+        order = Order.objects.using(shard).create(
+            user=user,
+            total_amount_without_coupon=total_amount_without_coupon,
+            total_amount=total_amount,
+            shipping_address=shipping_address,
+            payment_method=payment_method,
+            coupon_code=coupon_code,
+            discounted_amount=discount_amount,
+            coupon_applied=True,
+        )
+        if coupon is not None:
+            try:
+                coupons.redeem(coupon, user, order)
+            except coupons.CouponUnavailable as e:
+                raise CheckoutError(str(e))
+        order_items = OrderItem.objects.using(shard).bulk_create([
+            OrderItem(order=order, product=item.product, quantity=item.quantity, price_at_order=item.product.price)
+            for item in cart_items
+        ])
+        VerifiedPurchase.objects.bulk_create(
+            [VerifiedPurchase(user=user, product_id=product_id) for product_id in quantities],
+            ignore_conflicts=True,
+        )
+        CartItem.objects.using(shard).filter(pk__in=[item.pk for item in cart_items]).delete()
+        # Recalculated rather than decremented: it's cheap on an emptied cart and
+        # wipes out any drift.
+        cart_items[0].cart.recalculate_totals()
+
+        # Stock goes through update(), which skips the model signals.
+        affected = {(item.product_id, item.product.category_id) for item in cart_items}
+        transaction.on_commit(lambda: catalog_cache.invalidate_products(affected))
+
+    return order, order_items
@@ -0,0 +1,143 @@
+import hashlib
+
+from django.db.models import Count, Max
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from rest_framework.response import Response
+
+from . import catalog_cache
+
+
+def compute_validators(queryset, timestamp_fields, scope, with_last_modified=True):
+    """
+    Returns ``(etag, last_modified)`` for the rows behind a response from one
+    aggregate query. ``timestamp_fields`` are the rows' own timestamps and
+    those of related rows the payload shows; the latest one wins. ``scope``
+    (the request's path and query string) keeps different pages and filters
+    apart.
+    """
+    stats = queryset.order_by().aggregate(**validator_aggregates(timestamp_fields))
+    return validators_from(stats, scope, with_last_modified)
+
+
+async def acompute_validators(queryset, timestamp_fields, scope, with_last_modified=True):
+    stats = await queryset.order_by().aaggregate(**validator_aggregates(timestamp_fields))
+    return validators_from(stats, scope, with_last_modified)
+
+
+def validator_aggregates(timestamp_fields):
+    return {
+        'count': Count('pk'),
+        **{f'last_modified_{index}': Max(field) for index, field in enumerate(timestamp_fields)},
+    }
+
+
+def validators_from(stats, scope, with_last_modified=True):
+    count = stats.pop('count')
+    last_modified = max(filter(None, stats.values()), default=None)
+    stamp = last_modified.isoformat() if last_modified else ''
+    etag = hashlib.md5(f"{stamp}:{count}:{scope}".encode()).hexdigest()
+    if last_modified is None or not with_last_modified:
+        return quote_etag(etag), None
+    # HTTP dates have whole seconds.
+    return quote_etag(etag), int(last_modified.timestamp())
+
+
+def not_modified(request, validators):
+    etag, last_modified = validators
+    return get_conditional_response(request, etag=etag, last_modified=last_modified)
+
+
+def set_validators(response, validators):
+    etag, last_modified = validators
+    response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+    return response
+
+
+class ConditionalGetMixin:
+    """
+    Answers If-None-Match / If-Modified-Since for list and retrieve with a 304
+    before anything is serialized. Views that return a catalog_cache key from
+    ``get_cache_key()`` keep the validators next to the cached payload, so a
+    warm cache answers without touching the database.
+
+    Lists get an ETag only. Deleting a row doesn't lower the latest
+    timestamp, so a Last-Modified date would keep answering 304 for a list
+    that lost a row; the ETag also counts the rows.
+    """
+    last_modified_fields = ('updated_at',)
+
+    def get_cache_key(self):
+        return None
+
+    def is_detail(self):
+        return (self.lookup_url_kwarg or self.lookup_field) in self.kwargs
+
+    def get_validator_queryset(self):
+        queryset = self.filter_queryset(self.get_queryset())
+        if self.is_detail():
+            lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+            queryset = queryset.filter(**{self.lookup_field: self.kwargs[lookup_url_kwarg]})
+        return queryset
+
+    def conditional(self, request, render):
+        cache_key = self.get_cache_key()
+        cached = catalog_cache.get_cached(cache_key) if cache_key else None
+        if cached is not None:
+            data, validators = cached
+        else:
+            # Taken before the payload: a write in between only costs the
+            # client one extra download, never a 304 for stale data.
+            data = None
+            validators = compute_validators(
+                self.get_validator_queryset(), self.last_modified_fields, request.get_full_path(), self.is_detail(),
+            )
+
+        response = not_modified(request, validators)
+        if response is not None:
+            return response
+
+        if data is None:
+            data = render().data
+            if cache_key:
+                catalog_cache.store(cache_key, (data, validators))
+        return set_validators(Response(data), validators)
+
+    def list(self, request, *args, **kwargs):
+        return self.conditional(request, lambda: super(ConditionalGetMixin, self).list(request, *args, **kwargs))
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.conditional(request, lambda: super(ConditionalGetMixin, self).retrieve(request, *args, **kwargs))
+
+
+class AsyncConditionalGetMixin(ConditionalGetMixin):
+    """
+    ConditionalGetMixin for async views: ``aconditional()`` takes a coroutine
+    function returning the response to cache. The catalog cache is still
+    called directly; Django's cache backends have no async I/O of their own
+    (their a* methods run the sync ones in a thread) and the default one is
+    in-process.
+    """
+
+    async def aconditional(self, request, render):
+        cache_key = self.get_cache_key()
+        cached = catalog_cache.get_cached(cache_key) if cache_key else None
+        if cached is not None:
+            data, validators = cached
+        else:
+            data = None
+            validators = await acompute_validators(
+                self.get_validator_queryset(), self.last_modified_fields, request.get_full_path(), self.is_detail(),
+            )
+
+        response = not_modified(request, validators)
+        if response is not None:
+            return response
+
+        if data is None:
+            data = (await render()).data
+            if cache_key:
+                catalog_cache.store(cache_key, (data, validators))
+        return set_validators(Response(data), validators)
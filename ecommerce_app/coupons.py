@@ -0,0 +1,94 @@
+import threading
+import time
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import Coupon, CouponRedemption
+
+
+class CouponUnavailable(Exception):
+    pass
+
+
+class CouponIndex:
+    """
+    In-process map of coupon code to Coupon for every coupon that hasn't
+    expired yet. Reloaded with a single query once COUPON_INDEX_TTL has passed
+    or when a coupon is written in this process; other processes catch up
+    within the TTL. Usage limits are enforced in the database, not here.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._coupons = None
+        self._expires_at = 0
+
+    def get_ttl(self):
+        return getattr(settings, 'COUPON_INDEX_TTL', 60)
+
+    def invalidate(self):
+        self._expires_at = 0
+
+    def load(self):
+        today = timezone.localdate()
+        # From the primary: a stale replica read would be kept for the whole TTL.
+        unexpired = Coupon.objects.using(DEFAULT_DB_ALIAS).filter(end_date__gte=today)
+        return {coupon.coupon_code: coupon for coupon in unexpired}
+
+    def all(self):
+        if time.monotonic() >= self._expires_at:
+            with self._lock:
+                if time.monotonic() >= self._expires_at:
+                    self._coupons = self.load()
+                    self._expires_at = time.monotonic() + self.get_ttl()
+        return self._coupons
+
+    def active(self):
+        today = timezone.localdate()
+        return sorted(
+            (coupon for coupon in self.all().values() if coupon.start_date <= today <= coupon.end_date),
+            key=lambda coupon: coupon.pk,
+        )
+
+    def get(self, coupon_code):
+        coupon = self.all().get(coupon_code)
+        if coupon is None:
+            return None
+        if not coupon.start_date <= timezone.localdate() <= coupon.end_date:
+            return None
+        return coupon
+
+
+index = CouponIndex()
+
+
+def get_active(coupon_code):
+    return index.get(coupon_code)
+
+
+def redeem(coupon, user, order):
+    """
+    Uses up one redemption of ``coupon`` for ``user``'s ``order``. Must run
+    inside the checkout transaction; raises CouponUnavailable when the usage
+    limit is reached or the user already redeemed the coupon.
+
+    A coupon is good for one order per user, and for max_usage orders in all
+    (unlimited when it's None). Before the redemption table any order with
+    the coupon used it up for everyone, whatever max_usage said.
+    """
+    if coupon.max_usage is not None:
+        # Conditional decrement, so concurrent checkouts can't over-redeem.
+        used = Coupon.objects.filter(pk=coupon.pk, max_usage__gt=0).update(max_usage=F('max_usage') - 1)
+        if not used:
+            raise CouponUnavailable('Coupon has reached its maximum usage limit')
+        # update() sends no signals, so the index is refreshed here. Not
+        # before the commit, or another request could cache the old count again.
+        transaction.on_commit(index.invalidate)
+    try:
+        with transaction.atomic():
+            CouponRedemption.objects.create(coupon=coupon, user=user, order=order)
+    except IntegrityError:
+        raise CouponUnavailable('Coupon has already been used')
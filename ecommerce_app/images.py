@@ -0,0 +1,105 @@
+import io
+import os
+import posixpath
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.utils import timezone
+from PIL import Image, ImageOps
+
+from . import catalog_cache
+from .models import Product
+from .storage import content_hash, derived_image_storage, is_content_addressed, product_image_storage
+
+DERIVED_DIR = 'product_images/derived'
+
+# Longest edge in pixels for each variant; images are never upscaled.
+DEFAULT_SIZES = {'thumbnail': 150, 'list': 400, 'detail': 1000}
+
+FORMATS = {
+    'jpeg': ('JPEG', '.jpg', {'quality': 85, 'optimize': True, 'progressive': True}),
+    'webp': ('WEBP', '.webp', {'quality': 80, 'method': 4}),
+}
+
+
+def get_sizes():
+    return getattr(settings, 'PRODUCT_IMAGE_SIZES', DEFAULT_SIZES)
+
+
+def source_digest(name):
+    # Originals saved through ContentAddressedStorage are named after their hash.
+    if is_content_addressed(name):
+        return os.path.splitext(posixpath.basename(name))[0]
+    with product_image_storage.open(name, 'rb') as f:
+        return content_hash(f)
+
+
+def render_variant(image, edge, image_format, options):
+    variant = image.copy()
+    variant.thumbnail((edge, edge), Image.LANCZOS)
+    if image_format == 'JPEG' and variant.mode != 'RGB':
+        variant = variant.convert('RGB')
+    output = io.BytesIO()
+    variant.save(output, image_format, **options)
+    return output.getvalue()
+
+
+def build_variants(name):
+    """
+    Renders every size and format of the original stored at ``name`` and
+    returns ``{size: {format: path}}``. Variants are named after the
+    original's content hash, so products sharing an image share its variants
+    and existing files are not rendered again.
+    """
+    digest = source_digest(name)
+    variants = {}
+    image = None
+    for size, edge in get_sizes().items():
+        variants[size] = {}
+        for format_name, (image_format, extension, options) in FORMATS.items():
+            path = f'{DERIVED_DIR}/{digest[:2]}/{digest}_{size}{extension}'
+            if not derived_image_storage.exists(path):
+                if image is None:
+                    with product_image_storage.open(name, 'rb') as f:
+                        image = ImageOps.exif_transpose(Image.open(f))
+                        image.load()
+                content = render_variant(image, edge, image_format, options)
+                path = derived_image_storage.save(path, ContentFile(content))
+            variants[size][format_name] = path
+    return variants
+
+
+def pending_products():
+    return Product.objects.exclude(image='').exclude(image__isnull=True).filter(image_variants={})
+
+
+def process_product(product):
+    variants = build_variants(product.image.name)
+    # update() skips the product signals, so nothing else gets recomputed.
+    updated = Product.objects.filter(pk=product.pk, image=product.image.name).update(
+        image_variants=variants, updated_at=timezone.now(),
+    )
+    if updated:
+        catalog_cache.invalidate_products([(product.pk, product.category_id)])
+    return variants
+
+
+def rehash_original(product):
+    """
+    Moves a product's image to its content-addressed name, so byte-identical
+    uploads made before the storage change end up sharing one file. The old
+    file is deleted once no product points at it any more.
+    """
+    name = product.image.name
+    if is_content_addressed(name):
+        return name
+    with product_image_storage.open(name, 'rb') as f:
+        new_name = product_image_storage.save(name, f)
+    if new_name != name:
+        Product.objects.filter(pk=product.pk, image=name).update(
+            image=new_name, image_variants={}, updated_at=timezone.now(),
+        )
+        catalog_cache.invalidate_products([(product.pk, product.category_id)])
+        if not Product.objects.filter(image=name).exists():
+            product_image_storage.delete(name)
+    return new_name
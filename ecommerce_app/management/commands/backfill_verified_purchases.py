@@ -0,0 +1,69 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from ecommerce_app import sharding
+from ecommerce_app.models import OrderItem, ProductReview, VerifiedPurchase
+
+
+class Command(BaseCommand):
+    help = 'Builds the verified purchase table from order history and links the existing reviews to it.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        purchases = sum(self.backfill_purchases(alias, batch_size) for alias in sharding.get_shards())
+        linked = self.link_reviews(batch_size)
+        self.stdout.write(f'Scanned {purchases} order items, linked {linked} reviews.')
+
+    def backfill_purchases(self, alias, batch_size):
+        # Seeks through a shard's order items by id so each batch is one
+        # indexed range read.
+        scanned = 0
+        after_id = 0
+        while True:
+            batch = list(
+                OrderItem.objects.using(alias).filter(id__gt=after_id).order_by('id')
+                .values_list('id', 'order__user_id', 'product_id')[:batch_size]
+            )
+            if not batch:
+                return scanned
+            pairs = {(user_id, product_id) for _, user_id, product_id in batch}
+            VerifiedPurchase.objects.bulk_create(
+                [VerifiedPurchase(user_id=user_id, product_id=product_id) for user_id, product_id in pairs],
+                ignore_conflicts=True,
+            )
+            scanned += len(batch)
+            after_id = batch[-1][0]
+
+    def link_reviews(self, batch_size):
+        # The oldest review of each purchase takes its slot; reviews without a
+        # purchase behind them are left alone.
+        linked = 0
+        after_id = 0
+        while True:
+            reviews = list(
+                ProductReview.objects.filter(id__gt=after_id).order_by('id')
+                .values_list('id', 'user_id', 'product_id')[:batch_size]
+            )
+            if not reviews:
+                return linked
+            after_id = reviews[-1][0]
+            first_review = {}
+            for review_id, user_id, product_id in reviews:
+                first_review.setdefault((user_id, product_id), review_id)
+            with transaction.atomic():
+                open_purchases = VerifiedPurchase.objects.filter(
+                    review__isnull=True,
+                    user_id__in={user_id for user_id, _ in first_review},
+                    product_id__in={product_id for _, product_id in first_review},
+                ).select_for_update()
+                updated = []
+                for purchase in open_purchases:
+                    review_id = first_review.get((purchase.user_id, purchase.product_id))
+                    if review_id is not None:
+                        purchase.review_id = review_id
+                        updated.append(purchase)
+                VerifiedPurchase.objects.bulk_update(updated, ['review'])
+            linked += len(updated)
@@ -0,0 +1,449 @@
+import asyncio
+import json
+import logging
+import math
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import subprocess
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from decimal import Decimal
+
+import django
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.core.cache import caches
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connection, connections
+from django.test import override_settings
+from django.test.client import AsyncClient
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from ecommerce_app import routers, sharding
+from ecommerce_app.authentication import user_cache
+from ecommerce_app.models import Category, Coupon, CustomUser, Product
+
+SCENARIOS = ['login', 'catalog', 'search', 'cart_add', 'coupon', 'checkout', 'history']
+
+PASSWORD = 'benchmark-password'
+COUPON_CODE = 'BENCHMARK10'
+WORDS = ['oak', 'pine', 'walnut', 'chair', 'table', 'lamp', 'sofa', 'desk', 'shelf', 'rug', 'bed', 'stool']
+
+
+def percentile(sorted_values, p):
+    # Nearest-rank, so every reported value is a latency that was observed.
+    if not sorted_values:
+        return None
+    return sorted_values[max(0, math.ceil(p / 100 * len(sorted_values)) - 1)]
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=settings.BASE_DIR,
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Worker:
+    """
+    One simulated client: its own user, thread, API client and database
+    connection. Requests go through the full middleware and URL stack.
+    """
+
+    def __init__(self, email, product_ids, rng):
+        self.email = email
+        self.product_ids = product_ids
+        self.rng = rng
+        # Failures come back as 500 responses and count as errors.
+        self.client = APIClient(HTTP_HOST='localhost', raise_request_exception=False)
+        self.authenticated = False
+
+    def get(self, path, params=None):
+        return self.client.get(path, params)
+
+    def post(self, path, data):
+        return self.client.post(path, data, format='json')
+
+    def login(self):
+        response = self.post('/login/', {'email': self.email, 'password': PASSWORD})
+        if response.status_code == 200:
+            self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {response.data['access_token']}")
+            self.authenticated = True
+        return response
+
+    def ensure_login(self):
+        if not self.authenticated:
+            self.login()
+
+    def add_to_cart(self):
+        return self.post('/cart/', {'product_id': self.rng.choice(self.product_ids), 'quantity': 1})
+
+    # Each scenario returns (setup, request): setup runs untimed, request is
+    # the timed call.
+
+    def scenario_login(self):
+        return None, self.login
+
+    def scenario_catalog(self):
+        params = {'page_size': 20}
+        if self.rng.random() < 0.3:
+            params['category'] = self.rng.choice(self.category_ids)
+        else:
+            params['page'] = self.rng.randint(1, 5)
+        return self.ensure_login, lambda: self.get('/product_list/', params)
+
+    def scenario_search(self):
+        params = {'q': self.rng.choice(WORDS)}
+        return self.ensure_login, lambda: self.get('/product_list/', params)
+
+    def scenario_cart_add(self):
+        return self.ensure_login, self.add_to_cart
+
+    def scenario_coupon(self):
+        def setup():
+            self.ensure_login()
+            self.add_to_cart()
+        return setup, self.validate_coupon
+
+    def scenario_checkout(self):
+        def setup():
+            self.ensure_login()
+            for _ in range(self.rng.randint(1, 5)):
+                self.add_to_cart()
+        return setup, self.place_order
+
+    def scenario_history(self):
+        return self.ensure_login, lambda: self.get('/order_history/', {'page_size': 20})
+
+    def validate_coupon(self):
+        return self.post('/validate_coupon_for_cart/', {'coupon_code': COUPON_CODE})
+
+    def place_order(self):
+        return self.post('/place_order/', {'shipping_address': 'Benchmark street 1', 'payment_method': 'card'})
+
+
+class AsyncWorker(Worker):
+    """
+    The same client on Django's AsyncClient, for --interface asgi: requests
+    go through the async handler and the ASGI URLconf, and every call returns
+    a coroutine. The clients are tasks on one event loop, not threads.
+    """
+
+    def __init__(self, email, product_ids, rng):
+        super().__init__(email, product_ids, rng)
+        self.client = AsyncClient(raise_request_exception=False)
+        self.headers = {}
+
+    def get(self, path, params=None):
+        return self.client.get(path, params, headers=self.headers)
+
+    def post(self, path, data):
+        return self.client.post(path, data, content_type='application/json', headers=self.headers)
+
+    async def login(self):
+        response = await self.post('/login/', {'email': self.email, 'password': PASSWORD})
+        if response.status_code == 200:
+            self.headers = {'Authorization': f"Bearer {response.json()['access_token']}"}
+            self.authenticated = True
+        return response
+
+    async def ensure_login(self):
+        if not self.authenticated:
+            await self.login()
+
+    def scenario_coupon(self):
+        async def setup():
+            await self.ensure_login()
+            await self.add_to_cart()
+        return setup, self.validate_coupon
+
+    def scenario_checkout(self):
+        async def setup():
+            await self.ensure_login()
+            for _ in range(self.rng.randint(1, 5)):
+                await self.add_to_cart()
+        return setup, self.place_order
+
+
+class Command(BaseCommand):
+    help = (
+        'Drives the API in-process with concurrent clients against a throwaway SQLite database and '
+        'reports throughput and p50/p95/p99 latency per scenario.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=SCENARIOS)
+        parser.add_argument('--concurrency', type=int, default=4, help='Simultaneous clients.')
+        parser.add_argument('--interface', choices=['wsgi', 'asgi'], default='wsgi',
+                            help='Serve through the WSGI handler with a thread per client, or through the '
+                                 'ASGI handler and URLconf with a task per client on one event loop.')
+        parser.add_argument('--requests', type=int, default=200, help='Timed requests per scenario.')
+        parser.add_argument('--warmup', type=int, default=5, help='Untimed requests per client first.')
+        parser.add_argument('--products', type=int, default=2000, help='Products to seed into a fresh database.')
+        parser.add_argument('--database',
+                            help='Seeded SQLite file to benchmark against. It is copied first and never modified.')
+        parser.add_argument('--seed', type=int, default=1, help='Random seed for data and request mix.')
+        parser.add_argument('--output', help='Write the results as JSON to this file.')
+        parser.add_argument('--compare', help='Earlier JSON results to print the changes against.')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            raise CommandError('benchmark_api runs against SQLite only.')
+        workdir = tempfile.mkdtemp(prefix='benchmark_api-')
+        original_names = {
+            alias: connections[alias].settings_dict['NAME'] for alias in [*sharding.get_shards(), *routers.get_replicas()]
+        }
+        # Error responses are counted per status; logging each one would
+        # swamp the report.
+        request_logger = logging.getLogger('django.request')
+        level = request_logger.level
+        request_logger.setLevel(logging.CRITICAL)
+        # The clients send Host: localhost (AsyncClient always sends
+        # testserver), which DEBUG=False settings wouldn't accept.
+        hosts = override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'localhost', 'testserver'])
+        try:
+            self.prepare_database(workdir, options)
+            with hosts:
+                results = self.run(options)
+        finally:
+            request_logger.setLevel(level)
+            connections.close_all()
+            for alias, name in original_names.items():
+                settings.DATABASES[alias]['NAME'] = name
+                connections[alias].settings_dict['NAME'] = name
+            shutil.rmtree(workdir, ignore_errors=True)
+
+        self.report(results, options.get('compare'))
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2)
+            self.stdout.write(f"Results written to {options['output']}")
+
+    def prepare_database(self, workdir, options):
+        name = os.path.join(workdir, 'benchmark.sqlite3')
+        if options['database']:
+            # sqlite3's backup API gives a consistent copy even of a live file.
+            with sqlite3.connect(options['database']) as source, sqlite3.connect(name) as target:
+                source.backup(target)
+        connections.close_all()
+        from django.core.management import call_command
+        # Safe requests read from the replicas, so they read the benchmark
+        # database too, as replicas that never lag.
+        for alias in routers.get_replicas():
+            settings.DATABASES[alias]['NAME'] = name
+            connections[alias].settings_dict['NAME'] = name
+        for alias in sharding.get_shards():
+            # Other shards start out empty; the benchmark users are new anyway.
+            if alias != DEFAULT_DB_ALIAS:
+                name = os.path.join(workdir, f'benchmark-{alias}.sqlite3')
+            settings.DATABASES[alias]['NAME'] = name
+            connections[alias].settings_dict['NAME'] = name
+            call_command('migrate', database=alias, verbosity=0, interactive=False)
+        self.seed(options)
+
+    def seed(self, options):
+        rng = random.Random(options['seed'])
+        if not Product.objects.exists():
+            categories = Category.objects.bulk_create(Category(name=f'Benchmark {word}') for word in WORDS)
+            Product.objects.bulk_create(
+                (
+                    Product(
+                        name=f'{rng.choice(WORDS)} {rng.choice(WORDS)} {i}',
+                        description=' '.join(rng.choice(WORDS) for _ in range(12)),
+                        price=Decimal(rng.randint(100, 100000)) / 100,
+                        quantity=10 ** 6,
+                        category=rng.choice(categories),
+                    )
+                    for i in range(options['products'])
+                ),
+                batch_size=500,
+            )
+        # Checkout needs stock however many orders the run places.
+        Product.objects.update(quantity=10 ** 6)
+
+        # One hash for every client: hashing per user would dominate seeding.
+        password = make_password(PASSWORD)
+        emails = [f"benchmark-{i}-{options['seed']}@example.com" for i in range(options['concurrency'])]
+        CustomUser.objects.filter(email__in=emails).delete()
+        CustomUser.objects.bulk_create(
+            CustomUser(email=email, password=password, first_name='Bench', last_name='Mark') for email in emails
+        )
+        today = timezone.localdate()
+        Coupon.objects.update_or_create(coupon_code=COUPON_CODE, defaults={
+            'discount_type': 'percentage', 'discount_value': 10, 'min_purchase_amount': 0,
+            'start_date': today - timedelta(days=1), 'end_date': today + timedelta(days=365), 'max_usage': None,
+        })
+        self.emails = emails
+
+    def run(self, options):
+        product_ids = list(Product.objects.values_list('id', flat=True))
+        category_ids = list(Category.objects.values_list('id', flat=True))
+        worker_class = AsyncWorker if options['interface'] == 'asgi' else Worker
+        workers = []
+        for index, email in enumerate(self.emails):
+            worker = worker_class(email, product_ids, random.Random(f"{options['seed']}-{index}"))
+            worker.category_ids = category_ids
+            workers.append(worker)
+
+        results = {
+            'commit': git_commit(),
+            'started_at': timezone.now().isoformat(),
+            'options': {
+                key: options[key]
+                for key in ('scenarios', 'interface', 'concurrency', 'requests', 'warmup', 'products', 'database', 'seed')
+            },
+            'environment': {
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'sqlite': sqlite3.sqlite_version,
+                'platform': platform.platform(),
+            },
+            'shards': len(sharding.get_shards()),
+            'replicas': len(routers.get_replicas()),
+            'products': len(product_ids),
+            'scenarios': {},
+        }
+        for scenario in options['scenarios']:
+            results['scenarios'][scenario] = self.run_scenario(scenario, workers, options)
+        return results
+
+    def run_scenario(self, scenario, workers, options):
+        # Every scenario starts cold, so the order they run in doesn't matter.
+        for cache_alias in settings.CACHES:
+            caches[cache_alias].clear()
+        user_cache.clear()
+
+        per_worker = [options['requests'] // len(workers)] * len(workers)
+        for index in range(options['requests'] % len(workers)):
+            per_worker[index] += 1
+
+        if options['interface'] == 'asgi':
+            with override_settings(ROOT_URLCONF='ecommerce_project.urls_asgi'):
+                outcomes, wall = asyncio.run(self.drive_tasks(scenario, workers, per_worker, options))
+        else:
+            outcomes, wall = self.drive_threads(scenario, workers, per_worker, options)
+
+        latencies = sorted(latency for worker_latencies, _ in outcomes for latency in worker_latencies)
+        statuses = sum((worker_statuses for _, worker_statuses in outcomes), Counter())
+        # Untimed setup requests are part of the wall clock, so throughput is
+        # per timed request, not per HTTP call.
+        return {
+            'requests': len(latencies),
+            'errors': sum(count for status, count in statuses.items() if status >= 400),
+            'statuses': {str(status): count for status, count in sorted(statuses.items())},
+            'wall_seconds': round(wall, 4),
+            'throughput_rps': round(len(latencies) / wall, 2) if wall else None,
+            'mean_ms': round(sum(latencies) / len(latencies) * 1000, 3) if latencies else None,
+            'p50_ms': round(percentile(latencies, 50) * 1000, 3) if latencies else None,
+            'p95_ms': round(percentile(latencies, 95) * 1000, 3) if latencies else None,
+            'p99_ms': round(percentile(latencies, 99) * 1000, 3) if latencies else None,
+            'max_ms': round(latencies[-1] * 1000, 3) if latencies else None,
+        }
+
+    def drive_threads(self, scenario, workers, per_worker, options):
+        barrier = threading.Barrier(len(workers) + 1)
+
+        def drive(worker, count):
+            latencies, statuses = [], Counter()
+            try:
+                make = getattr(worker, f'scenario_{scenario}')
+                for _ in range(options['warmup']):
+                    setup, request = make()
+                    if setup:
+                        setup()
+                    request()
+                barrier.wait()
+                for _ in range(count):
+                    setup, request = make()
+                    if setup:
+                        setup()
+                    started = time.perf_counter()
+                    response = request()
+                    latencies.append(time.perf_counter() - started)
+                    statuses[response.status_code] += 1
+            except BaseException:
+                # Don't leave the other clients waiting at the start line.
+                barrier.abort()
+                raise
+            finally:
+                connections.close_all()
+            return latencies, statuses
+
+        with ThreadPoolExecutor(max_workers=len(workers)) as pool:
+            futures = [pool.submit(drive, worker, count) for worker, count in zip(workers, per_worker)]
+            try:
+                barrier.wait()
+            except threading.BrokenBarrierError:
+                pass  # future.result() below raises the client's error.
+            started = time.perf_counter()
+            outcomes = [future.result() for future in futures]
+            wall = time.perf_counter() - started
+
+        return outcomes, wall
+
+    async def drive_tasks(self, scenario, workers, per_worker, options):
+        async def warm_up(worker):
+            make = getattr(worker, f'scenario_{scenario}')
+            for _ in range(options['warmup']):
+                setup, request = make()
+                if setup:
+                    await setup()
+                await request()
+
+        async def drive(worker, count):
+            latencies, statuses = [], Counter()
+            make = getattr(worker, f'scenario_{scenario}')
+            for _ in range(count):
+                setup, request = make()
+                if setup:
+                    await setup()
+                started = time.perf_counter()
+                response = await request()
+                latencies.append(time.perf_counter() - started)
+                statuses[response.status_code] += 1
+            return latencies, statuses
+
+        # The ORM calls of the async views run on asgiref's shared sync
+        # thread, whose connections may predate the switch to the benchmark
+        # database.
+        await sync_to_async(connections.close_all)()
+        try:
+            await asyncio.gather(*(warm_up(worker) for worker in workers))
+            started = time.perf_counter()
+            outcomes = await asyncio.gather(*(drive(worker, count) for worker, count in zip(workers, per_worker)))
+            wall = time.perf_counter() - started
+        finally:
+            await sync_to_async(connections.close_all)()
+        return outcomes, wall
+
+    def report(self, results, compare_path):
+        previous = {}
+        if compare_path:
+            with open(compare_path) as f:
+                previous = json.load(f).get('scenarios', {})
+            self.stdout.write(f'Compared with {compare_path} (change in parentheses)')
+
+        columns = ['throughput_rps', 'p50_ms', 'p95_ms', 'p99_ms']
+        self.stdout.write(f"{'scenario':<10} {'requests':>8} {'errors':>6}" + ''.join(f'{c:>24}' for c in columns))
+        for scenario, stats in results['scenarios'].items():
+            line = f"{scenario:<10} {stats['requests']:>8} {stats['errors']:>6}"
+            for column in columns:
+                value = stats[column]
+                cell = '-' if value is None else f'{value:.2f}'
+                before = previous.get(scenario, {}).get(column)
+                if value is not None and before:
+                    cell += f' ({(value - before) / before * 100:+.1f}%)'
+                line += f'{cell:>24}'
+            self.stdout.write(line)
@@ -0,0 +1,101 @@
+import math
+import time
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from ecommerce_app.models import Category, CustomUser, Order, OrderItem, Product
+from ecommerce_app.serializers import OrderSerializer
+from ecommerce_app.views import OrderHistoryView
+
+
+class Command(BaseCommand):
+    help = (
+        'Reports query count and latency of order serialization for growing numbers '
+        'of line items. Data is created inside a transaction that is rolled back.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[1, 100, 10000],
+                            help='Total line items to benchmark with.')
+        parser.add_argument('--items-per-order', type=int, default=10)
+        parser.add_argument('--repeat', type=int, default=3,
+                            help='Runs per measurement; the fastest one is reported.')
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"{'line items':>10} {'orders':>7}  {'measurement':<28} {'queries':>8} {'ms':>10}")
+        for size in options['sizes']:
+            with transaction.atomic():
+                user, orders = self.seed(size, options['items_per_order'])
+                for label, run in self.measurements(user):
+                    queries, elapsed = self.measure(run, options['repeat'])
+                    self.stdout.write(f'{size:>10} {orders:>7}  {label:<28} {queries:>8} {elapsed * 1000:>10.1f}')
+                transaction.set_rollback(True)
+
+    def seed(self, size, items_per_order):
+        user = CustomUser.objects.create_user(
+            f'benchmark-{time.time_ns()}@example.com', 'benchmark', first_name='Bench', last_name='Mark'
+        )
+        category = Category.objects.create(name='Benchmark')
+        products = Product.objects.bulk_create(
+            Product(name=f'Benchmark product {i}', description='', price=Decimal('9.99'), quantity=1000, category=category)
+            for i in range(min(size, 1000))
+        )
+        order_count = math.ceil(size / items_per_order)
+        orders = Order.objects.bulk_create(
+            Order(user=user, total_amount=0, shipping_address='Benchmark street', payment_method='card')
+            for _ in range(order_count)
+        )
+        OrderItem.objects.bulk_create(
+            (
+                OrderItem(
+                    order=orders[i // items_per_order],
+                    product=products[i % len(products)],
+                    quantity=1,
+                    price_at_order=Decimal('9.99'),
+                )
+                for i in range(size)
+            ),
+            batch_size=500,
+        )
+        return user, order_count
+
+    def measurements(self, user):
+        factory = APIRequestFactory()
+        view = OrderHistoryView.as_view()
+
+        def history_page():
+            request = factory.get('/order_history/', {'page_size': 100}, HTTP_HOST='localhost')
+            force_authenticate(request, user=user)
+            view(request).render()
+
+        def full_history():
+            return OrderSerializer(Order.objects.filter(user=user).with_details(), many=True).data
+
+        def full_history_naive():
+            return OrderSerializer(Order.objects.filter(user=user), many=True).data
+
+        return [
+            ('GET /order_history/ (100)', history_page),
+            ('serialize all orders', full_history),
+            ('serialize all (no prefetch)', full_history_naive),
+        ]
+
+    def measure(self, run, repeat):
+        best = None
+        for _ in range(repeat):
+            queries = 0
+
+            def count_queries(execute, sql, params, many, context):
+                nonlocal queries
+                queries += 1
+                return execute(sql, params, many, context)
+
+            with connection.execute_wrapper(count_queries):
+                started = time.perf_counter()
+                run()
+                elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        return queries, best
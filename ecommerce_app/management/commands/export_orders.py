@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from ecommerce_app import order_export, streaming
+from ecommerce_app.serializers import OrderExportFilterSerializer
+
+
+class Command(BaseCommand):
+    help = 'Writes one CSV or NDJSON line per order item, with the order columns repeated on each line.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=sorted(streaming.FORMATS), default='csv')
+        parser.add_argument('--output', default='-', help='File to write, or - for stdout.')
+        parser.add_argument('--date-from', help='YYYY-MM-DD, inclusive.')
+        parser.add_argument('--date-to', help='YYYY-MM-DD, inclusive.')
+        parser.add_argument('--status')
+        parser.add_argument('--coupon')
+
+    def handle(self, *args, **options):
+        params = {
+            name: options[name] for name in ('date_from', 'date_to', 'status', 'coupon') if options[name]
+        }
+        filters = OrderExportFilterSerializer(data=params)
+        if not filters.is_valid():
+            raise CommandError(filters.errors)
+
+        rows = order_export.export_rows(order_export.filter_items(**filters.validated_data))
+        if options['format'] == 'csv':
+            lines = streaming.iter_csv(order_export.FIELDS, rows)
+        else:
+            lines = streaming.iter_ndjson(rows)
+
+        if options['output'] == '-':
+            for line in lines:
+                self.stdout.write(line, ending='')
+        else:
+            with open(options['output'], 'w', encoding='utf-8', newline='') as f:
+                f.writelines(lines)
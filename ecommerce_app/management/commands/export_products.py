@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from ecommerce_app import catalog_io, streaming
+
+
+class Command(BaseCommand):
+    help = 'Writes every product as CSV or NDJSON, in the format import_products reads.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=sorted(streaming.FORMATS), default='csv')
+        parser.add_argument('--output', default='-', help='File to write, or - for stdout.')
+
+    def handle(self, *args, **options):
+        if options['format'] == 'csv':
+            lines = streaming.iter_csv(catalog_io.FIELDS, catalog_io.export_rows())
+        else:
+            lines = streaming.iter_ndjson(catalog_io.export_rows())
+
+        if options['output'] == '-':
+            for line in lines:
+                self.stdout.write(line, ending='')
+        else:
+            with open(options['output'], 'w', encoding='utf-8', newline='') as f:
+                f.writelines(lines)
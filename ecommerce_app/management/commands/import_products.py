@@ -0,0 +1,36 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ecommerce_app import catalog_io, streaming
+
+
+class Command(BaseCommand):
+    help = 'Upserts products from a CSV or NDJSON file (columns: id, name, description, price, quantity, category).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='File to import, or - for stdin.')
+        parser.add_argument('--format', choices=sorted(streaming.FORMATS),
+                            help='Defaults to the file extension.')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        path = options['path']
+        file_format = options['format'] or path.rsplit('.', 1)[-1].lower()
+        if file_format not in streaming.FORMATS:
+            raise CommandError('Pass --format csv or --format ndjson.')
+
+        if path == '-':
+            result = self.run(sys.stdin.buffer, file_format, options['batch_size'])
+        else:
+            with open(path, 'rb') as f:
+                result = self.run(f, file_format, options['batch_size'])
+
+        for error in result['errors']:
+            self.stderr.write(f"Line {error['line']}: {error['errors']}")
+        self.stdout.write(
+            f"Created {result['created']}, updated {result['updated']}, rejected {result['rejected']}."
+        )
+
+    def run(self, binary_file, file_format, batch_size):
+        return catalog_io.import_rows(streaming.read_rows(binary_file, file_format), batch_size=batch_size)
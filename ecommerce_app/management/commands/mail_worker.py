@@ -0,0 +1,73 @@
+import asyncio
+import time
+
+from asgiref.sync import sync_to_async
+from django.core.mail import get_connection
+from django.core.management.base import BaseCommand
+
+from ecommerce_app import outbox
+from ecommerce_app.broadcast import BroadcastSender
+
+
+class Command(BaseCommand):
+    help = (
+        'Sends queued outbox emails and broadcast jobs in batches over a reused SMTP '
+        'connection. Outbox emails go first; broadcasts advance one batch at a time.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=50)
+        parser.add_argument('--broadcast-batch-size', type=int, default=None,
+                            help='Recipients per broadcast message (defaults to BROADCAST_BATCH_SIZE).')
+        parser.add_argument('--interval', type=float, default=1.0,
+                            help='Seconds to sleep when the outbox is empty.')
+        parser.add_argument('--once', action='store_true',
+                            help='Drain whatever is due and exit.')
+        parser.add_argument('--connections', type=int, default=1,
+                            help='SMTP sessions to send outbox emails over at once. Above 1 the outbox is '
+                                 'drained with asyncio, through aiosmtplib with the SMTP backend.')
+
+    def handle(self, *args, **options):
+        if options['connections'] > 1:
+            asyncio.run(self.handle_async(options))
+            return
+        connection = get_connection()
+        broadcasts = BroadcastSender(connection, options['broadcast_batch_size'])
+        try:
+            while True:
+                claimed = outbox.drain(options['batch_size'], connection=connection)
+                if claimed:
+                    self.stdout.write(f'Processed {claimed} email(s).')
+                    continue
+                if broadcasts.step():
+                    continue
+                if options['once']:
+                    break
+                # Don't hold the SMTP connection open while idle.
+                connection.close()
+                time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            pass
+        finally:
+            connection.close()
+
+    async def handle_async(self, options):
+        # Broadcasts are few, large messages and stay on the sync backend.
+        connection = get_connection()
+        broadcasts = BroadcastSender(connection, options['broadcast_batch_size'])
+        step = sync_to_async(broadcasts.step)
+        close = sync_to_async(connection.close)
+        try:
+            while True:
+                claimed = await outbox.adrain(options['batch_size'], options['connections'])
+                if claimed:
+                    self.stdout.write(f'Processed {claimed} email(s).')
+                    continue
+                if await step():
+                    continue
+                if options['once']:
+                    break
+                await close()
+                await asyncio.sleep(options['interval'])
+        finally:
+            await close()
@@ -0,0 +1,32 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from ecommerce_app import reservations
+
+
+class Command(BaseCommand):
+    help = 'Gives the stock held by expired cart reservations back to the products.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--loop', action='store_true',
+                            help='Keep running and release reservations as they expire.')
+        parser.add_argument('--interval', type=float, default=30.0,
+                            help='Seconds to sleep between passes with --loop.')
+
+    def handle(self, *args, **options):
+        while True:
+            try:
+                released = reservations.release_expired(options['batch_size'])
+            except reservations.ReservationChanged:
+                # A cart refreshed one of the holds mid-pass. Leave the batch
+                # to the next pass instead of retrying it straight away.
+                self.stderr.write('Reservations changed during the pass; leaving them to the next one.')
+                released = 0
+            if released:
+                self.stdout.write(f'Released {released} reservations')
+                continue
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,483 @@
+import math
+import random
+import time
+from array import array
+from datetime import timedelta
+from decimal import Decimal
+
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from ecommerce_app import catalog_cache, coupons, search, sharding
+from ecommerce_app.models import (
+    Cart, CartItem, Category, Coupon, CouponRedemption, CustomUser, Order, OrderItem, Product, ProductReview,
+    VerifiedPurchase, Wishlist,
+)
+
+ADJECTIVES = [
+    'classic', 'compact', 'deluxe', 'ergonomic', 'foldable', 'handmade', 'heavy-duty', 'lightweight', 'modern',
+    'organic', 'portable', 'premium', 'rustic', 'smart', 'vintage', 'waterproof', 'wireless', 'wooden',
+]
+NOUNS = [
+    'backpack', 'blender', 'chair', 'desk', 'headphones', 'jacket', 'kettle', 'lamp', 'mug', 'notebook', 'pan',
+    'pillow', 'rug', 'sneakers', 'sofa', 'speaker', 'tent', 'watch',
+]
+FIRST_NAMES = ['Alex', 'Ana', 'Chen', 'Fatima', 'Ivan', 'Kofi', 'Lena', 'Maya', 'Noah', 'Omar', 'Priya', 'Sam']
+LAST_NAMES = ['Garcia', 'Ivanova', 'Kim', 'Mensah', 'Nakamura', 'Novak', 'Okafor', 'Patel', 'Silva', 'Smith']
+# J-shaped, like most review sites: mostly fives, some ones.
+RATING_WEIGHTS = [0.08, 0.05, 0.09, 0.23, 0.55]
+REVIEW_TEXTS = [
+    'Exactly as described.', 'Great value for the price.', 'Stopped working after a month.',
+    'Arrived late but works fine.', 'Would buy again.', 'Not what I expected.', 'Solid build quality.',
+]
+
+
+class Zipf:
+    """
+    Draws ranks 0..n-1 with probability roughly proportional to 1/(rank+1)**s,
+    by inverting the continuous power law, so nothing of size n is kept.
+    Ranks go through a fixed permutation so the popular ids aren't all the
+    lowest ones.
+    """
+
+    def __init__(self, rng, n, s):
+        self.rng = rng
+        self.n = n
+        self.s = s
+        self.stride = rng.randrange(1, n) if n > 1 else 1
+        while math.gcd(self.stride, n) != 1:
+            self.stride += 1
+        self.offset = rng.randrange(n)
+
+    def rank(self):
+        u = self.rng.random()
+        if self.s == 1:
+            x = (self.n + 1) ** u
+        else:
+            x = (((self.n + 1) ** (1 - self.s) - 1) * u + 1) ** (1 / (1 - self.s))
+        return min(int(x) - 1, self.n - 1)
+
+    def __call__(self):
+        return (self.rank() * self.stride + self.offset) % self.n
+
+    def distinct(self, k):
+        k = min(k, self.n)
+        picked = set()
+        while len(picked) < k:
+            picked.add(self())
+        return picked
+
+
+class Table:
+    """
+    Buffers rows for one model and writes them with a single executemany per
+    batch. Rows skip model instances and signals; values for date, decimal and
+    JSON columns go through the field's own database preparation.
+    """
+
+    def __init__(self, connection, model, fields=None):
+        self.connection = connection
+        meta = model._meta
+        concrete = [field for field in meta.local_concrete_fields if fields is None or field.attname in fields]
+        self.names = [field.attname for field in concrete]
+        self.prepare = [
+            field if field.get_internal_type() in ('DateField', 'DateTimeField', 'DecimalField', 'JSONField') else None
+            for field in concrete
+        ]
+        self.defaults = {
+            field.attname: field.get_db_prep_save(field.get_default(), connection)
+            for field in concrete if not field.primary_key and field.has_default()
+        }
+        quote = connection.ops.quote_name
+        self.sql = (
+            f"INSERT INTO {quote(meta.db_table)} ({', '.join(quote(name) for name in self.names)}) "
+            f"VALUES ({', '.join(['%s'] * len(self.names))})"
+        )
+        self.last_prepared = [None] * len(self.names)
+        self.rows = []
+        self.written = 0
+
+    def add(self, **values):
+        row = []
+        for index, (name, field) in enumerate(zip(self.names, self.prepare)):
+            if name not in values:
+                row.append(self.defaults.get(name))
+            elif field is not None and values[name] is not None:
+                # Columns often repeat the previous value (a batch timestamp),
+                # so the last preparation is reused.
+                value = values[name]
+                last = self.last_prepared[index]
+                if last is None or last[0] != value:
+                    last = self.last_prepared[index] = (value, field.get_db_prep_save(value, self.connection))
+                row.append(last[1])
+            else:
+                row.append(values[name])
+        self.rows.append(row)
+
+    def flush(self):
+        if self.rows:
+            with self.connection.cursor() as cursor:
+                cursor.executemany(self.sql, self.rows)
+            self.written += len(self.rows)
+            self.rows = []
+
+
+def next_id(model, using):
+    last = model.objects.using(using).aggregate(last=Max('pk'))['last'] or 0
+    if sharding.is_sharded(model) and using in sharding.get_shards():
+        # Stay in the shard's id range.
+        last = max(last, sharding.get_shards().index(using) * sharding.ID_SPAN)
+    return last + 1
+
+
+class Command(BaseCommand):
+    help = (
+        'Seeds a deterministic synthetic dataset for scale testing: categories, products, users with carts and '
+        'wishlists, orders, reviews and coupons, with Zipf-skewed hot products and heavy buyers. Rows are written '
+        'with batched inserts and every user shares one pre-hashed password.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=100000)
+        parser.add_argument('--categories', type=int, default=200)
+        parser.add_argument('--users', type=int, default=20000)
+        parser.add_argument('--orders', type=int, default=100000)
+        parser.add_argument('--coupons', type=int, default=50)
+        parser.add_argument('--max-items-per-order', type=int, default=6)
+        parser.add_argument('--review-rate', type=float, default=0.2,
+                            help='Share of purchased products the buyer reviews.')
+        parser.add_argument('--coupon-rate', type=float, default=0.1, help='Share of orders that use a coupon.')
+        parser.add_argument('--cart-rate', type=float, default=0.3, help='Share of users with a non-empty cart.')
+        parser.add_argument('--wishlist-rate', type=float, default=0.2, help='Share of users with a wishlist.')
+        parser.add_argument('--skew', type=float, default=1.1,
+                            help='Zipf exponent for product popularity and orders per user.')
+        parser.add_argument('--days', type=int, default=365, help='Orders are spread over this many past days.')
+        parser.add_argument('--password', default='password', help='Password of every seeded user.')
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--batch-size', type=int, default=10000)
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS)
+
+    def handle(self, *args, **options):
+        for name in ('products', 'categories', 'users'):
+            if options[name] < 1:
+                raise CommandError(f'--{name} must be at least 1.')
+        using = options['database']
+        connection = connections[using]
+        if CustomUser.objects.using(using).filter(email__startswith=f"seed{options['seed']}-").exists():
+            raise CommandError(f"Seed {options['seed']} is already in this database; pick another --seed.")
+
+        self.rng = random.Random(options['seed'])
+        self.options = options
+        self.connection = connection
+        self.using = using
+        # Seeding the default database fills every shard; carts, orders and
+        # wishlists go to their user's.
+        self.shards = sharding.get_shards() if using == DEFAULT_DB_ALIAS else [using]
+        self.now = timezone.now().replace(microsecond=0)
+        started = time.monotonic()
+
+        for alias in {using, *self.shards}:
+            # SQLite refuses to change synchronous inside a transaction (as when
+            # called from another command's atomic block); the seed is just slower.
+            if connections[alias].vendor == 'sqlite' and not connections[alias].in_atomic_block:
+                with connections[alias].cursor() as cursor:
+                    # Losing a seed run to a crash is fine; waiting on fsync isn't.
+                    cursor.execute('PRAGMA synchronous = OFF')
+                    cursor.execute('PRAGMA temp_store = MEMORY')
+                    cursor.execute('PRAGMA cache_size = -262144')
+
+        # The full-text index is rebuilt once at the end instead of one trigger
+        # firing per product.
+        rebuild_search = search.is_supported(connection)
+        if rebuild_search:
+            search.uninstall(connection)
+        try:
+            self.seed_catalog()
+            self.seed_coupons()
+            self.seed_users()
+            self.seed_activity()
+        finally:
+            if rebuild_search:
+                self.log('Rebuilding the search index')
+                search.install(connection)
+
+        catalog_cache.bump([catalog_cache.ALL_GENERATION])
+        coupons.index.invalidate()
+        self.stdout.write(f'Done in {time.monotonic() - started:.1f}s.')
+
+    def log(self, message):
+        self.stdout.write(message)
+        self.stdout.flush()
+
+    def write(self, *tables):
+        # Tables are flushed together, parents first, in one transaction per
+        # database.
+        for alias in dict.fromkeys(table.connection.alias for table in tables):
+            with transaction.atomic(using=alias):
+                for table in tables:
+                    if table.connection.alias == alias:
+                        table.flush()
+
+    def random_time(self, days):
+        return self.now - timedelta(seconds=self.rng.randrange(max(days, 1) * 86400))
+
+    def seed_catalog(self):
+        options = self.options
+        rng = self.rng
+        self.log(f"Seeding {options['categories']} categories and {options['products']} products")
+
+        categories = Table(self.connection, Category)
+        first_category = next_id(Category, self.using)
+        for i in range(options['categories']):
+            categories.add(id=first_category + i, name=f'{rng.choice(ADJECTIVES).title()} {rng.choice(NOUNS)}s {i}',
+                           updated_at=self.now)
+        self.write(categories)
+
+        # Some categories are far bigger than others.
+        category_of = Zipf(rng, options['categories'], 1.0)
+        products = Table(self.connection, Product)
+        self.first_product = next_id(Product, self.using)
+        # Current prices in cents, for order and cart totals.
+        self.prices = array('q')
+        # Building a fresh description per product costs more than inserting it.
+        descriptions = [
+            ' '.join(rng.choice(ADJECTIVES + NOUNS) for _ in range(rng.randint(8, 30))) for _ in range(4096)
+        ]
+        for i in range(options['products']):
+            price = max(99, int(math.exp(rng.gauss(3.4, 1.0)) * 100))
+            self.prices.append(price)
+            # One product in twenty is sold out.
+            quantity = 0 if rng.random() < 0.05 else rng.randint(1, 1000)
+            products.add(
+                id=self.first_product + i,
+                name=f'{rng.choice(ADJECTIVES).title()} {rng.choice(ADJECTIVES)} {rng.choice(NOUNS)} {i}',
+                description=rng.choice(descriptions),
+                price=Decimal(price) / 100,
+                quantity=quantity,
+                category_id=first_category + category_of(),
+                updated_at=self.now,
+            )
+            if len(products.rows) >= options['batch_size']:
+                self.write(products)
+        self.write(products)
+        self.popular_products = Zipf(rng, options['products'], options['skew'])
+
+    def seed_coupons(self):
+        options = self.options
+        rng = self.rng
+        table = Table(self.connection, Coupon)
+        first_coupon = next_id(Coupon, self.using)
+        self.coupons = []
+        today = self.now.date()
+        for i in range(options['coupons']):
+            percentage = rng.random() < 0.5
+            discount = Decimal(rng.choice([5, 10, 15, 20, 25])) if percentage else Decimal(rng.choice([5, 10, 20, 50]))
+            min_purchase = Decimal(rng.choice([0, 0, 25, 50, 100]))
+            start = today - timedelta(days=rng.randrange(options['days'] + 1))
+            # A quarter of them have run out already.
+            end = start + timedelta(days=rng.randint(7, 90)) if rng.random() < 0.25 else today + timedelta(days=365)
+            limit = rng.choice([None, None, 100, 1000, 10000])
+            code = f"SEED{options['seed']}-{i}"
+            self.coupons.append({
+                'id': first_coupon + i, 'code': code, 'percentage': percentage, 'discount': discount, 'min_purchase': min_purchase,
+                'start': start, 'end': end, 'remaining': limit,
+            })
+            table.add(
+                id=first_coupon + i, coupon_code=code,
+                discount_type='percentage' if percentage else 'amount', discount_value=discount,
+                min_purchase_amount=min_purchase, start_date=start, end_date=end, max_usage=limit,
+            )
+        self.coupon_table = table
+
+    def seed_users(self):
+        options = self.options
+        rng = self.rng
+        self.log(f"Seeding {options['users']} users")
+        # Hashing is deliberately slow; one hash serves every user.
+        password = make_password(options['password'])
+        table = Table(self.connection, CustomUser)
+        self.first_user = next_id(CustomUser, self.using)
+        for i in range(options['users']):
+            table.add(
+                id=self.first_user + i, email=f"seed{options['seed']}-user{i}@example.com", password=password,
+                first_name=rng.choice(FIRST_NAMES), last_name=rng.choice(LAST_NAMES),
+            )
+            if len(table.rows) >= options['batch_size']:
+                self.write(table)
+        self.write(table)
+
+    def seed_activity(self):
+        options = self.options
+        rng = self.rng
+        self.log(f"Seeding {options['orders']} orders, reviews, carts and wishlists")
+
+        # Orders per user are Zipf-distributed too: a few heavy buyers, a long
+        # tail of one-time customers and many users who never ordered.
+        buyers = Zipf(rng, options['users'], options['skew'])
+        orders_per_user = array('q', [0]) * options['users']
+        for _ in range(options['orders']):
+            orders_per_user[buyers()] += 1
+
+        # {alias: {model: table}} for the per-user tables of each shard.
+        sharded = {
+            alias: {model: Table(connections[alias], model) for model in (
+                Cart, CartItem, Wishlist, Wishlist.products.through, Order, OrderItem,
+            )}
+            for alias in self.shards
+        }
+        reviews = Table(self.connection, ProductReview)
+        purchases = Table(self.connection, VerifiedPurchase)
+        redemptions = Table(self.connection, CouponRedemption)
+        tables = [self.coupon_table]
+        for shard_tables in sharded.values():
+            tables.extend(shard_tables.values())
+        tables.extend([reviews, purchases, redemptions])
+        ids = {table: next_id(table_model, self.using) for table, table_model in (
+            (reviews, ProductReview), (purchases, VerifiedPurchase), (redemptions, CouponRedemption),
+        )}
+        for alias, shard_tables in sharded.items():
+            ids.update((table, next_id(table_model, alias)) for table_model, table in shard_tables.items())
+
+        def new_id(table):
+            ids[table] += 1
+            return ids[table] - 1
+
+        # {product_id: [count of 1-star, ..., count of 5-star]}
+        ratings = {}
+
+        for index in range(options['users']):
+            user_id = self.first_user + index
+            shard_tables = sharded[self.shards[0] if len(self.shards) == 1 else sharding.shard_for_user(user_id)]
+            carts, cart_items, wishlists, wishlist_products, orders, order_items = shard_tables.values()
+
+            if rng.random() < options['cart_rate']:
+                cart_id = new_id(carts)
+                subtotal = 0
+                item_count = 0
+                for rank in self.popular_products.distinct(rng.randint(1, 5)):
+                    quantity = rng.randint(1, 3)
+                    cart_items.add(id=new_id(cart_items), cart_id=cart_id, product_id=self.first_product + rank,
+                                   quantity=quantity)
+                    subtotal += self.prices[rank] * quantity
+                    item_count += quantity
+                carts.add(id=cart_id, user_id=user_id, created_at=self.random_time(30),
+                          subtotal=Decimal(subtotal) / 100, item_count=item_count)
+
+            if rng.random() < options['wishlist_rate']:
+                wishlist_id = new_id(wishlists)
+                wishlists.add(id=wishlist_id, user_id=user_id)
+                for rank in self.popular_products.distinct(rng.randint(1, 10)):
+                    wishlist_products.add(id=new_id(wishlist_products), wishlist_id=wishlist_id,
+                                          product_id=self.first_product + rank)
+
+            # First purchase time per product, for verified purchases and reviews.
+            purchased = {}
+            used_coupons = set()
+            for _ in range(orders_per_user[index]):
+                order_id = new_id(orders)
+                created_at = self.random_time(options['days'])
+                total = 0
+                for rank in self.popular_products.distinct(rng.randint(1, options['max_items_per_order'])):
+                    quantity = rng.choice([1, 1, 1, 2, 3])
+                    order_items.add(id=new_id(order_items), order_id=order_id, product_id=self.first_product + rank,
+                                    quantity=quantity, price_at_order=Decimal(self.prices[rank]) / 100)
+                    total += self.prices[rank] * quantity
+                    if rank not in purchased or purchased[rank] > created_at:
+                        purchased[rank] = created_at
+
+                total = Decimal(total) / 100
+                order = {
+                    'id': order_id, 'user_id': user_id, 'total_amount': total, 'total_amount_without_coupon': total,
+                    'shipping_address': f'{rng.randint(1, 999)} Seed street', 'created_at': created_at,
+                    'payment_method': rng.choice(['card', 'card', 'paypal', 'cash_on_delivery']),
+                    'order_status': self.status_for(created_at),
+                }
+                if self.coupons and rng.random() < options['coupon_rate']:
+                    self.apply_coupon(order, used_coupons, redemptions, new_id)
+                orders.add(**order)
+
+            for rank, bought_at in sorted(purchased.items()):
+                review_id = None
+                if rng.random() < options['review_rate']:
+                    review_id = new_id(reviews)
+                    rating = rng.choices(range(1, 6), RATING_WEIGHTS)[0]
+                    reviews.add(id=review_id, user_id=user_id, product_id=self.first_product + rank, rating=rating,
+                                review_text=rng.choice(REVIEW_TEXTS),
+                                created_at=bought_at + timedelta(days=rng.randint(2, 30)))
+                    ratings.setdefault(rank, [0] * 5)[rating - 1] += 1
+                purchases.add(id=new_id(purchases), user_id=user_id, product_id=self.first_product + rank,
+                              review_id=review_id, created_at=bought_at)
+
+            if sum(len(table.rows) for table in tables) >= options['batch_size']:
+                self.write(*tables)
+        self.write(*tables)
+
+        self.write_ratings(ratings)
+        self.write_coupon_usage()
+        written = {model: sum(shard_tables[model].written for shard_tables in sharded.values()) for model in (
+            Cart, Wishlist, Order, OrderItem,
+        )}
+        self.log(
+            f'Wrote {written[Order]} orders, {written[OrderItem]} order items, {reviews.written} reviews, '
+            f'{written[Cart]} carts, {written[Wishlist]} wishlists and {redemptions.written} coupon redemptions '
+            f'over {len(self.shards)} shard(s).'
+        )
+
+    def status_for(self, created_at):
+        age = self.now - created_at
+        if age > timedelta(days=7):
+            return 'Delivered'
+        if age > timedelta(days=2):
+            return 'Shipped'
+        return 'Processing'
+
+    def apply_coupon(self, order, used_coupons, redemptions, new_id):
+        coupon = self.rng.choice(self.coupons)
+        if (
+            coupon['id'] in used_coupons
+            or coupon['remaining'] == 0
+            or not coupon['start'] <= order['created_at'].date() <= coupon['end']
+            or order['total_amount'] < coupon['min_purchase']
+        ):
+            return
+        if coupon['percentage']:
+            discount = (order['total_amount'] * coupon['discount'] / 100).quantize(Decimal('0.01'))
+        else:
+            discount = min(coupon['discount'], order['total_amount'])
+        order.update(
+            total_amount=order['total_amount'] - discount, discounted_amount=discount,
+            coupon_code=coupon['code'], coupon_applied=True,
+        )
+        if coupon['remaining'] is not None:
+            coupon['remaining'] -= 1
+        used_coupons.add(coupon['id'])
+        redemptions.add(id=new_id(redemptions), coupon_id=coupon['id'], user_id=order['user_id'], order_id=order['id'],
+                        created_at=order['created_at'])
+
+    def write_ratings(self, ratings):
+        # Same values the ProductReview signals would have produced.
+        rows = []
+        for rank, counts in ratings.items():
+            count = sum(counts)
+            total = sum(rating * n for rating, n in zip(range(1, 6), counts))
+            rows.append([count, total, *counts, total / count, self.first_product + rank])
+        quote = self.connection.ops.quote_name
+        columns = ['rating_count', 'rating_sum', 'rating_1', 'rating_2', 'rating_3', 'rating_4', 'rating_5',
+                   'rating_average']
+        sql = (
+            f"UPDATE {quote(Product._meta.db_table)} SET {', '.join(f'{quote(c)} = %s' for c in columns)} "
+            f"WHERE {quote('id')} = %s"
+        )
+        batch_size = self.options['batch_size']
+        for start in range(0, len(rows), batch_size):
+            with transaction.atomic(using=self.using), self.connection.cursor() as cursor:
+                cursor.executemany(sql, rows[start:start + batch_size])
+
+    def write_coupon_usage(self):
+        # max_usage counts the redemptions left, as coupons.redeem() leaves it.
+        for coupon in self.coupons:
+            if coupon['remaining'] is not None:
+                Coupon.objects.using(self.using).filter(pk=coupon['id']).update(max_usage=coupon['remaining'])
@@ -0,0 +1,52 @@
+import os
+import sqlite3
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+
+
+class Command(BaseCommand):
+    help = (
+        'Copies the primary SQLite database over the files of the DATABASE_REPLICAS aliases, as a local stand-in '
+        'for streaming replication. Each copy is a consistent snapshot written next to the replica and renamed '
+        'into place, so readers never see a half-written file.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=0,
+                            help='Keep taking snapshots this many seconds apart; 0 takes one and exits.')
+
+    def handle(self, *args, **options):
+        primary = settings.DATABASES[DEFAULT_DB_ALIAS]
+        if connections[DEFAULT_DB_ALIAS].vendor != 'sqlite':
+            raise CommandError('snapshot_replica only copies SQLite databases.')
+        targets = [str(settings.DATABASES[alias]['NAME']) for alias in settings.DATABASE_REPLICAS]
+        if not targets:
+            raise CommandError('No replicas configured; set DATABASE_REPLICAS to the replica file paths.')
+
+        while True:
+            started = time.monotonic()
+            for target in targets:
+                self.snapshot(str(primary['NAME']), target)
+            self.stdout.write(f'Snapshot written to {len(targets)} replica(s) in {time.monotonic() - started:.2f}s.')
+            if not options['interval']:
+                return
+            time.sleep(max(0, options['interval'] - (time.monotonic() - started)))
+
+    def snapshot(self, source_path, target_path):
+        partial_path = f'{target_path}.partial'
+        source = sqlite3.connect(source_path)
+        target = sqlite3.connect(partial_path)
+        try:
+            # The backup API copies a consistent state even while the primary
+            # is being written to.
+            source.backup(target)
+            # A WAL-mode copy would pair with the old replica's -wal file after
+            # the rename.
+            target.execute('PRAGMA journal_mode = DELETE')
+        finally:
+            target.close()
+            source.close()
+        os.replace(partial_path, target_path)
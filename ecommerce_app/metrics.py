@@ -0,0 +1,253 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import ExitStack
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db import connections
+from django.http import HttpResponse, HttpResponseForbidden
+from django.utils.crypto import constant_time_compare
+
+DEFAULT_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def get_latency_buckets():
+    return tuple(getattr(settings, 'METRICS_LATENCY_BUCKETS', DEFAULT_LATENCY_BUCKETS))
+
+
+class EndpointStats:
+    __slots__ = ('buckets', 'count', 'latency', 'queries', 'query_time', 'response_bytes', 'serializer_time', 'statuses')
+
+    def __init__(self, bucket_count):
+        # One slot per bucket plus +Inf; made cumulative on export.
+        self.buckets = [0] * (bucket_count + 1)
+        self.count = 0
+        self.latency = 0.0
+        self.queries = 0
+        self.query_time = 0.0
+        self.response_bytes = 0
+        self.serializer_time = 0.0
+        self.statuses = {}
+
+
+class Registry:
+    """
+    Metrics recorded by one thread. Only the owning thread writes to it, so
+    recording takes no lock; a scrape reads every registry and merges them.
+    """
+    _all = []
+    _all_lock = threading.Lock()
+    _local = threading.local()
+
+    def __init__(self):
+        self.bounds = get_latency_buckets()
+        self.endpoints = {}
+
+    @classmethod
+    def for_thread(cls):
+        registry = getattr(cls._local, 'registry', None)
+        if registry is None:
+            registry = cls._local.registry = cls()
+            # Once per thread; threads that exit keep their counts.
+            with cls._all_lock:
+                cls._all.append(registry)
+        return registry
+
+    @classmethod
+    def registries(cls):
+        with cls._all_lock:
+            return list(cls._all)
+
+    def record(self, labels, status, latency, request_stats, response_bytes):
+        stats = self.endpoints.get(labels)
+        if stats is None:
+            stats = self.endpoints[labels] = EndpointStats(len(self.bounds))
+        stats.buckets[bisect_left(self.bounds, latency)] += 1
+        stats.count += 1
+        stats.latency += latency
+        stats.queries += request_stats.queries
+        stats.query_time += request_stats.query_time
+        stats.serializer_time += request_stats.serializer_time
+        stats.response_bytes += response_bytes
+        stats.statuses[status] = stats.statuses.get(status, 0) + 1
+
+
+class RequestStats:
+    __slots__ = ('queries', 'query_time', 'serializer_time', 'serializer_depth')
+
+    def __init__(self):
+        self.queries = 0
+        self.query_time = 0.0
+        self.serializer_time = 0.0
+        self.serializer_depth = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        # connection.execute_wrapper() hook.
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.query_time += time.perf_counter() - start
+
+
+current_request = ContextVar('metrics_current_request', default=None)
+
+
+class TimedSerializerMixin:
+    """
+    Adds the time a serializer spends in ``to_representation()`` to the
+    current request's serializer time. Nested serializers and the items of a
+    ``many=True`` list are only counted at the outermost call.
+    """
+
+    def to_representation(self, instance):
+        request_stats = current_request.get()
+        if request_stats is None or request_stats.serializer_depth:
+            return super().to_representation(instance)
+        request_stats.serializer_depth += 1
+        start = time.perf_counter()
+        try:
+            return super().to_representation(instance)
+        finally:
+            request_stats.serializer_time += time.perf_counter() - start
+            request_stats.serializer_depth -= 1
+
+
+def endpoint_labels(request):
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return ('unmatched', 'unmatched', request.method)
+    # Several routes share a URL name, so the route goes in as well.
+    return (match.url_name or match.view_name or 'unnamed', match.route, request.method)
+
+
+def wrap_connections(stack, request_stats):
+    for connection in connections.all():
+        stack.enter_context(connection.execute_wrapper(request_stats))
+
+
+class MetricsMiddleware:
+    """
+    Records latency, SQL query count and time, response size and serializer
+    time (of serializers using TimedSerializerMixin) per resolved route. Put
+    it first in MIDDLEWARE so the timings cover the whole stack.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        request_stats = RequestStats()
+        token = current_request.set(request_stats)
+        start = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                wrap_connections(stack, request_stats)
+                response = self.get_response(request)
+        finally:
+            current_request.reset(token)
+        return self.record(request, response, time.perf_counter() - start, request_stats)
+
+    async def __acall__(self, request):
+        request_stats = RequestStats()
+        token = current_request.set(request_stats)
+        start = time.perf_counter()
+        # Connections are per thread and the queries of an ASGI request run in
+        # its sync_to_async thread, so the wrappers go on that thread's.
+        stack = ExitStack()
+        try:
+            await sync_to_async(wrap_connections)(stack, request_stats)
+            response = await self.get_response(request)
+        finally:
+            await sync_to_async(stack.close)()
+            current_request.reset(token)
+        return self.record(request, response, time.perf_counter() - start, request_stats)
+
+    def record(self, request, response, latency, request_stats):
+        response_bytes = 0 if response.streaming else len(response.content)
+        Registry.for_thread().record(
+            endpoint_labels(request), response.status_code, latency, request_stats, response_bytes,
+        )
+        return response
+
+
+def merged_endpoints():
+    merged = {}
+    for registry in Registry.registries():
+        for labels, stats in list(registry.endpoints.items()):
+            total = merged.get(labels)
+            if total is None:
+                total = merged[labels] = EndpointStats(len(registry.bounds))
+            for index, count in enumerate(stats.buckets):
+                total.buckets[index] += count
+            total.count += stats.count
+            total.latency += stats.latency
+            total.queries += stats.queries
+            total.query_time += stats.query_time
+            total.response_bytes += stats.response_bytes
+            total.serializer_time += stats.serializer_time
+            for status, count in list(stats.statuses.items()):
+                total.statuses[status] = total.statuses.get(status, 0) + count
+    return merged
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render():
+    bounds = get_latency_buckets()
+    endpoints = sorted(merged_endpoints().items())
+    lines = []
+
+    def family(name, metric_type, help_text):
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {metric_type}')
+
+    def label_text(labels, **extra):
+        view, route, method = labels
+        pairs = [('view', view), ('route', route), ('method', method), *extra.items()]
+        return ','.join(f'{key}="{escape(value)}"' for key, value in pairs)
+
+    family('http_request_duration_seconds', 'histogram', 'Request latency, including middleware.')
+    for labels, stats in endpoints:
+        cumulative = 0
+        for bound, count in zip(bounds + ('+Inf',), stats.buckets):
+            cumulative += count
+            lines.append(f'http_request_duration_seconds_bucket{{{label_text(labels, le=bound)}}} {cumulative}')
+        lines.append(f'http_request_duration_seconds_sum{{{label_text(labels)}}} {stats.latency}')
+        lines.append(f'http_request_duration_seconds_count{{{label_text(labels)}}} {stats.count}')
+
+    family('http_responses_total', 'counter', 'Responses by status code.')
+    for labels, stats in endpoints:
+        for status, count in sorted(stats.statuses.items()):
+            lines.append(f'http_responses_total{{{label_text(labels, status=status)}}} {count}')
+
+    for name, attribute, help_text in (
+        ('http_request_db_queries_total', 'queries', 'SQL queries run while handling requests.'),
+        ('http_request_db_seconds_total', 'query_time', 'Time spent in SQL queries.'),
+        ('http_response_size_bytes_total', 'response_bytes', 'Response body bytes, streaming responses excluded.'),
+        ('http_request_serializer_seconds_total', 'serializer_time', 'Time spent building serializer data.'),
+    ):
+        family(name, 'counter', help_text)
+        for labels, stats in endpoints:
+            lines.append(f'{name}{{{label_text(labels)}}} {getattr(stats, attribute)}')
+
+    return '\n'.join(lines) + '\n'
+
+
+def metrics_view(request):
+    # Without a configured token the endpoint stays closed.
+    token = getattr(settings, 'METRICS_TOKEN', None)
+    if not token or not constant_time_compare(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return HttpResponseForbidden()
+    return HttpResponse(render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,24 @@
+from django.db import migrations
+
+from ecommerce_app import search
+
+
+def create_search_index(apps, schema_editor):
+    if search.is_supported(schema_editor.connection):
+        search.install(schema_editor.connection)
+
+
+def drop_search_index(apps, schema_editor):
+    if search.is_supported(schema_editor.connection):
+        search.uninstall(schema_editor.connection)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ecommerce_app', '0010_order_coupon_applied'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index, hints={'model_name': 'product'}),
+    ]
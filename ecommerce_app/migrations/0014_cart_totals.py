@@ -0,0 +1,38 @@
+# Generated by Django 4.2.3 on 2026-10-18 14:09
+
+from django.db import migrations, models
+from django.db.models import F, Sum
+
+
+def calculate_cart_totals(apps, schema_editor):
+    Cart = apps.get_model('ecommerce_app', 'Cart')
+    db_alias = schema_editor.connection.alias
+    for cart in Cart.objects.using(db_alias).all():
+        totals = cart.items.aggregate(
+            subtotal=Sum(F('product__price') * F('quantity')),
+            item_count=Sum('quantity'),
+        )
+        cart.subtotal = totals['subtotal'] or 0
+        cart.item_count = totals['item_count'] or 0
+        cart.save(update_fields=['subtotal', 'item_count'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ecommerce_app', '0013_broadcastjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cart',
+            name='item_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='cart',
+            name='subtotal',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=12),
+        ),
+        migrations.RunPython(calculate_cart_totals, migrations.RunPython.noop, hints={'model_name': 'cart'}),
+    ]
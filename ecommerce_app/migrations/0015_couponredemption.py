@@ -0,0 +1,46 @@
+# Generated by Django 4.2.3 on 2026-10-18 14:11
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def backfill_redemptions(apps, schema_editor):
+    Coupon = apps.get_model('ecommerce_app', 'Coupon')
+    CouponRedemption = apps.get_model('ecommerce_app', 'CouponRedemption')
+    Order = apps.get_model('ecommerce_app', 'Order')
+    db_alias = schema_editor.connection.alias
+    coupon_ids = dict(Coupon.objects.using(db_alias).values_list('coupon_code', 'id'))
+    redemptions = {}
+    orders = Order.objects.using(db_alias).filter(coupon_code__in=coupon_ids, coupon_applied=True).order_by('id')
+    for order in orders.iterator():
+        redemptions.setdefault(
+            (coupon_ids[order.coupon_code], order.user_id),
+            CouponRedemption(coupon_id=coupon_ids[order.coupon_code], user_id=order.user_id, order_id=order.id),
+        )
+    CouponRedemption.objects.using(db_alias).bulk_create(redemptions.values(), batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ecommerce_app', '0014_cart_totals'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CouponRedemption',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('coupon', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='redemptions', to='ecommerce_app.coupon')),
+                ('order', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='ecommerce_app.order')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='couponredemption',
+            constraint=models.UniqueConstraint(fields=('coupon', 'user'), name='unique_coupon_redemption_per_user'),
+        ),
+        migrations.RunPython(backfill_redemptions, migrations.RunPython.noop, hints={'model_name': 'couponredemption'}),
+    ]
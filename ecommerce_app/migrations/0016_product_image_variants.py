@@ -0,0 +1,24 @@
+# Generated by Django 4.2.3 on 2026-10-18 14:12
+
+from django.db import migrations, models
+import ecommerce_app.storage
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ecommerce_app', '0015_couponredemption'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='image_variants',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+        migrations.AlterField(
+            model_name='product',
+            name='image',
+            field=models.ImageField(blank=True, null=True, storage=ecommerce_app.storage.get_product_image_storage, upload_to='product_images/'),
+        ),
+    ]
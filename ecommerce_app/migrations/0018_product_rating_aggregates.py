@@ -0,0 +1,75 @@
+# Generated by Django 4.2.3 on 2026-10-18 14:20
+
+from django.db import migrations, models
+from django.db.models import Count, Q, Sum
+
+
+def backfill_ratings(apps, schema_editor):
+    Product = apps.get_model('ecommerce_app', 'Product')
+    ProductReview = apps.get_model('ecommerce_app', 'ProductReview')
+    db_alias = schema_editor.connection.alias
+    aggregates = ProductReview.objects.using(db_alias).values('product').annotate(
+        count=Count('id'),
+        total=Sum('rating'),
+        **{f'stars_{stars}': Count('id', filter=Q(rating=stars)) for stars in range(1, 6)},
+    )
+    products = []
+    for row in aggregates:
+        product = Product(pk=row['product'], rating_count=row['count'], rating_sum=row['total'])
+        for stars in range(1, 6):
+            setattr(product, f'rating_{stars}', row[f'stars_{stars}'])
+        product.rating_average = row['total'] / row['count']
+        products.append(product)
+    fields = ['rating_count', 'rating_sum', 'rating_average'] + [f'rating_{stars}' for stars in range(1, 6)]
+    Product.objects.using(db_alias).bulk_update(products, fields, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ecommerce_app', '0017_stock_reservations'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='rating_1',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_2',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_3',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_4',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_5',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_average',
+            field=models.FloatField(db_index=True, default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_sum',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(backfill_ratings, migrations.RunPython.noop, hints={'model_name': 'product'}),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.2.3 on 2026-10-18 14:22
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ecommerce_app', '0018_product_rating_aggregates'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VerifiedPurchase',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='ecommerce_app.product')),
+                ('review', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='verified_purchase', to='ecommerce_app.productreview')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='verifiedpurchase',
+            constraint=models.UniqueConstraint(fields=('user', 'product'), name='unique_verified_purchase'),
+        ),
+    ]
@@ -0,0 +1,60 @@
+# Generated by Django 4.2.3 on 2026-10-18 15:10
+
+from django.db import migrations, models
+from django.db.models import Count, Min, Sum
+
+
+def merge_duplicate_cart_items(apps, schema_editor):
+    # Racing add-to-cart requests could create several rows for one product;
+    # fold them into the oldest so the unique constraint can be added. The
+    # cart's running totals already count every row, so they stay right.
+    CartItem = apps.get_model('ecommerce_app', 'CartItem')
+    db_alias = schema_editor.connection.alias
+    duplicates = (
+        CartItem.objects.using(db_alias).values('cart', 'product')
+        .annotate(rows=Count('id'), keep=Min('id'), quantity=Sum('quantity'))
+        .filter(rows__gt=1)
+    )
+    for row in duplicates:
+        items = CartItem.objects.using(db_alias).filter(cart=row['cart'], product=row['product'])
+        items.filter(pk=row['keep']).update(quantity=row['quantity'])
+        items.exclude(pk=row['keep']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ecommerce_app', '0020_catalog_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='coupon',
+            index=models.Index(fields=['end_date', 'start_date'], name='ecommerce_a_end_dat_6e320a_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['user', 'created_at'], name='ecommerce_a_user_id_c49e16_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['created_at'], name='ecommerce_a_created_385284_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['coupon_code', 'coupon_applied'], name='ecommerce_a_coupon__bb9005_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['category', 'price'], name='ecommerce_a_categor_2f3d73_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='productreview',
+            index=models.Index(fields=['product', 'created_at'], name='ecommerce_a_product_864a85_idx'),
+        ),
+        migrations.RunPython(merge_duplicate_cart_items, migrations.RunPython.noop, hints={'model_name': 'cartitem'}),
+        migrations.AddConstraint(
+            model_name='cartitem',
+            constraint=models.UniqueConstraint(fields=('cart', 'product'), name='unique_cart_item_per_product'),
+        ),
+    ]
@@ -1,5 +1,11 @@
 from django.db import models
+from django.db.models import Case, F, OuterRef, Subquery, Sum, Value, When
+from django.db.models.functions import Cast
+from django.utils import timezone
 from django.contrib.auth.models import AbstractBaseUser, BaseUserManager, PermissionsMixin
+
+from . import sharding
+from .storage import get_product_image_storage
 # Create your models here.
 class CustomUserManager(BaseUserManager):
     def create_user(self, email, password=None, **extra_fields):
@@ -35,6 +41,7 @@ class CustomUser(AbstractBaseUser, PermissionsMixin):
     
 class Category(models.Model):
     name = models.CharField(max_length=255)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
 
     def __str__(self):
         return self.name
@@ -44,13 +51,64 @@ class Product(models.Model):
     description = models.TextField()
     price = models.DecimalField(max_digits=10, decimal_places=2)
     quantity = models.PositiveIntegerField()
-    image = models.ImageField(upload_to='product_images/', blank=True, null=True)
+    image = models.ImageField(upload_to='product_images/', storage=get_product_image_storage, blank=True, null=True)
+    # {size: {format: path}}, filled in by the build_image_variants command
+    image_variants = models.JSONField(default=dict, blank=True)
     category = models.ForeignKey(Category, on_delete=models.CASCADE, related_name='products')
+    # Units held by carts (see StockReservation); only ever changed with F()
+    # updates, so quantity - reserved is what can still be added to a cart.
+    reserved = models.PositiveIntegerField(default=0, editable=False)
+    # Running review aggregates, maintained by the ProductReview signals.
+    rating_count = models.PositiveIntegerField(default=0, editable=False)
+    rating_sum = models.PositiveIntegerField(default=0, editable=False)
+    rating_1 = models.PositiveIntegerField(default=0, editable=False)
+    rating_2 = models.PositiveIntegerField(default=0, editable=False)
+    rating_3 = models.PositiveIntegerField(default=0, editable=False)
+    rating_4 = models.PositiveIntegerField(default=0, editable=False)
+    rating_5 = models.PositiveIntegerField(default=0, editable=False)
+    rating_average = models.FloatField(default=0, editable=False, db_index=True)
+    # Drives the catalog's ETag/Last-Modified; update() calls that change what
+    # ProductSerializer shows must set it themselves.
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    class Meta:
+        indexes = [
+            # Category listings narrowed by a price range.
+            models.Index(fields=['category', 'price']),
+        ]
+
+    # Only ever changed with F() updates.
+    COUNTER_FIELDS = (
+        'reserved', 'rating_count', 'rating_sum', 'rating_1', 'rating_2', 'rating_3', 'rating_4', 'rating_5',
+        'rating_average',
+    )
+
     def save(self, *args, **kwargs):
            if not self.pk:
                # New product, set the original price
                self.original_price = self.price
+           elif not self._state.adding and kwargs.get('update_fields') is None:
+               # Writing back a stale copy of the counters would undo concurrent updates.
+               kwargs['update_fields'] = [
+                   field.name for field in self._meta.concrete_fields
+                   if not field.primary_key and field.name not in self.COUNTER_FIELDS
+               ]
            super().save(*args, **kwargs)
+
+    @classmethod
+    def add_rating(cls, product_id, rating, sign=1):
+        # Adds (sign=1) or removes (sign=-1) one review's rating in one UPDATE.
+        # SET expressions see the old row, hence the old count and sum below.
+        count = F('rating_count') + sign
+        average = (Cast(F('rating_sum'), models.FloatField()) + sign * rating) / count
+        cls.objects.filter(pk=product_id).update(
+            rating_count=count,
+            rating_sum=F('rating_sum') + sign * rating,
+            **{f'rating_{rating}': F(f'rating_{rating}') + sign},
+            # Only matches when the last review is removed, which would divide by zero.
+            rating_average=Case(When(rating_count=-sign, then=Value(0.0)), default=average),
+            updated_at=timezone.now(),
+        )
     def __str__(self):
         return self.name
     
@@ -59,25 +117,98 @@ from django.contrib.auth import get_user_model
 User = get_user_model()
 
 class Cart(models.Model):
-    user = models.OneToOneField(User, on_delete=models.CASCADE)
+    # Carts, orders and wishlists may live on another shard than the users and
+    # products they point at (see sharding.py), so those relations have no
+    # database constraint.
+    user = models.OneToOneField(User, on_delete=models.CASCADE, db_constraint=False)
     created_at = models.DateTimeField(auto_now_add=True)
+    # Running totals of the items at current prices, kept up to date on every
+    # cart change and price change so nobody has to load the items to get them.
+    subtotal = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    item_count = models.PositiveIntegerField(default=0)
 
     def __str__(self):
         return f"Cart for {self.user.username}"
+
+    def add_to_totals(self, amount, quantity):
+        Cart.objects.using(self._state.db).filter(pk=self.pk).update(
+            subtotal=F('subtotal') + amount,
+            item_count=F('item_count') + quantity,
+        )
+
+    def recalculate_totals(self):
+        # The prices come from the default database, which the cart's shard
+        # can't join against.
+        quantities = dict(self.items.values_list('product_id').annotate(total=Sum('quantity')))
+        prices = Product.objects.filter(pk__in=quantities).values_list('pk', 'price')
+        Cart.objects.using(self._state.db).filter(pk=self.pk).update(
+            subtotal=sum(price * quantities[pk] for pk, price in prices),
+            item_count=sum(quantities.values()),
+        )
+
+    @classmethod
+    def reprice_product(cls, product_id, price_delta, quantity_sign=0):
+        # Shifts every cart holding the product by price_delta per unit, in one
+        # UPDATE. quantity_sign=-1 also takes the units out of item_count (used
+        # when the product goes away).
+        quantity = Subquery(
+            CartItem.objects.filter(cart=OuterRef('pk'), product_id=product_id)
+            .values('cart').annotate(total=Sum('quantity')).values('total')
+        )
+        for alias in sharding.get_shards():
+            cls.objects.using(alias).filter(items__product_id=product_id).update(
+                subtotal=F('subtotal') + price_delta * quantity,
+                item_count=F('item_count') + quantity_sign * quantity,
+            )
 class CartItem(models.Model):
     cart = models.ForeignKey(Cart, related_name='items', on_delete=models.CASCADE)
-    product = models.ForeignKey(Product, on_delete=models.CASCADE)
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, db_constraint=False)
     quantity = models.PositiveIntegerField(default=1)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['cart', 'product'], name='unique_cart_item_per_product'),
+        ]
+
     def __str__(self):
         return f"{self.product.name} x {self.quantity}"
+class StockReservation(models.Model):
+    # Released by the Cart pre_delete signal, since the cart may be on a shard.
+    cart = models.ForeignKey(Cart, related_name='reservations', on_delete=models.DO_NOTHING, db_constraint=False)
+    product = models.ForeignKey(Product, related_name='reservations', on_delete=models.CASCADE)
+    quantity = models.PositiveIntegerField()
+    expires_at = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['cart', 'product'], name='unique_stock_reservation_per_cart'),
+        ]
+        indexes = [
+            models.Index(fields=['expires_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.product} x {self.quantity} for {self.cart}"
 User = get_user_model()
+class OrderQuerySet(models.QuerySet):
+    def with_details(self):
+        # Loads users, items and their products in a fixed number of queries
+        # for OrderSerializer, however many orders or items there are. Users
+        # and products are prefetched rather than joined, since they live on
+        # the default database and the orders may be on another shard.
+        return self.prefetch_related(
+            'user',
+            models.Prefetch('order_items', queryset=OrderItem.objects.order_by('id')),
+            'order_items__product',
+        )
+
 class Order(models.Model):
     ORDER_STATUS_CHOICES = [
         ('Processing', 'Processing'),
         ('Shipped', 'Shipped'),
         ('Delivered', 'Delivered'),
     ]
-    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, db_constraint=False)
     items = models.ManyToManyField(Product, through='OrderItem')
     total_amount = models.DecimalField(max_digits=10, decimal_places=2)
     total_amount_without_coupon = models.DecimalField(max_digits=10, decimal_places=2,default=0.00)
@@ -89,11 +220,21 @@ class Order(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     coupon_applied = models.BooleanField(default=False)  # Track whether a coupon has been applied
 
+    objects = OrderQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # Order history, newest first, and the admin list / export date ranges.
+            models.Index(fields=['user', 'created_at']),
+            models.Index(fields=['created_at']),
+            models.Index(fields=['coupon_code', 'coupon_applied']),
+        ]
+
     def __str__(self):
         return f"Order for {self.user.username}"
 class OrderItem(models.Model):
     order = models.ForeignKey(Order,related_name='order_items',  on_delete=models.CASCADE)
-    product = models.ForeignKey(Product, on_delete=models.CASCADE)
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, db_constraint=False)
     quantity = models.PositiveIntegerField()
     price_at_order = models.DecimalField(max_digits=10, decimal_places=2)
 
@@ -101,8 +242,18 @@ class OrderItem(models.Model):
         return f"{self.product.name} x {self.quantity}"
 
 class Wishlist(models.Model):
-    user = models.OneToOneField(User, on_delete=models.CASCADE)
-    products = models.ManyToManyField(Product)
+    user = models.OneToOneField(User, on_delete=models.CASCADE, db_constraint=False)
+    products = models.ManyToManyField(Product, db_constraint=False)
+
+    def product_ids(self):
+        # Read from the through table alone: products.all() would join it to
+        # the product table, which is on the default database.
+        through = Wishlist.products.through
+        return list(
+            through.objects.using(self._state.db).filter(wishlist=self)
+            .order_by('product_id').values_list('product_id', flat=True)
+        )
+
 class ProductReview(models.Model):
     user = models.ForeignKey(CustomUser, on_delete=models.CASCADE)
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
@@ -110,6 +261,30 @@ class ProductReview(models.Model):
     review_text = models.TextField()
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['product', 'created_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.user} - {self.product}"
+
+
+class VerifiedPurchase(models.Model):
+    # One row per (user, product) ever ordered; review is set once the user has
+    # reviewed the product, which is what stops duplicate reviews.
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE)
+    product = models.ForeignKey(Product, on_delete=models.CASCADE)
+    review = models.OneToOneField(
+        ProductReview, null=True, blank=True, on_delete=models.SET_NULL, related_name='verified_purchase',
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'product'], name='unique_verified_purchase'),
+        ]
+
     def __str__(self):
         return f"{self.user} - {self.product}"
 
@@ -127,5 +302,89 @@ class Coupon(models.Model):
     end_date = models.DateField()
     max_usage = models.PositiveIntegerField(null=True, blank=True)
 
+    class Meta:
+        indexes = [
+            # end_date first: the coupon index loads everything not yet expired.
+            models.Index(fields=['end_date', 'start_date']),
+        ]
+
+    def __str__(self):
+        return self.coupon_code
+
+class OutboxEmail(models.Model):
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('sending', 'Sending'),
+        ('sent', 'Sent'),
+        ('failed', 'Failed'),
+    ]
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    html_body = models.TextField(blank=True)
+    from_email = models.CharField(max_length=255)
+    recipients = models.JSONField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    claim_token = models.UUIDField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'next_attempt_at'])]
+
+    def __str__(self):
+        return f"{self.subject} ({self.status})"
+
+
+class BroadcastJob(models.Model):
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+    ]
+    subject = models.CharField(max_length=255)
+    html_message = models.TextField()
+    from_email = models.CharField(max_length=255)
+    created_by = models.ForeignKey(User, null=True, on_delete=models.SET_NULL, related_name='+')
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
+    total_recipients = models.PositiveIntegerField(default=0)
+    sent_count = models.PositiveIntegerField(default=0)
+    failed_count = models.PositiveIntegerField(default=0)
+    last_user_id = models.BigIntegerField(default=0)  # Recipients are sent in id order, so this is where to resume
+    claim_token = models.UUIDField(null=True, blank=True)
+    lease_expires_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.subject} ({self.status})"
+
+
+class BroadcastAttachment(models.Model):
+    job = models.ForeignKey(BroadcastJob, related_name='attachments', on_delete=models.CASCADE)
+    file = models.FileField(upload_to='broadcast_attachments/')
+    name = models.CharField(max_length=255)
+    content_type = models.CharField(max_length=255, blank=True)
+
+    def __str__(self):
+        return self.name
+
+
+class CouponRedemption(models.Model):
+    coupon = models.ForeignKey(Coupon, related_name='redemptions', on_delete=models.CASCADE)
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    # Cleared by the Order pre_delete signal, since the order may be on a shard.
+    order = models.ForeignKey(Order, null=True, blank=True, on_delete=models.DO_NOTHING, db_constraint=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            # Once per user; max_usage caps the total (see coupons.redeem).
+            models.UniqueConstraint(fields=['coupon', 'user'], name='unique_coupon_redemption_per_user'),
+        ]
+
     def __str__(self):
-        return self.coupon_code
\ No newline at end of file
+        return f"{self.coupon} - {self.user}"
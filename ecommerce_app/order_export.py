@@ -0,0 +1,75 @@
+from datetime import datetime, time, timedelta
+from itertools import islice
+
+from django.utils import timezone
+
+from . import sharding
+from .models import CustomUser, OrderItem, Product
+
+FIELDS = [
+    'order_id', 'created_at', 'customer_email', 'order_status', 'coupon_code',
+    'total_amount_without_coupon', 'discounted_amount', 'total_amount', 'payment_method',
+    'product_id', 'product_name', 'quantity', 'price_at_order', 'line_total',
+]
+
+# Read from the shards; customer emails and product names are on the default
+# database and get looked up separately.
+COLUMNS = [
+    'order_id', 'order__created_at', 'order__user_id', 'order__order_status', 'order__coupon_code',
+    'order__total_amount_without_coupon', 'order__discounted_amount', 'order__total_amount',
+    'order__payment_method', 'product_id', 'quantity', 'price_at_order',
+]
+
+
+def start_of(day):
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+
+def filter_items(date_from=None, date_to=None, status=None, coupon=None):
+    """
+    Order items of the orders matching the filters. Both dates are inclusive
+    and compared as a range on created_at so its index can be used.
+    """
+    items = OrderItem.objects.all()
+    if date_from:
+        items = items.filter(order__created_at__gte=start_of(date_from))
+    if date_to:
+        items = items.filter(order__created_at__lt=start_of(date_to + timedelta(days=1)))
+    if status:
+        items = items.filter(order__order_status=status)
+    if coupon:
+        items = items.filter(order__coupon_code=coupon)
+    return items
+
+
+def export_rows(items, chunk_size=2000):
+    """
+    Yields one dict per order item, keyed by FIELDS, with the order columns
+    repeated on each line. Each shard's rows are fetched in chunks, plus two
+    lookups per chunk for the emails and product names, so memory stays flat
+    however many orders match. Order ids grow with the shard, so the rows
+    still come out by order id.
+    """
+    for alias in sharding.get_shards():
+        rows = items.using(alias).order_by('order_id', 'id').values_list(*COLUMNS).iterator(chunk_size=chunk_size)
+        while chunk := list(islice(rows, chunk_size)):
+            emails = dict(CustomUser.objects.filter(pk__in={row[2] for row in chunk}).values_list('pk', 'email'))
+            names = dict(Product.objects.filter(pk__in={row[9] for row in chunk}).values_list('pk', 'name'))
+            for (order_id, created_at, user_id, order_status, coupon_code, total_amount_without_coupon,
+                 discounted_amount, total_amount, payment_method, product_id, quantity, price_at_order) in chunk:
+                yield {
+                    'order_id': order_id,
+                    'created_at': created_at,
+                    'customer_email': emails.get(user_id),
+                    'order_status': order_status,
+                    'coupon_code': coupon_code,
+                    'total_amount_without_coupon': total_amount_without_coupon,
+                    'discounted_amount': discounted_amount,
+                    'total_amount': total_amount,
+                    'payment_method': payment_method,
+                    'product_id': product_id,
+                    'product_name': names.get(product_id),
+                    'quantity': quantity,
+                    'price_at_order': price_at_order,
+                    'line_total': price_at_order * quantity,
+                }
@@ -0,0 +1,232 @@
+import asyncio
+import uuid
+from datetime import timedelta
+
+import aiosmtplib
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.db.models import Subquery
+from django.utils import timezone
+
+from .models import OutboxEmail
+
+SMTP_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
+
+
+def get_setting(name, default):
+    return getattr(settings, name, default)
+
+
+def enqueue_mail(subject, message, from_email, recipient_list, html_message=None):
+    """
+    Same arguments as ``django.core.mail.send_mail``, but only writes the
+    message to the outbox. Called inside a transaction, the mail is sent if and
+    only if the transaction commits. ``mail_worker`` does the actual sending.
+    """
+    return OutboxEmail.objects.create(
+        subject=subject,
+        body=message,
+        html_body=html_message or '',
+        from_email=from_email,
+        recipients=list(recipient_list),
+    )
+
+
+def claim_batch(batch_size):
+    """
+    Leases up to ``batch_size`` due messages to this worker. Messages held by a
+    worker that died become due again once the lease runs out.
+    """
+    due, lease, claimed = claim_queries(batch_size)
+    due.update(**lease)
+    return list(claimed)
+
+
+async def aclaim_batch(batch_size):
+    due, lease, claimed = claim_queries(batch_size)
+    await due.aupdate(**lease)
+    return [outbox_email async for outbox_email in claimed]
+
+
+def claim_queries(batch_size):
+    now = timezone.now()
+    token = uuid.uuid4()
+    due = OutboxEmail.objects.filter(
+        status__in=['pending', 'sending'], next_attempt_at__lte=now,
+    ).order_by('next_attempt_at', 'id').values('id')[:batch_size]
+    lease = {
+        'status': 'sending',
+        'claim_token': token,
+        'next_attempt_at': now + timedelta(seconds=get_setting('EMAIL_OUTBOX_LEASE', 300)),
+    }
+    claimed = OutboxEmail.objects.filter(claim_token=token, status='sending').order_by('id')
+    return OutboxEmail.objects.filter(id__in=Subquery(due)), lease, claimed
+
+
+def build_message(outbox_email, connection):
+    message = EmailMultiAlternatives(
+        subject=outbox_email.subject,
+        body=outbox_email.body,
+        from_email=outbox_email.from_email,
+        to=outbox_email.recipients,
+        connection=connection,
+    )
+    if outbox_email.html_body:
+        message.attach_alternative(outbox_email.html_body, 'text/html')
+    return message
+
+
+def retry_delay(attempts):
+    base = get_setting('EMAIL_OUTBOX_RETRY_BACKOFF', 30)
+    return timedelta(seconds=min(base * 2 ** (attempts - 1), get_setting('EMAIL_OUTBOX_MAX_BACKOFF', 3600)))
+
+
+FAILURE_FIELDS = ['attempts', 'last_error', 'status', 'next_attempt_at']
+
+
+def record_failure(outbox_email, error):
+    # Saved by the caller, with update_fields=FAILURE_FIELDS.
+    outbox_email.attempts += 1
+    outbox_email.last_error = repr(error)
+    if outbox_email.attempts >= get_setting('EMAIL_OUTBOX_MAX_ATTEMPTS', 5):
+        outbox_email.status = 'failed'
+    else:
+        outbox_email.status = 'pending'
+        outbox_email.next_attempt_at = timezone.now() + retry_delay(outbox_email.attempts)
+
+
+def drain(batch_size=50, connection=None):
+    """
+    Sends one batch of due messages over a single SMTP connection and returns
+    how many were claimed. Failed messages are retried with exponential
+    backoff until EMAIL_OUTBOX_MAX_ATTEMPTS is reached.
+    """
+    batch = claim_batch(batch_size)
+    if not batch:
+        return 0
+
+    own_connection = connection is None
+    connection = connection or get_connection()
+    sent = []
+    for outbox_email in batch:
+        try:
+            # No-op while the connection is up; reconnects after a failure.
+            connection.open()
+            connection.send_messages([build_message(outbox_email, connection)])
+        except Exception as e:
+            # Drop the connection so the next send reconnects from scratch.
+            connection.close()
+            record_failure(outbox_email, e)
+            outbox_email.save(update_fields=FAILURE_FIELDS)
+        else:
+            sent.append(outbox_email.pk)
+
+    if own_connection:
+        connection.close()
+
+    OutboxEmail.objects.filter(pk__in=sent).update(status='sent', sent_at=timezone.now())
+    return len(batch)
+
+
+class AsyncSMTPConnection:
+    """
+    Sends over one aiosmtplib session, configured from the same EMAIL_*
+    settings as Django's SMTP backend. Connects on the first send and again
+    after close().
+    """
+
+    def __init__(self):
+        self.client = None
+
+    async def open(self):
+        if self.client is not None:
+            return
+        client = aiosmtplib.SMTP(
+            hostname=settings.EMAIL_HOST,
+            port=int(settings.EMAIL_PORT),
+            use_tls=settings.EMAIL_USE_SSL,
+            start_tls=settings.EMAIL_USE_TLS,
+            timeout=settings.EMAIL_TIMEOUT,
+        )
+        await client.connect()
+        if settings.EMAIL_HOST_USER:
+            try:
+                await client.login(settings.EMAIL_HOST_USER, settings.EMAIL_HOST_PASSWORD)
+            except aiosmtplib.SMTPException:
+                client.close()
+                raise
+        self.client = client
+
+    async def send(self, message):
+        await self.open()
+        await self.client.send_message(message.message(), sender=message.from_email, recipients=message.recipients())
+
+    async def close(self):
+        client, self.client = self.client, None
+        if client is not None:
+            try:
+                await client.quit()
+            except aiosmtplib.SMTPException:
+                client.close()
+
+
+class ThreadedConnection:
+    """
+    The same interface over a Django mail backend, which blocks, so each call
+    runs in a worker thread of its own. Used for the non-SMTP backends
+    (console, locmem in tests, ...).
+    """
+
+    def __init__(self):
+        self.connection = get_connection()
+
+    async def send(self, message):
+        await sync_to_async(self._send, thread_sensitive=False)(message)
+
+    def _send(self, message):
+        # No-op while the connection is up; reconnects after a failure.
+        self.connection.open()
+        self.connection.send_messages([message])
+
+    async def close(self):
+        await sync_to_async(self.connection.close, thread_sensitive=False)()
+
+
+def get_async_connection():
+    if settings.EMAIL_BACKEND == SMTP_BACKEND:
+        return AsyncSMTPConnection()
+    return ThreadedConnection()
+
+
+async def adrain(batch_size=50, connections=4):
+    """
+    drain() for asyncio: sends one claimed batch over up to ``connections``
+    SMTP sessions at once, so a slow server is waited on in parallel. Returns
+    how many messages were claimed.
+    """
+    batch = await aclaim_batch(batch_size)
+    if not batch:
+        return 0
+
+    pending = iter(batch)
+    sent = []
+
+    async def send_pending(connection):
+        try:
+            # Every session pulls from the same iterator until it runs dry.
+            for outbox_email in pending:
+                try:
+                    await connection.send(build_message(outbox_email, None))
+                except Exception as e:
+                    await connection.close()
+                    record_failure(outbox_email, e)
+                    await outbox_email.asave(update_fields=FAILURE_FIELDS)
+                else:
+                    sent.append(outbox_email.pk)
+        finally:
+            await connection.close()
+
+    await asyncio.gather(*(send_pending(get_async_connection()) for _ in range(min(connections, len(batch)))))
+    await OutboxEmail.objects.filter(pk__in=sent).aupdate(status='sent', sent_at=timezone.now())
+    return len(batch)
@@ -0,0 +1,151 @@
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, PositiveIntegerField, Value, When
+from django.utils import timezone
+
+from . import catalog_cache
+from .models import Product, StockReservation
+
+
+class InsufficientStock(Exception):
+    pass
+
+
+class ReservationChanged(Exception):
+    # Another request or the sweeper touched the reservation in between.
+    pass
+
+
+def get_ttl():
+    return timedelta(seconds=getattr(settings, 'CART_RESERVATION_TTL', 900))
+
+
+def per_product(quantities):
+    return Case(
+        *[When(pk=pk, then=Value(quantity)) for pk, quantity in quantities.items()],
+        default=Value(0),
+        output_field=PositiveIntegerField(),
+    )
+
+
+def invalidate_on_commit(products):
+    # The catalog's in_stock filter and facet compare quantity with reserved,
+    # so a hold that sells a product out, or a release that brings it back,
+    # changes the cached listings. Other holds leave them alone.
+    if products:
+        transaction.on_commit(lambda: catalog_cache.invalidate_products(products))
+
+
+def release_stock(quantities):
+    """
+    Gives ``quantities`` ({product_id: units}) back to the products in one
+    UPDATE.
+    """
+    if quantities:
+        restocked = list(
+            Product.objects.filter(pk__in=quantities, quantity__lte=F('reserved')).values_list('pk', 'category_id')
+        )
+        Product.objects.filter(pk__in=quantities).update(reserved=F('reserved') - per_product(quantities))
+        invalidate_on_commit(restocked)
+
+
+def _hold(cart, product_id, quantity):
+    reservation = StockReservation.objects.select_for_update().filter(cart=cart, product_id=product_id).first()
+    current = reservation.quantity if reservation else 0
+    delta = quantity - current
+
+    if delta > 0:
+        # The stock check and the hold are one conditional UPDATE on the
+        # product row, so two carts can never take the same last unit.
+        held = Product.objects.filter(pk=product_id, quantity__gte=F('reserved') + delta).update(
+            reserved=F('reserved') + delta,
+        )
+        if not held:
+            raise InsufficientStock('Requested quantity exceeds available quantity')
+        invalidate_on_commit(list(
+            Product.objects.filter(pk=product_id, quantity=F('reserved')).values_list('pk', 'category_id')
+        ))
+    elif delta < 0:
+        release_stock({product_id: -delta})
+
+    if reservation is None:
+        if quantity:
+            StockReservation.objects.create(
+                cart=cart, product_id=product_id, quantity=quantity, expires_at=timezone.now() + get_ttl(),
+            )
+        return
+    unchanged = StockReservation.objects.filter(pk=reservation.pk, quantity=current)
+    if quantity:
+        written = unchanged.update(quantity=quantity, expires_at=timezone.now() + get_ttl())
+    else:
+        written, _ = unchanged.delete()
+    if not written:
+        raise ReservationChanged
+
+
+def hold(cart, product_id, quantity, attempts=3):
+    """
+    Sets the units of the product held for ``cart`` to ``quantity`` and
+    restarts the hold's TTL. Raises InsufficientStock when the extra units
+    aren't available.
+    """
+    for attempt in range(attempts):
+        try:
+            with transaction.atomic():
+                return _hold(cart, product_id, quantity)
+        except ReservationChanged:
+            if attempt == attempts - 1:
+                raise
+
+
+def take_cart_holds(cart):
+    """
+    Deletes the cart's reservations for checkout and returns the units they
+    held per product; checkout turns those into sold stock. Must run in the
+    checkout transaction.
+    """
+    reservations = list(
+        StockReservation.objects.select_for_update().filter(cart=cart).values_list('id', 'product_id', 'quantity')
+    )
+    if not reservations:
+        return {}
+    deleted, _ = StockReservation.objects.filter(pk__in=[pk for pk, _, _ in reservations]).delete()
+    if deleted != len(reservations):
+        raise ReservationChanged
+    held = defaultdict(int)
+    for _, product_id, quantity in reservations:
+        held[product_id] += quantity
+    return held
+
+
+def release_cart(cart):
+    with transaction.atomic():
+        release_stock(take_cart_holds(cart))
+
+
+def release_expired(batch_size=500):
+    """
+    Releases up to ``batch_size`` expired reservations with one DELETE and one
+    UPDATE, and returns how many were released.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        expired = list(
+            StockReservation.objects.select_for_update(skip_locked=True)
+            .filter(expires_at__lt=now).order_by('expires_at')
+            .values_list('id', 'product_id', 'quantity')[:batch_size]
+        )
+        if not expired:
+            return 0
+        deleted, _ = StockReservation.objects.filter(pk__in=[pk for pk, _, _ in expired], expires_at__lt=now).delete()
+        if deleted != len(expired):
+            # Refreshed in between; roll back and let the next pass retry.
+            raise ReservationChanged
+        released = defaultdict(int)
+        for _, product_id, quantity in expired:
+            released[product_id] += quantity
+        release_stock(released)
+    return len(expired)
@@ -0,0 +1,144 @@
+import hashlib
+import random
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections
+
+
+class RequestRouting:
+    __slots__ = ('pinned', 'wrote')
+
+    def __init__(self, pinned):
+        self.pinned = pinned
+        self.wrote = False
+
+
+# Only set while a request is handled; management commands and workers have
+# no state and always use the primary.
+current_routing = ContextVar('current_routing', default=None)
+
+
+def get_replicas():
+    return getattr(settings, 'DATABASE_REPLICAS', [])
+
+
+def get_pin_seconds():
+    return getattr(settings, 'REPLICA_PIN_SECONDS', 10)
+
+
+def reading_from_replica():
+    routing = current_routing.get()
+    return routing is not None and not routing.pinned and bool(get_replicas())
+
+
+def read_alias():
+    """
+    Where the current request reads the default database's data from: a
+    random replica, or the primary once pinned, outside requests and inside
+    transactions.
+    """
+    if not reading_from_replica() or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+        return DEFAULT_DB_ALIAS
+    return random.choice(get_replicas())
+
+
+class PrimaryReplicaRouter:
+    """
+    Sends the reads of safe requests to a random alias in DATABASE_REPLICAS
+    and everything else to the primary. A request moves to the primary for
+    good on its first write, and reads stay there inside transactions and for
+    objects loaded from it.
+
+    Replicas copy the default database only. Sharded tables are read with an
+    explicit ``.using()`` and skip this router: from a replica when the user's
+    shard is the default database (``sharding.read_shard_for_user()``), from
+    their shard otherwise.
+    """
+
+    def db_for_read(self, model, **hints):
+        alias = read_alias()
+        if alias == DEFAULT_DB_ALIAS:
+            return alias
+        instance = hints.get('instance')
+        # Objects read from a shard don't say where the rest of their data is.
+        if instance is not None and instance._state.db in (DEFAULT_DB_ALIAS, *get_replicas()):
+            return instance._state.db
+        return alias
+
+    def db_for_write(self, model, **hints):
+        routing = current_routing.get()
+        if routing is not None:
+            routing.pinned = routing.wrote = True
+        # Explicit, since Django would otherwise write an object back to the
+        # replica it was read from.
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replicas are copies of the primary, schema included.
+        return db not in get_replicas()
+
+
+def client_pin_key(request):
+    authorization = request.headers.get('Authorization')
+    if not authorization:
+        return None
+    return 'db:pinned:' + hashlib.sha256(authorization.encode()).hexdigest()
+
+
+class PrimaryPinningMiddleware:
+    """
+    Starts unsafe requests on the primary, so everything a POST/PUT/PATCH/
+    DELETE reads is current. Clients that sent one, or wrote from a safe
+    request, stay on the primary for REPLICA_PIN_SECONDS, long enough for the
+    replicas to catch up with what they just did.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        pin_key, routing = self.start(request)
+        token = current_routing.set(routing)
+        try:
+            response = self.get_response(request)
+        finally:
+            current_routing.reset(token)
+        return self.finish(pin_key, routing, response)
+
+    async def __acall__(self, request):
+        # The routing is copied into the request's sync_to_async calls with
+        # the rest of the context, and a write there still pins it.
+        pin_key, routing = self.start(request)
+        token = current_routing.set(routing)
+        try:
+            response = await self.get_response(request)
+        finally:
+            current_routing.reset(token)
+        return self.finish(pin_key, routing, response)
+
+    def start(self, request):
+        pin_key = client_pin_key(request) if get_replicas() else None
+        unsafe = request.method not in ('GET', 'HEAD', 'OPTIONS')
+        routing = RequestRouting(unsafe or bool(pin_key and cache.get(pin_key)))
+        # Writes made with an explicit .using() (the sharded tables) never
+        # reach the router, so an unsafe request counts as a write up front.
+        routing.wrote = unsafe
+        return pin_key, routing
+
+    def finish(self, pin_key, routing, response):
+        if pin_key and routing.wrote:
+            cache.set(pin_key, True, get_pin_seconds())
+        return response
@@ -0,0 +1,134 @@
+import re
+
+from django.db import connections
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+
+PRODUCT_TABLE = 'ecommerce_app_product'
+FTS_TABLE = 'ecommerce_app_product_fts'
+
+# Name matches weigh ten times more than description matches.
+RANK_SQL = f'bm25({FTS_TABLE}, 10.0, 1.0)'
+
+CREATE_TABLE_SQL = (
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+    f"name, description, content='{PRODUCT_TABLE}', content_rowid='id', "
+    f"tokenize='unicode61 remove_diacritics 2')"
+)
+
+# The index is an external-content table, so SQLite triggers keep it in sync
+# with every write to the product table, including bulk and F() updates.
+TRIGGERS = {
+    f'{FTS_TABLE}_ai': (
+        f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ai AFTER INSERT ON {PRODUCT_TABLE} BEGIN "
+        f"INSERT INTO {FTS_TABLE}(rowid, name, description) VALUES (new.id, new.name, new.description); "
+        f"END"
+    ),
+    f'{FTS_TABLE}_ad': (
+        f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ad AFTER DELETE ON {PRODUCT_TABLE} BEGIN "
+        f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, name, description) "
+        f"VALUES ('delete', old.id, old.name, old.description); "
+        f"END"
+    ),
+    f'{FTS_TABLE}_au': (
+        f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_au AFTER UPDATE OF name, description ON {PRODUCT_TABLE} BEGIN "
+        f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, name, description) "
+        f"VALUES ('delete', old.id, old.name, old.description); "
+        f"INSERT INTO {FTS_TABLE}(rowid, name, description) VALUES (new.id, new.name, new.description); "
+        f"END"
+    ),
+}
+
+REBUILD_SQL = f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')"
+
+
+def is_supported(connection):
+    return connection.vendor == 'sqlite'
+
+
+def install(connection):
+    with connection.cursor() as cursor:
+        cursor.execute(CREATE_TABLE_SQL)
+        for sql in TRIGGERS.values():
+            cursor.execute(sql)
+        cursor.execute(REBUILD_SQL)
+
+
+def uninstall(connection):
+    with connection.cursor() as cursor:
+        for name in TRIGGERS:
+            cursor.execute(f'DROP TRIGGER IF EXISTS {name}')
+        cursor.execute(f'DROP TABLE IF EXISTS {FTS_TABLE}')
+
+
+def ensure_index(using='default', **kwargs):
+    """
+    SQLite migrations that alter the product table rebuild it from scratch,
+    which silently drops our triggers. Reinstall them (and rebuild the index,
+    since writes may have been missed) whenever that happened.
+    """
+    connection = connections[using]
+    if not is_supported(connection):
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT name FROM sqlite_master WHERE type IN ('table', 'trigger') AND name LIKE %s",
+            [f'{FTS_TABLE}%'],
+        )
+        existing = {row[0] for row in cursor.fetchall()}
+    if FTS_TABLE in existing and not set(TRIGGERS) <= existing:
+        install(connection)
+
+
+def build_match_query(text, column=None):
+    tokens = re.findall(r'\w+', text)
+    if not tokens:
+        return None
+    # Every token is quoted (so FTS5 operators in user input are inert) and
+    # matched as a prefix.
+    terms = ' '.join(f'"{token}"*' for token in tokens)
+    if column:
+        return f'{column} : ({terms})'
+    return f'({terms})'
+
+
+def search(queryset, q=None, name=None, rank=True):
+    """
+    Filters ``queryset`` down to products matching ``q`` (name and description)
+    and ``name`` (name only), best matches first unless ``rank`` is False.
+    """
+    connection = connections[queryset.db]
+    if not is_supported(connection):
+        return _search_fallback(queryset, q, name)
+
+    clauses = []
+    for text, column in ((q, None), (name, 'name')):
+        if text:
+            clause = build_match_query(text, column)
+            if clause is None:
+                return queryset.none()
+            clauses.append(clause)
+    if not clauses:
+        return queryset
+    match = ' AND '.join(clauses)
+
+    queryset = queryset.filter(
+        id__in=RawSQL(f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s', [match]),
+    )
+    if not rank:
+        return queryset
+    return queryset.annotate(
+        search_rank=RawSQL(
+            f'SELECT {RANK_SQL} FROM {FTS_TABLE} '
+            f'WHERE {FTS_TABLE} MATCH %s AND rowid = {PRODUCT_TABLE}.id',
+            [match],
+        ),
+    ).order_by('search_rank', 'id')
+
+
+def _search_fallback(queryset, q, name):
+    if q:
+        queryset = queryset.filter(Q(name__icontains=q) | Q(description__icontains=q))
+    if name:
+        queryset = queryset.filter(name__icontains=name)
+    return queryset
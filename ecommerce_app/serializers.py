@@ -1,6 +1,8 @@
 from rest_framework import serializers
-from .models import CustomUser, CartItem, OrderItem, Category, Product, Order,Coupon, CustomUser, Category, Product, ProductReview, Wishlist
-class CustomUserSerializer(serializers.ModelSerializer):
+from .metrics import TimedSerializerMixin
+from .storage import derived_image_storage
+from .models import BroadcastJob, Cart, CustomUser, CartItem, OrderItem, Category, Product, Order,Coupon, CustomUser, Category, Product, ProductReview, Wishlist
+class CustomUserSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     password = serializers.CharField(write_only=True)
 
     class Meta:
@@ -33,25 +35,64 @@ class PasswordResetSerializer(serializers.Serializer):
     new_password = serializers.CharField(write_only=True)
 
 
-class CategorySerializer(serializers.ModelSerializer):
+class CategorySerializer(TimedSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = Category
         fields = '__all__'
 
 
-class ProductSerializer(serializers.ModelSerializer):
+class ProductSerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    images = serializers.SerializerMethodField()
+    rating = serializers.SerializerMethodField()
+
     class Meta:
         model = Product
-        fields = '__all__'
+        exclude = ['image_variants', *Product.COUNTER_FIELDS]
+
+    def get_rating(self, obj):
+        return {
+            'average': round(obj.rating_average, 2),
+            'count': obj.rating_count,
+            'histogram': {str(stars): getattr(obj, f'rating_{stars}') for stars in range(1, 6)},
+        }
+
+    def get_images(self, obj):
+        # {size: {format: url}} for the resized variants that have been built;
+        # clients fall back to `image` until then.
+        request = self.context.get('request')
+        images = {}
+        for size, formats in (obj.image_variants or {}).items():
+            images[size] = {}
+            for format_name, path in formats.items():
+                url = derived_image_storage.url(path)
+                images[size][format_name] = request.build_absolute_uri(url) if request else url
+        return images
+
+
+class ProductImportRowSerializer(serializers.Serializer):
+    # One row of a bulk import; rows with an id update that product.
+    id = serializers.IntegerField(required=False, min_value=1)
+    name = serializers.CharField(max_length=255)
+    description = serializers.CharField(allow_blank=True, default='')
+    price = serializers.DecimalField(max_digits=10, decimal_places=2, min_value=0)
+    quantity = serializers.IntegerField(min_value=0)
+    category = serializers.CharField(max_length=255)
+
 
+class OrderExportFilterSerializer(serializers.Serializer):
+    date_from = serializers.DateField(required=False)
+    date_to = serializers.DateField(required=False)
+    status = serializers.ChoiceField(choices=Order.ORDER_STATUS_CHOICES, required=False)
+    coupon = serializers.CharField(max_length=50, required=False)
 
-class UserSerializer(serializers.ModelSerializer):
+
+class UserSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = CustomUser
         fields = ['id', 'email', 'first_name', 'last_name', 'is_staff']
 
 
-class CartItemSerializer(serializers.ModelSerializer):
+class CartItemSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     product_name = serializers.SerializerMethodField()
     price = serializers.SerializerMethodField()
 
@@ -66,7 +107,13 @@ class CartItemSerializer(serializers.ModelSerializer):
         return obj.product.price
 
 
-class OrderItemSerializer(serializers.ModelSerializer):
+class CartSummarySerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    class Meta:
+        model = Cart
+        fields = ['subtotal', 'item_count']
+
+
+class OrderItemSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     product = serializers.SerializerMethodField()
     price_at_order = serializers.DecimalField(max_digits=10, decimal_places=2)
     amount_for_item = serializers.SerializerMethodField()
@@ -84,7 +131,7 @@ class OrderItemSerializer(serializers.ModelSerializer):
         }
 
 
-class UserProfileUpdateSerializer(serializers.ModelSerializer):
+class UserProfileUpdateSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = CustomUser
         fields = ('id', 'email', 'first_name', 'last_name')
@@ -92,16 +139,20 @@ class UserProfileUpdateSerializer(serializers.ModelSerializer):
             'email': {'read_only': True},  # Make email read-only to prevent modification
         }
 
-class WishlistSerializer(serializers.ModelSerializer):
+class WishlistSerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    products = serializers.SerializerMethodField()
 
     class Meta:
         model = Wishlist
         fields = '__all__'
 
+    def get_products(self, obj):
+        return obj.product_ids()
+
 class WishlistAddProductSerializer(serializers.Serializer):
     product_id = serializers.PrimaryKeyRelatedField(queryset=Product.objects.all())
 
-class ProductReviewSerializer(serializers.ModelSerializer):
+class ProductReviewSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     user = serializers.StringRelatedField()
     product_name = serializers.SerializerMethodField()
 
@@ -113,12 +164,12 @@ class ProductReviewSerializer(serializers.ModelSerializer):
         return obj.product.name
     
     
-class CouponSerializer(serializers.ModelSerializer):
+class CouponSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = Coupon
         fields = '__all__'
 
-class OrderSerializer(serializers.ModelSerializer):
+class OrderSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     order_items = OrderItemSerializer(many=True, read_only=True)
     user = UserSerializer()
     discounted_amount = serializers.DecimalField(max_digits=10, decimal_places=2, read_only=True)
@@ -128,4 +179,14 @@ class OrderSerializer(serializers.ModelSerializer):
         fields = ['id', 'user', 'total_amount','total_amount_without_coupon', 'order_status', 'shipping_address', 'coupon_code', 'payment_method', 'order_items','discounted_amount']
 
     def create(self, validated_data):
-        return Order.objects.create(**validated_data)
\ No newline at end of file
+        return Order.objects.create(**validated_data)
+
+
+class BroadcastJobSerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    job_id = serializers.IntegerField(source='id', read_only=True)
+    attachments = serializers.SlugRelatedField(many=True, read_only=True, slug_field='name')
+
+    class Meta:
+        model = BroadcastJob
+        fields = ['job_id', 'subject', 'status', 'total_recipients', 'sent_count', 'failed_count',
+                  'attachments', 'last_error', 'created_at', 'finished_at']
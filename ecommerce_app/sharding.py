@@ -0,0 +1,219 @@
+import hashlib
+from contextlib import ExitStack, contextmanager
+from heapq import merge
+from itertools import islice
+
+from django.apps import apps
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+
+from . import routers
+
+# Per-user tables, spread over DATABASE_SHARDS by the owner's id. Everything
+# else (catalog, users, coupons, reservations, ...) lives on the default
+# database, which is also the first shard.
+SHARDED_MODELS = frozenset({'cart', 'cartitem', 'order', 'orderitem', 'wishlist', 'wishlist_products'})
+
+# Shard N numbers its rows from N * ID_SPAN, so cart and order ids are unique
+# across shards and the shard holding an order can be read off its id.
+ID_SPAN = 10 ** 15
+
+
+def get_shards():
+    return getattr(settings, 'DATABASE_SHARDS', [DEFAULT_DB_ALIAS])
+
+
+def is_sharded(model):
+    return model._meta.app_label == 'ecommerce_app' and model._meta.model_name in SHARDED_MODELS
+
+
+def shard_for_user(user):
+    """
+    The alias holding the carts, orders and wishlist of ``user`` (a user or a
+    user id). A stable hash rather than Python's hash(), which changes between
+    processes.
+    """
+    shards = get_shards()
+    if len(shards) == 1:
+        return shards[0]
+    user_id = getattr(user, 'pk', user)
+    digest = hashlib.blake2b(str(user_id).encode(), digest_size=8).digest()
+    return shards[int.from_bytes(digest, 'big') % len(shards)]
+
+
+def read_shard_for_user(user):
+    """
+    ``shard_for_user()`` for the reads of a request. Only the default
+    database has read replicas, so users kept there are read from one when
+    the request may use them (see ``routers.read_alias()``); users on other
+    shards are always read from their shard.
+    """
+    alias = shard_for_user(user)
+    return routers.read_alias() if alias == DEFAULT_DB_ALIAS else alias
+
+
+def shard_for_id(pk):
+    """The alias a sharded row with this id was created on, or None."""
+    shards = get_shards()
+    try:
+        index = int(pk) // ID_SPAN
+    except (TypeError, ValueError):
+        return None
+    return shards[index] if 0 <= index < len(shards) else None
+
+
+@contextmanager
+def atomic(alias):
+    """
+    A transaction on ``alias`` with one on the default database inside it.
+    Either fails before anything commits or both commit, except when the
+    second commit itself fails, after a crash or an I/O error. The default
+    database commits first, so that window leaves stock taken for nothing
+    rather than an order for stock nobody took. It also leaves whatever else
+    checkout wrote to the default database without an order on the shard:
+    the coupon redemption, the VerifiedPurchase rows and the confirmation
+    emails in the outbox, which are still sent. That window is accepted and
+    nothing reconciles it. Users kept on the default database are not
+    affected: there is only one transaction.
+    """
+    with ExitStack() as stack:
+        stack.enter_context(transaction.atomic(using=alias))
+        if alias != DEFAULT_DB_ALIAS:
+            stack.enter_context(transaction.atomic(using=DEFAULT_DB_ALIAS))
+        yield
+
+
+class ShardRouter:
+    """
+    Sends the sharded models to the alias of the object they were reached
+    from (an instance loaded from a shard, or the owning user), and to the
+    default database otherwise; views pick the user's shard with
+    ``.using(shard_for_user(user))``. Other models are left to the next router.
+    """
+
+    def db_for_read(self, model, **hints):
+        if not is_sharded(model):
+            return None
+        instance = hints.get('instance')
+        if instance is not None:
+            if is_sharded(type(instance)) and instance._state.db:
+                return instance._state.db
+            if instance._meta.label == settings.AUTH_USER_MODEL and instance.pk is not None:
+                return shard_for_user(instance)
+        return DEFAULT_DB_ALIAS
+
+    db_for_write = db_for_read
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db == DEFAULT_DB_ALIAS or db not in get_shards():
+            return None
+        # The other shards only hold the per-user tables.
+        return app_label == 'ecommerce_app' and model_name in SHARDED_MODELS
+
+
+def sharded_models():
+    return [model for model in apps.get_app_config('ecommerce_app').get_models(include_auto_created=True)
+            if is_sharded(model)]
+
+
+def reserve_id_ranges(using=DEFAULT_DB_ALIAS, **kwargs):
+    """
+    post_migrate handler moving the id sequences of a shard's tables to the
+    start of its ID_SPAN range. Only SQLite is handled, through the
+    AUTOINCREMENT counters in sqlite_sequence.
+    """
+    shards = get_shards()
+    if using not in shards or not shards.index(using):
+        return
+    connection = connections[using]
+    if connection.vendor != 'sqlite':
+        return
+    start = shards.index(using) * ID_SPAN
+    with connection.cursor() as cursor:
+        for model in sharded_models():
+            table = model._meta.db_table
+            cursor.execute('SELECT seq FROM sqlite_sequence WHERE name = %s', [table])
+            row = cursor.fetchone()
+            if row is None:
+                cursor.execute('INSERT INTO sqlite_sequence (name, seq) VALUES (%s, %s)', [table, start])
+            elif row[0] < start:
+                cursor.execute('UPDATE sqlite_sequence SET seq = %s WHERE name = %s', [start, table])
+
+
+def delete_from_other_shards(instance):
+    """
+    Deletes the sharded rows cascading from ``instance`` (a user or product)
+    on every shard but the default database, where Django's own collector
+    already handles them.
+    """
+    for model in sharded_models():
+        for field in model._meta.concrete_fields:
+            if field.is_relation and field.remote_field.model is type(instance):
+                for alias in get_shards()[1:]:
+                    model._base_manager.using(alias).filter(**{field.name: instance.pk}).delete()
+
+
+class Descending:
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+class ShardedQuerySet:
+    """
+    One read-only queryset over every shard, with just what the paginators
+    need: filter() and order_by() apply to each shard, count() adds them up,
+    and slicing merges the shards' sorted rows. A slice reads up to its stop
+    from each shard, so keep offsets small (keyset pagination never has one).
+    """
+
+    def __init__(self, querysets):
+        self.querysets = list(querysets)
+
+    @classmethod
+    def over_shards(cls, queryset):
+        return cls(queryset.using(alias) for alias in get_shards())
+
+    def _chain(self, method, *args, **kwargs):
+        return type(self)(getattr(queryset, method)(*args, **kwargs) for queryset in self.querysets)
+
+    def filter(self, *args, **kwargs):
+        return self._chain('filter', *args, **kwargs)
+
+    def order_by(self, *fields):
+        return self._chain('order_by', *fields)
+
+    @property
+    def query(self):
+        return self.querysets[0].query
+
+    @property
+    def ordered(self):
+        return self.querysets[0].ordered
+
+    def count(self):
+        return sum(queryset.count() for queryset in self.querysets)
+
+    def sort_key(self, obj):
+        ordering = self.query.order_by or self.querysets[0].model._meta.ordering
+        return tuple(
+            Descending(getattr(obj, field[1:])) if field.startswith('-') else getattr(obj, field)
+            for field in ordering
+        )
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            return self[key:key + 1][0]
+        start, stop = key.start or 0, key.stop
+        shards = [queryset if stop is None else queryset[:stop] for queryset in self.querysets]
+        return list(islice(merge(*shards, key=self.sort_key), start, stop))
+
+    def __iter__(self):
+        return iter(self[:])
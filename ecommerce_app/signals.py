@@ -0,0 +1,115 @@
+from decimal import Decimal
+
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+
+from . import catalog_cache, coupons, reservations, sharding
+from .authentication import user_cache
+from .models import Cart, Category, Coupon, CouponRedemption, CustomUser, Order, Product, ProductReview
+
+
+@receiver(pre_save, sender=Product)
+def remember_previous_product_state(sender, instance, **kwargs):
+    instance._previous_category_id = instance._previous_price = None
+    previous_image = None
+    if instance.pk:
+        previous = Product.objects.filter(pk=instance.pk).values_list('category_id', 'price', 'image').first()
+        if previous:
+            instance._previous_category_id, instance._previous_price, previous_image = previous
+    # A new upload (or a cleared image) makes the resized variants stale; the
+    # build_image_variants command picks the product up again.
+    image_changed = not instance.image._committed or (instance.image.name or '') != (previous_image or '')
+    if image_changed:
+        instance.image_variants = {}
+
+
+@receiver(post_save, sender=Product)
+def reprice_carts(sender, instance, created, **kwargs):
+    previous_price = getattr(instance, '_previous_price', None)
+    if not created and previous_price is not None and previous_price != instance.price:
+        Cart.reprice_product(instance.pk, Decimal(instance.price) - previous_price)
+
+
+@receiver(pre_delete, sender=Product)
+def remove_from_cart_totals(sender, instance, **kwargs):
+    # The cart items go with the product, without signals of their own.
+    Cart.reprice_product(instance.pk, -instance.price, quantity_sign=-1)
+
+
+@receiver(pre_delete, sender=Product)
+@receiver(pre_delete, sender=CustomUser)
+def delete_sharded_rows(sender, instance, **kwargs):
+    # Django only cascades on the database the instance is deleted from.
+    sharding.delete_from_other_shards(instance)
+
+
+@receiver(pre_delete, sender=Cart)
+def release_cart_reservations(sender, instance, **kwargs):
+    # The reservations are deleted with the cart, but the units they held
+    # have to go back to the products.
+    reservations.release_cart(instance)
+
+
+@receiver(pre_delete, sender=Order)
+def detach_coupon_redemptions(sender, instance, **kwargs):
+    # The redemption stays, so the coupon remains used.
+    CouponRedemption.objects.filter(order_id=instance.pk).update(order=None)
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def invalidate_product_cache(sender, instance, **kwargs):
+    affected = [(instance.pk, instance.category_id)]
+    previous_category_id = getattr(instance, '_previous_category_id', None)
+    if previous_category_id is not None and previous_category_id != instance.category_id:
+        affected.append((instance.pk, previous_category_id))
+    catalog_cache.invalidate_products(affected)
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def invalidate_category_cache(sender, instance, **kwargs):
+    catalog_cache.invalidate_category(instance.pk)
+
+
+@receiver(post_save, sender=Coupon)
+@receiver(post_delete, sender=Coupon)
+def refresh_coupon_index(sender, instance, **kwargs):
+    coupons.index.invalidate()
+
+
+@receiver(pre_save, sender=ProductReview)
+def remember_previous_rating(sender, instance, **kwargs):
+    instance._previous_rating = None
+    if instance.pk:
+        instance._previous_rating = ProductReview.objects.filter(pk=instance.pk).values_list('rating', flat=True).first()
+
+
+@receiver(post_save, sender=ProductReview)
+def add_review_rating(sender, instance, created, **kwargs):
+    previous_rating = getattr(instance, '_previous_rating', None)
+    if not created and previous_rating == instance.rating:
+        return
+    if previous_rating is not None:
+        Product.add_rating(instance.product_id, previous_rating, sign=-1)
+    Product.add_rating(instance.product_id, instance.rating)
+    # add_rating() goes through update(), which skips the product signals.
+    catalog_cache.invalidate_products([(instance.product_id, instance.product.category_id)])
+
+
+@receiver(post_delete, sender=ProductReview)
+def remove_review_rating(sender, instance, **kwargs):
+    Product.add_rating(instance.product_id, instance.rating, sign=-1)
+    # The product may be on its way out too (cascade), so don't touch instance.product.
+    category_id = Product.objects.filter(pk=instance.product_id).values_list('category_id', flat=True).first()
+    if category_id is not None:
+        catalog_cache.invalidate_products([(instance.product_id, category_id)])
+
+
+@receiver(post_save, sender=CustomUser)
+@receiver(post_delete, sender=CustomUser)
+def evict_cached_user(sender, instance, **kwargs):
+    # Covers profile updates, password resets and deactivation; tokens of a
+    # deleted or deactivated user stop working in this process right away.
+    user_cache.evict(getattr(instance, jwt_settings.USER_ID_FIELD))
@@ -0,0 +1,50 @@
+import hashlib
+import os
+import posixpath
+
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+
+
+def content_hash(content):
+    digest = hashlib.sha256()
+    for chunk in content.chunks():
+        digest.update(chunk)
+    content.seek(0)
+    return digest.hexdigest()
+
+
+def is_content_addressed(name):
+    stem = os.path.splitext(posixpath.basename(name))[0]
+    return len(stem) == 64 and all(c in '0123456789abcdef' for c in stem)
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    Stores every file under the SHA-256 of its bytes, keeping the directory and
+    extension it was uploaded with. Uploading bytes that are already stored
+    reuses the existing file instead of writing a renamed copy.
+    """
+
+    def save(self, name, content, max_length=None):
+        if name is None:
+            name = content.name
+        if not hasattr(content, 'chunks'):
+            content = File(content, name)
+        directory, filename = posixpath.split(name.replace(os.sep, '/'))
+        extension = os.path.splitext(filename)[1].lower()
+        digest = content_hash(content)
+        name = posixpath.join(directory, digest[:2], digest + extension)
+        if self.exists(name):
+            return name
+        return super().save(name, content, max_length=max_length)
+
+
+product_image_storage = ContentAddressedStorage()
+
+# Resized variants already carry the original's hash in their path.
+derived_image_storage = FileSystemStorage()
+
+
+def get_product_image_storage():
+    return product_image_storage
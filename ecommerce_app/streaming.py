@@ -0,0 +1,65 @@
+import csv
+import io
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import StreamingHttpResponse
+
+FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+
+class Echo:
+    # csv.writer only needs something with write(); hand the line back instead
+    # of buffering it.
+    def write(self, value):
+        return value
+
+
+def iter_csv(fields, rows):
+    writer = csv.writer(Echo())
+    yield writer.writerow(fields)
+    for row in rows:
+        yield writer.writerow([row[field] for field in fields])
+
+
+def iter_ndjson(rows):
+    for row in rows:
+        yield json.dumps(row, cls=DjangoJSONEncoder) + '\n'
+
+
+def streaming_response(rows, fields, file_format, filename):
+    """
+    Streams ``rows`` (an iterator of dicts keyed by ``fields``) as CSV or
+    NDJSON, one line at a time.
+    """
+    if file_format == 'csv':
+        content = iter_csv(fields, rows)
+    else:
+        content = iter_ndjson(rows)
+    response = StreamingHttpResponse(content, content_type=FORMATS[file_format])
+    response['Content-Disposition'] = f'attachment; filename="{filename}.{file_format}"'
+    return response
+
+
+def read_rows(binary_file, file_format):
+    """
+    Yields ``(line_number, dict)`` from a CSV or NDJSON file without reading
+    it into memory. Malformed NDJSON lines yield ``(line_number, None)``.
+    """
+    text = io.TextIOWrapper(binary_file, encoding='utf-8-sig', newline='')
+    if file_format == 'csv':
+        reader = csv.DictReader(text)
+        for row in reader:
+            yield reader.line_num, row
+    else:
+        for line_number, line in enumerate(text, start=1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                row = None
+            yield line_number, row if isinstance(row, dict) else None
@@ -1,3 +1,2059 @@
-from django.test import TestCase
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from datetime import date, timedelta
+from decimal import Decimal
+from io import BytesIO, StringIO
+from urllib.parse import urlencode
+from unittest import mock, skipUnless
+
+import aiosmtplib
+from asgiref.sync import async_to_sync
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.core import mail
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.mail.backends import locmem
+from django.core.management import CommandError, call_command
+from django.db import DEFAULT_DB_ALIAS, OperationalError, connection, connections, transaction
+from django.http import HttpResponse
+from django.test import AsyncClient, RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.http import http_date
+from rest_framework import serializers
+from rest_framework.request import Request
+from PIL import Image
+from rest_framework.test import APIClient, APIRequestFactory
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from . import broadcast, catalog_io, checkout, coupons, metrics, order_export, outbox, reservations, routers, search, sharding
+from .authentication import user_cache
+from .management.commands import benchmark_api
+from .models import (
+    BroadcastJob, Cart, CartItem, Category, Coupon, CouponRedemption, CustomUser, Order, OrderItem, OutboxEmail, Product, ProductReview,
+    StockReservation, VerifiedPurchase,
+)
+from .serializers import ProductSerializer
+from .views import AdminOrderView, CustomerProductListView, OrderHistoryView, ProductReviewListView
+
+
+def client_for(user):
+    client = APIClient()
+    client.force_authenticate(user)
+    return client
+
+
+def run_concurrently(clients, work):
+    """
+    Runs ``work(client)`` for every client in a thread of its own, all
+    starting together, and returns their results in order.
+    """
+    barrier = threading.Barrier(len(clients))
+    results = [None] * len(clients)
+    errors = []
+
+    def run(index, client):
+        try:
+            barrier.wait()
+            results[index] = work(client)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            connections.close_all()
+
+    threads = [threading.Thread(target=run, args=(index, client)) for index, client in enumerate(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return results
+
+
+def use_temporary_media_root(test):
+    media_root = tempfile.mkdtemp()
+    test.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+    media_settings = override_settings(MEDIA_ROOT=media_root)
+    media_settings.enable()
+    test.addCleanup(media_settings.disable)
+    return media_root
+
+
+def add_sqlite_database(add_cleanup, alias, **settings_dict):
+    """
+    Adds ``alias``, a fresh SQLite file in a temporary directory, to
+    DATABASES and the connection handler until ``add_cleanup`` (a test's
+    addCleanup or addClassCleanup) runs its cleanups.
+    """
+    directory = tempfile.mkdtemp()
+    add_cleanup(shutil.rmtree, directory, ignore_errors=True)
+    database = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': os.path.join(directory, f'{alias}.sqlite3'), **settings_dict}
+    configured = connections.configure_settings({DEFAULT_DB_ALIAS: connections.settings[DEFAULT_DB_ALIAS], alias: database})
+
+    def remove():
+        connections[alias].close()
+        del connections[alias]
+        connections.settings.pop(alias, None)
+        settings.DATABASES.pop(alias, None)
+
+    # Usually the same dict.
+    settings.DATABASES[alias] = connections.settings[alias] = configured[alias]
+    add_cleanup(remove)
+    return database['NAME']
+
+
+def jpeg_bytes(color, size=(1200, 800)):
+    output = BytesIO()
+    Image.new('RGB', size, color).save(output, 'JPEG')
+    return output.getvalue()
+
+
+@skipUnless(connection.vendor == 'sqlite', 'Plans are read from SQLite EXPLAIN QUERY PLAN output.')
+class QueryPlanTests(TestCase):
+    """
+    Fails when a hot query stops using an index: a plan step that scans a
+    whole table, or (for paginated listings) sorts rows in a temp b-tree
+    instead of reading them in index order.
+    """
+    databases = '__all__'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user('plans@example.com', 'password', first_name='Query', last_name='Plan')
+        cls.category = Category.objects.create(name='Plans')
+        cls.product = Product.objects.create(
+            name='Plan product', description='', price=10, quantity=5, category=cls.category,
+        )
+
+    def view_queryset(self, view_class, params=None, **kwargs):
+        request = Request(APIRequestFactory().get('/', params or {}))
+        request.user = self.user
+        view = view_class()
+        view.setup(request, **kwargs)
+        view.request = request
+        return view.get_queryset()
+
+    def assertUsesIndexes(self, queryset, ordered=False):
+        plan = queryset.explain()
+        for line in plan.splitlines():
+            self.assertFalse(' SCAN ' in line and 'USING' not in line, f'Full table scan:\n{plan}')
+        if ordered:
+            self.assertNotIn('USE TEMP B-TREE', plan, f'Sorted without an index:\n{plan}')
+
+    def test_order_history(self):
+        queryset = self.view_queryset(OrderHistoryView)
+        self.assertUsesIndexes(queryset[:10], ordered=True)
+        self.assertUsesIndexes(queryset.filter(created_at__lt=date(2024, 1, 1))[:10], ordered=True)
+
+    def test_admin_order_list(self):
+        for queryset in self.view_queryset(AdminOrderView).querysets:
+            self.assertUsesIndexes(queryset[:10], ordered=True)
+
+    def test_order_export(self):
+        for filters in ({'date_from': date(2024, 1, 1), 'date_to': date(2024, 1, 31)}, {'coupon': 'SAVE10'}):
+            items = order_export.filter_items(**filters)
+            self.assertUsesIndexes(items.order_by('order_id', 'id').values_list(*order_export.COLUMNS))
+
+    def test_product_reviews(self):
+        queryset = self.view_queryset(ProductReviewListView, {'product_id': self.product.pk})
+        self.assertUsesIndexes(queryset[:10], ordered=True)
+
+    def test_catalog_by_category(self):
+        for params in ({'category': self.category.pk}, {'category': self.category.pk, 'min_price': 5, 'max_price': 50}):
+            self.assertUsesIndexes(self.view_queryset(CustomerProductListView, params)[:10])
+
+    def test_unexpired_coupons(self):
+        # What CouponIndex.load() reads.
+        self.assertUsesIndexes(Coupon.objects.filter(end_date__gte=date(2024, 1, 1)))
+
+    def test_cart_item_lookup(self):
+        self.assertUsesIndexes(CartItem.objects.filter(cart_id=1, product=self.product))
+        self.assertUsesIndexes(CartItem.objects.filter(cart__user=self.user).select_related('product', 'cart'))
+
+    def test_verified_purchase_lookup(self):
+        self.assertUsesIndexes(VerifiedPurchase.objects.filter(user=self.user, product=self.product))
+
+
+class CatalogCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user('cache@example.com', 'password', first_name='Cache', last_name='User')
+        cls.admin = CustomUser.objects.create_superuser('admin@example.com', 'password', first_name='Ad', last_name='Min')
+        cls.chairs = Category.objects.create(name='Chairs')
+        cls.tables = Category.objects.create(name='Tables')
+        cls.sofa = Product.objects.create(name='Sofa', description='comfy', price=10, quantity=5, category=cls.chairs)
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def count(self, url):
+        return self.client.get(url).data['count']
+
+    def test_repeated_list_is_served_from_cache(self):
+        self.client.get('/product_list/')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/product_list/')
+        self.assertEqual(response.data['count'], 1)
+        self.assertEqual(len(queries), 0, queries.captured_queries)
+
+    def test_product_writes_invalidate_lists(self):
+        self.assertEqual(self.count(f'/product_list/?category={self.tables.pk}'), 0)
+        Product.objects.create(name='Stool', description='', price=1, quantity=1, category=self.chairs)
+        self.assertEqual(self.count('/product_list/'), 2)
+        # Lists of other categories stay cached.
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(f'/product_list/?category={self.tables.pk}')
+        self.assertEqual(len(queries), 0)
+
+        # Moving a product invalidates both its old and its new category.
+        self.sofa.category = self.tables
+        self.sofa.save()
+        self.assertEqual(self.count(f'/product_list/?category={self.tables.pk}'), 1)
+        self.assertEqual(self.count(f'/product_list/?category={self.chairs.pk}'), 1)
+
+    def test_admin_update_invalidates_detail(self):
+        self.assertEqual(self.client.get(f'/product_detail/{self.sofa.pk}/').data['name'], 'Sofa')
+        admin = APIClient()
+        admin.force_authenticate(self.admin)
+        admin.patch(f'/products/{self.sofa.pk}/', {'name': 'Couch'}, format='json')
+        self.assertEqual(self.client.get(f'/product_detail/{self.sofa.pk}/').data['name'], 'Couch')
+        self.assertEqual(self.count('/product_list/?name=COUCH'), 1)
+
+    def test_delete_invalidates_list_and_detail(self):
+        self.client.get('/product_list/')
+        self.client.get(f'/product_detail/{self.sofa.pk}/')
+        Product.objects.get(pk=self.sofa.pk).delete()
+        self.assertEqual(self.count('/product_list/'), 0)
+        self.assertEqual(self.client.get(f'/product_detail/{self.sofa.pk}/').status_code, 404)
+
+
+@skipUnless(connection.vendor == 'sqlite', 'The search index is an SQLite FTS5 table.')
+class ProductSearchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user('search@example.com', 'password', first_name='Se', last_name='Arch')
+        cls.category = Category.objects.create(name='Living room')
+        cls.sofa = Product.objects.create(
+            name='Leather Sofa', description='comfy seat', price=10, quantity=5, category=cls.category,
+        )
+        cls.table = Product.objects.create(
+            name='Dining table', description='wooden, seats a sofa-sized family', price=10, quantity=5,
+            category=cls.category,
+        )
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def names(self, **params):
+        return [product['name'] for product in self.client.get('/product_list/', params).data['results']]
+
+    def test_prefix_match_ranks_name_above_description(self):
+        self.assertEqual(self.names(q='sof'), ['Leather Sofa', 'Dining table'])
+        self.assertEqual(self.names(q='wooden'), ['Dining table'])
+        self.assertEqual(self.names(name='sofa'), ['Leather Sofa'])
+        self.assertEqual(self.names(q='oak', name='desk'), [])
+
+    def test_triggers_follow_writes(self):
+        self.table.name = 'Oak desk'
+        self.table.save()
+        self.assertEqual(self.names(name='oak'), ['Oak desk'])
+        self.sofa.delete()
+        self.assertEqual(self.names(q='sofa'), ['Oak desk'])
+        Product.objects.filter(pk=self.table.pk).update(description='walnut veneer')
+        self.assertEqual(self.names(q='walnut'), ['Oak desk'])
+
+    def test_query_syntax_is_escaped(self):
+        self.assertEqual(self.names(q='"NEAR'), [])
+        # Operators are searched for as words, not applied.
+        self.assertEqual(self.names(q='sofa OR'), [])
+        self.assertEqual(self.names(q='sofa*"'), ['Leather Sofa', 'Dining table'])
+
+    def test_ensure_index_restores_missing_triggers(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DROP TRIGGER {search.FTS_TABLE}_ai')
+        search.ensure_index('default')
+        Product.objects.create(name='Zebra rug', description='', price=1, quantity=1, category=self.category)
+        self.assertEqual(self.names(q='zeb'), ['Zebra rug'])
+
+
+class KeysetPaginationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user('pages@example.com', 'password', first_name='Pa', last_name='Ges')
+        cls.category = Category.objects.create(name='Sofas')
+        cls.products = [
+            Product.objects.create(name=f'sofa {i}', description='', price=10 + i % 3, quantity=5, category=cls.category)
+            for i in range(10)
+        ]
+        for _ in range(7):
+            ProductReview.objects.create(user=cls.user, product=cls.products[0], rating=3, review_text='fine')
+        for _ in range(5):
+            Order.objects.create(user=cls.user, total_amount=1, shipping_address='x', payment_method='card')
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def walk(self, url):
+        pages = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200, response.data)
+            self.assertNotIn('count', response.data)
+            pages.append([row['id'] for row in response.data['results']])
+            url = response.data['next']
+        return pages
+
+    def test_catalog(self):
+        pages = self.walk('/product_list/?cursor=&page_size=4')
+        self.assertEqual([len(page) for page in pages], [4, 4, 2])
+        self.assertCountEqual(sum(pages, []), [product.pk for product in self.products])
+        # Sorted on a non-unique column, ties broken by id.
+        pages = self.walk('/product_list/?cursor=&page_size=3&ordering=price')
+        self.assertEqual(len(set(sum(pages, []))), 10)
+
+    def test_rows_added_between_pages_are_not_repeated(self):
+        response = self.client.get('/product_list/?cursor=&page_size=4')
+        first = [row['id'] for row in response.data['results']]
+        Product.objects.create(name='sofa new', description='', price=1, quantity=1, category=self.category)
+        cache.clear()
+        rest = sum(self.walk(response.data['next']), [])
+        self.assertFalse(set(first) & set(rest))
+
+    def test_order_history_and_reviews(self):
+        pages = self.walk('/order_history/?cursor=&page_size=2')
+        self.assertEqual([len(page) for page in pages], [2, 2, 1])
+        pages = self.walk(f'/reviews/?cursor=&page_size=2&product_id={self.products[0].pk}')
+        self.assertEqual(len(set(sum(pages, []))), 7)
+
+    def test_page_numbers_still_work(self):
+        response = self.client.get('/product_list/?page_size=5&page=2')
+        self.assertEqual(response.data['count'], 10)
+        self.assertEqual(len(response.data['results']), 5)
+
+    def test_order_history_and_reviews_are_newest_first(self):
+        cases = [
+            ('/order_history/', {}, Order.objects.order_by('-id')),
+            ('/reviews/', {'product_id': self.products[0].pk}, ProductReview.objects.order_by('-id')),
+        ]
+        for path, params, queryset in cases:
+            with self.subTest(path=path):
+                expected = list(queryset.values_list('id', flat=True))
+                pages = [
+                    [row['id'] for row in self.client.get(path, {**params, 'page_size': 2, 'page': page}).data['results']]
+                    for page in range(1, 4)
+                ]
+                self.assertEqual(sum(pages, []), expected[:6])
+                query = urlencode({**params, 'cursor': '', 'page_size': 2})
+                self.assertEqual(sum(self.walk(f'{path}?{query}'), []), expected)
+
+    def test_invalid_cursor(self):
+        self.assertEqual(self.client.get('/product_list/?cursor=zzz').status_code, 404)
+
+
+class OrderQueryCountTests(TestCase):
+    """The order endpoints run a fixed number of queries, however many orders and items they show."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = CustomUser.objects.create_superuser('orders@example.com', 'password', first_name='Or', last_name='Der')
+        cls.category = Category.objects.create(name='Lamps')
+        cls.products = [
+            Product.objects.create(name=f'lamp {i}', description='', price=10, quantity=5, category=cls.category)
+            for i in range(3)
+        ]
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.admin)
+
+    def add_orders(self, count, items):
+        for _ in range(count):
+            order = Order.objects.create(user=self.admin, total_amount=1, shipping_address='x', payment_method='card')
+            for product in self.products[:items]:
+                OrderItem.objects.create(order=order, product=product, quantity=1, price_at_order=10)
+        return order
+
+    def queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_lists(self):
+        self.add_orders(1, 1)
+        few = [self.queries('/order_history/'), self.queries('/orders/')]
+        self.add_orders(5, 3)
+        self.assertEqual([self.queries('/order_history/'), self.queries('/orders/')], few)
+
+    def test_detail(self):
+        small = self.add_orders(1, 1)
+        large = self.add_orders(1, 3)
+        self.assertEqual(self.queries(f'/orders/{large.pk}/'), self.queries(f'/orders/{small.pk}/'))
+        response = self.client.get(f'/orders/{large.pk}/')
+        self.assertEqual(len(response.data['order_items']), 3)
+        self.assertEqual(response.data['order_items'][0]['product']['name'], 'lamp 0')
+
+
+class CheckoutTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user('checkout@example.com', 'password', first_name='Ch', last_name='Eck')
+        cls.category = Category.objects.create(name='Desks')
+
+    def setUp(self):
+        self.cart = Cart.objects.create(user=self.user)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def fill_cart(self, count, quantity=2):
+        products = [
+            Product.objects.create(name=f'desk {i}', description='', price=2, quantity=5, category=self.category)
+            for i in range(count)
+        ]
+        for product in products:
+            CartItem.objects.create(cart=self.cart, product=product, quantity=quantity)
+        return products
+
+    def checkout(self, **data):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(
+                '/place_order/', {'shipping_address': 'x', 'payment_method': 'card', **data}, format='json',
+            )
+        return response, len(queries)
+
+    def test_query_count_does_not_grow_with_the_cart(self):
+        self.fill_cart(1)
+        small, small_queries = self.checkout()
+        self.assertEqual(small.status_code, 201, small.data)
+        products = self.fill_cart(50)
+        large, large_queries = self.checkout()
+        self.assertEqual(large.status_code, 201, large.data)
+        self.assertEqual(large_queries, small_queries)
+        self.assertEqual(len(large.data['order_items']), 50)
+        self.assertEqual(Product.objects.get(pk=products[0].pk).quantity, 3)
+        self.assertFalse(CartItem.objects.exists())
+
+    def test_short_product_rolls_everything_back(self):
+        products = self.fill_cart(3)
+        Product.objects.filter(pk=products[1].pk).update(quantity=1)
+        response, _ = self.checkout()
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('exceeds', response.data['message'])
+        self.assertEqual(Product.objects.get(pk=products[0].pk).quantity, 5)
+        self.assertFalse(Order.objects.exists())
+        self.assertEqual(CartItem.objects.count(), 3)
+
+    def test_coupon(self):
+        self.fill_cart(2)
+        today = date.today()
+        Coupon.objects.create(
+            coupon_code='TEN', discount_type='percentage', discount_value=10, min_purchase_amount=1,
+            start_date=today, end_date=today, max_usage=2,
+        )
+        response, _ = self.checkout(coupon_code='TEN')
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertEqual(str(response.data['total_amount']), '7.20')
+        self.assertEqual(Coupon.objects.get().max_usage, 1)
+
+
+class CountingEmailBackend(locmem.EmailBackend):
+    """
+    Local SMTP stand-in: delivers to mail.outbox and, like the SMTP backend,
+    only connects when it isn't connected already. Counts the connections.
+    """
+    opened = 0
+    is_open = False
+
+    def open(self):
+        if self.is_open:
+            return False
+        self.is_open = True
+        type(self).opened += 1
+        return True
+
+    def close(self):
+        self.is_open = False
+
+
+@override_settings(EMAIL_BACKEND='ecommerce_app.tests.CountingEmailBackend')
+class OutboxTests(TestCase):
+    def setUp(self):
+        CountingEmailBackend.opened = 0
+
+    def test_mail_is_written_with_the_order(self):
+        response = APIClient().post('/register/customer/', {
+            'email': 'new@example.com', 'password': 'password', 'first_name': 'Ne', 'last_name': 'W',
+        }, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(OutboxEmail.objects.count(), 1)
+
+        user = CustomUser.objects.get()
+        product = Product.objects.create(
+            name='Rug', description='', price=10, quantity=5, category=Category.objects.create(name='Rugs'),
+        )
+        CartItem.objects.create(cart=Cart.objects.create(user=user), product=product, quantity=9)
+        client = client_for(user)
+        order = {'shipping_address': 'x', 'payment_method': 'card'}
+        # A checkout that rolls back leaves no mail behind.
+        self.assertEqual(client.post('/place_order/', order, format='json').status_code, 400)
+        self.assertEqual(OutboxEmail.objects.count(), 1)
+        CartItem.objects.update(quantity=1)
+        self.assertEqual(client.post('/place_order/', order, format='json').status_code, 201)
+        self.assertEqual(OutboxEmail.objects.count(), 3)
+
+        call_command('mail_worker', '--once', stdout=StringIO())
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertEqual(OutboxEmail.objects.filter(status='sent').count(), 3)
+        self.assertTrue(any(message.alternatives for message in mail.outbox))
+
+    def test_batch_shares_one_connection(self):
+        for i in range(5):
+            outbox.enqueue_mail(f'subject {i}', 'body', 'shop@example.com', [f'to{i}@example.com'])
+        self.assertEqual(outbox.drain(batch_size=50), 5)
+        self.assertEqual(len(mail.outbox), 5)
+        self.assertEqual(CountingEmailBackend.opened, 1)
+
+    def test_failures_back_off_then_give_up(self):
+        email = outbox.enqueue_mail('subject', 'body', 'shop@example.com', ['to@example.com'])
+        with mock.patch.object(CountingEmailBackend, 'send_messages', side_effect=OSError('connection refused')):
+            for attempt in range(1, 6):
+                OutboxEmail.objects.filter(pk=email.pk).update(next_attempt_at=timezone.now())
+                before = timezone.now()
+                self.assertEqual(outbox.drain(), 1)
+                email.refresh_from_db()
+                self.assertEqual(email.attempts, attempt)
+                self.assertIn('connection refused', email.last_error)
+                if attempt < 5:
+                    self.assertEqual(email.status, 'pending')
+                    # Not due again until the backoff is over.
+                    self.assertEqual(outbox.drain(), 0)
+                    self.assertGreaterEqual(email.next_attempt_at, before + outbox.retry_delay(attempt))
+        self.assertEqual(email.status, 'failed')
+        self.assertEqual(outbox.retry_delay(1), timedelta(seconds=30))
+        self.assertEqual(outbox.retry_delay(3), timedelta(seconds=120))
+        self.assertEqual(outbox.retry_delay(20), timedelta(seconds=3600))
+
+    def test_leases(self):
+        for i in range(3):
+            outbox.enqueue_mail(f'subject {i}', 'body', 'shop@example.com', [f'to{i}@example.com'])
+        first = outbox.claim_batch(2)
+        second = outbox.claim_batch(2)
+        self.assertEqual(len(first), 2)
+        self.assertEqual(len(second), 1)
+        self.assertFalse({email.pk for email in first} & {email.pk for email in second})
+        self.assertEqual(outbox.claim_batch(2), [])
+        # A worker that died mid-batch: its messages come back once the lease runs out.
+        OutboxEmail.objects.filter(pk__in=[email.pk for email in first]).update(
+            next_attempt_at=timezone.now() - timedelta(seconds=1),
+        )
+        self.assertCountEqual([email.pk for email in outbox.claim_batch(5)], [email.pk for email in first])
+
+
+@override_settings(EMAIL_BACKEND='ecommerce_app.tests.CountingEmailBackend', BROADCAST_BATCH_SIZE=4)
+class BroadcastTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = CustomUser.objects.create_superuser('boss@example.com', 'password', first_name='Bo', last_name='Ss')
+        cls.customers = [
+            CustomUser.objects.create_user(f'customer{i}@example.com', 'password', first_name='Cu', last_name='St')
+            for i in range(10)
+        ]
+
+    def setUp(self):
+        CountingEmailBackend.opened = 0
+        use_temporary_media_root(self)
+
+    def test_sent_in_bcc_batches_over_one_connection(self):
+        client = client_for(self.admin)
+        attachment = SimpleUploadedFile('note.txt', b'hello world', content_type='text/plain')
+        response = client.post(
+            '/custom_email/', {'subject': 'Sale', 'message': 'Everything must go', 'files': [attachment]},
+            format='multipart',
+        )
+        self.assertEqual(response.status_code, 202, response.data)
+        self.assertEqual(response.data['total_recipients'], 10)
+        self.assertEqual(len(mail.outbox), 0)
+
+        call_command('mail_worker', '--once', stdout=StringIO())
+        self.assertEqual([len(message.bcc) for message in mail.outbox], [4, 4, 2])
+        self.assertEqual(CountingEmailBackend.opened, 1)
+        # Encoded once, attached to every batch.
+        for message in mail.outbox:
+            self.assertIn(b'aGVsbG8gd29ybGQ=', message.message().as_bytes())
+        response = client.get(f"/custom_email/{response.data['job_id']}/")
+        self.assertEqual((response.data['status'], response.data['sent_count']), ('done', 10))
+
+    def test_resumes_after_the_last_batch_sent(self):
+        # A worker died after the first batch; its lease has run out.
+        job = broadcast.create_job('Sale', 'body', [])
+        BroadcastJob.objects.filter(pk=job.pk).update(
+            status='running', sent_count=4, last_user_id=self.customers[3].pk,
+            lease_expires_at=timezone.now() - timedelta(seconds=1),
+        )
+        call_command('mail_worker', '--once', stdout=StringIO())
+        sent_to = sum((message.bcc for message in mail.outbox), [])
+        self.assertEqual(sent_to, [customer.email for customer in self.customers[4:]])
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.sent_count, job.failed_count), ('done', 10, 0))
+
+    def test_failed_batches_are_counted(self):
+        broadcast.create_job('Sale', 'body', [])
+        with mock.patch.object(CountingEmailBackend, 'send_messages', side_effect=OSError('refused')):
+            call_command('mail_worker', '--once', stdout=StringIO())
+        job = BroadcastJob.objects.get()
+        self.assertEqual((job.status, job.sent_count, job.failed_count), ('done', 0, 10))
+        self.assertIn('refused', job.last_error)
+
+
+class CartTotalsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user('totals@example.com', 'password', first_name='To', last_name='Tals')
+        category = Category.objects.create(name='Cushions')
+        cls.cushion = Product.objects.create(
+            name='Cushion', description='', price=Decimal('2.50'), quantity=50, category=category,
+        )
+        cls.throw = Product.objects.create(
+            name='Throw', description='', price=Decimal('10.00'), quantity=50, category=category,
+        )
+
+    def setUp(self):
+        self.client = client_for(self.user)
+
+    def add(self, product, quantity):
+        return self.client.post('/cart/', {'product_id': product.pk, 'quantity': quantity}, format='json')
+
+    def summary(self):
+        # Read off the cart row, without touching its items.
+        with self.assertNumQueries(1):
+            response = self.client.get('/cart/summary/')
+        return response.data['subtotal'], response.data['item_count']
+
+    def test_totals_follow_cart_changes(self):
+        self.assertEqual(self.summary(), ('0.00', 0))
+        self.add(self.cushion, 2)
+        self.add(self.cushion, 1)
+        self.assertEqual(self.add(self.throw, 100).status_code, 400)
+        self.add(self.throw, 1)
+        self.assertEqual(self.summary(), ('17.50', 4))
+
+        item = CartItem.objects.get(product=self.throw)
+        self.client.patch(f'/cart_items/{item.pk}/', {'quantity': 3}, format='json')
+        self.assertEqual(self.summary(), ('37.50', 6))
+        self.client.delete(f'/cart_items/{item.pk}/')
+        self.assertEqual(self.summary(), ('7.50', 3))
+
+    def test_price_changes_and_deleted_products(self):
+        self.add(self.cushion, 3)
+        self.add(self.throw, 1)
+        self.cushion.price = Decimal('3.00')
+        self.cushion.save()
+        self.assertEqual(self.summary(), ('19.00', 4))
+        self.throw.delete()
+        self.assertEqual(self.summary(), ('9.00', 3))
+
+    def test_coupon_validation_uses_the_totals(self):
+        self.add(self.throw, 2)
+        today = date.today()
+        Coupon.objects.create(
+            coupon_code='FIVE', discount_type='amount', discount_value=5, min_purchase_amount=1,
+            start_date=today, end_date=today,
+        )
+        response = self.client.post('/validate_coupon_for_cart/', {'coupon_code': 'FIVE'}, format='json')
+        self.assertEqual(response.data['final_price'], Decimal('15.00'))
+
+    def test_checkout_empties_the_totals(self):
+        self.add(self.cushion, 2)
+        self.client.post('/place_order/', {'shipping_address': 'x', 'payment_method': 'card'}, format='json')
+        self.assertEqual(self.summary(), ('0.00', 0))
+
+
+class CouponTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Vases')
+        cls.vase = Product.objects.create(name='Vase', description='', price=10, quantity=50, category=category)
+        today = date.today()
+        cls.coupon = Coupon.objects.create(
+            coupon_code='FIVE', discount_type='amount', discount_value=5, min_purchase_amount=1,
+            start_date=today, end_date=today, max_usage=2,
+        )
+
+    def setUp(self):
+        coupons.index.invalidate()
+
+    def shopper(self, name):
+        user = CustomUser.objects.create_user(f'{name}@example.com', 'password', first_name=name, last_name='S')
+        client = client_for(user)
+        client.post('/cart/', {'product_id': self.vase.pk, 'quantity': 1}, format='json')
+        return client
+
+    def order(self, client):
+        return client.post(
+            '/place_order/', {'shipping_address': 'x', 'payment_method': 'card', 'coupon_code': 'FIVE'}, format='json',
+        )
+
+    def test_validation_reads_no_coupons(self):
+        client = self.shopper('ann')
+        coupons.get_active('FIVE')
+        # The cart subtotal is the only query.
+        with self.assertNumQueries(1):
+            response = client.post('/validate_coupon_for_cart/', {'coupon_code': 'FIVE'}, format='json')
+        self.assertEqual(response.data['final_price'], 5)
+
+    def test_once_per_user_and_max_usage_in_all(self):
+        ann, bob, cat = self.shopper('ann'), self.shopper('bob'), self.shopper('cat')
+        self.assertEqual(self.order(ann).status_code, 201)
+        ann.post('/cart/', {'product_id': self.vase.pk, 'quantity': 1}, format='json')
+        self.assertEqual(self.order(ann).data['message'], 'Coupon has already been used')
+        self.assertEqual(self.order(bob).status_code, 201)
+        self.assertEqual(self.order(cat).data['message'], 'Coupon has reached its maximum usage limit')
+        self.assertEqual(Coupon.objects.get().max_usage, 0)
+        self.assertEqual(CouponRedemption.objects.count(), 2)
+        # Failed redemptions roll back the stock they took.
+        self.assertEqual(Product.objects.get().quantity, 48)
+
+    def test_index_follows_coupon_writes(self):
+        client = self.shopper('ann')
+        self.assertEqual(len(client.get('/list_coupons/').data['results']), 1)
+        self.coupon.end_date = date.today() - timedelta(days=1)
+        self.coupon.save()
+        self.assertEqual(len(client.get('/list_coupons/').data['results']), 0)
+        self.assertEqual(
+            client.post('/validate_coupon_for_cart/', {'coupon_code': 'FIVE'}, format='json').status_code, 400,
+        )
+
+    def test_index_follows_redemptions(self):
+        ann, bob = self.shopper('ann'), self.shopper('bob')
+        self.assertEqual(ann.get('/list_coupons/').data['results'][0]['max_usage'], 2)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(self.order(ann).status_code, 201)
+        self.assertEqual(bob.get('/list_coupons/').data['results'][0]['max_usage'], 1)
+        self.assertEqual(coupons.get_active('FIVE').max_usage, 1)
+
+
+class ProductImageTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = CustomUser.objects.create_superuser('images@example.com', 'password', first_name='Im', last_name='G')
+        cls.category = Category.objects.create(name='Sofas')
+
+    def setUp(self):
+        self.media_root = use_temporary_media_root(self)
+        self.client = client_for(self.admin)
+
+    def stored_files(self, directory='product_images'):
+        root = os.path.join(self.media_root, directory)
+        return sorted(
+            os.path.relpath(os.path.join(path, name), self.media_root)
+            for path, _, names in os.walk(root) if 'derived' not in path for name in names
+        )
+
+    def upload(self, filename, content):
+        response = self.client.post('/products/', {
+            'name': 'Sofa', 'description': 'Three seats', 'price': '1.00', 'quantity': 1, 'category': self.category.pk,
+            'image': SimpleUploadedFile(filename, content, content_type='image/jpeg'),
+        }, format='multipart')
+        self.assertEqual(response.status_code, 201, response.data)
+        return Product.objects.get(pk=response.data['id'])
+
+    def test_identical_uploads_share_one_file(self):
+        content = jpeg_bytes('red')
+        first = self.upload('sofa.jpeg', content)
+        second = self.upload('sofa_copy.jpeg', content)
+        self.assertEqual(first.image.name, second.image.name)
+        self.assertEqual(self.stored_files(), [first.image.name])
+        self.assertNotEqual(self.upload('sofa.jpeg', jpeg_bytes('blue')).image.name, first.image.name)
+
+    def test_variants(self):
+        content = jpeg_bytes('red')
+        first = self.upload('sofa.jpeg', content)
+        second = self.upload('sofa_copy.jpeg', content)
+        self.assertEqual(self.client.get(f'/products/{first.pk}/').data['images'], {})
+
+        call_command('build_image_variants', stdout=StringIO())
+        first.refresh_from_db()
+        second.refresh_from_db()
+        self.assertEqual(first.image_variants, second.image_variants)
+        self.assertEqual(set(first.image_variants), {'thumbnail', 'list', 'detail'})
+        with Image.open(os.path.join(self.media_root, first.image_variants['list']['webp'])) as image:
+            self.assertEqual((image.format, image.size), ('WEBP', (400, 267)))
+        self.assertIn('webp', self.client.get(f'/products/{first.pk}/').data['images']['thumbnail'])
+
+        # A new image clears the variants; other edits keep them.
+        self.client.patch(f'/products/{first.pk}/', {
+            'image': SimpleUploadedFile('new.jpeg', jpeg_bytes('blue'), content_type='image/jpeg'),
+        }, format='multipart')
+        self.client.patch(f'/products/{second.pk}/', {'name': 'Couch'}, format='json')
+        first.refresh_from_db()
+        second.refresh_from_db()
+        self.assertEqual(first.image_variants, {})
+        self.assertNotEqual(second.image_variants, {})
+
+    def test_rehash_merges_legacy_duplicates(self):
+        # Uploads from before the content-addressed storage, with Django's renamed copies.
+        legacy = FileSystemStorage()
+        content = jpeg_bytes('green')
+        names = [legacy.save('product_images/sofa.jpeg', ContentFile(content)) for _ in range(2)]
+        names.append(legacy.save('product_images/work_table.jpeg', ContentFile(jpeg_bytes('white'))))
+        products = [
+            Product.objects.create(name=name, description='', price=1, quantity=1, category=self.category, image=name)
+            for name in names
+        ]
+
+        call_command('build_image_variants', '--rehash', stdout=StringIO())
+        images = [Product.objects.get(pk=product.pk).image.name for product in products]
+        self.assertEqual(images[0], images[1])
+        self.assertEqual(self.stored_files(), sorted({images[0], images[2]}))
+
+        # Nothing left to move, so a second run writes nothing.
+        call_command('build_image_variants', '--rehash', stdout=StringIO())
+        self.assertEqual(self.stored_files(), sorted({images[0], images[2]}))
+
+
+class CatalogImportExportTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = CustomUser.objects.create_superuser('import@example.com', 'password', first_name='Im', last_name='Port')
+        cls.user = CustomUser.objects.create_user('shopper@example.com', 'password', first_name='Sh', last_name='Opper')
+        cls.chairs = Category.objects.create(name='Chairs')
+        cls.chair = Product.objects.create(name='Chair', description='Oak', price=Decimal('5.00'), quantity=3, category=cls.chairs)
+
+    def setUp(self):
+        self.client = client_for(self.admin)
+
+    def upload(self, filename, content):
+        response = self.client.post(
+            '/products/import/', {'file': SimpleUploadedFile(filename, content)}, format='multipart',
+        )
+        self.assertEqual(response.status_code, 200, response.data)
+        return response.data
+
+    def export(self, file_format):
+        response = self.client.get(f'/products/export/?format={file_format}')
+        self.assertEqual(response.status_code, 200)
+        return b''.join(response.streaming_content).decode()
+
+    def test_csv_import_upserts_and_reports_rejected_rows(self):
+        cart = Cart.objects.create(user=self.user)
+        CartItem.objects.create(cart=cart, product=self.chair, quantity=2)
+        cart.recalculate_totals()
+
+        result = self.upload('products.csv', (
+            'id,name,description,price,quantity,category\n'
+            f'{self.chair.pk},Armchair,,7.50,4,Chairs\n'
+            ',Table,Pine,20,1,Tables\n'
+            ',Stool,Pine,-1,1,Tables\n'
+        ).encode())
+        self.assertEqual((result['created'], result['updated'], result['rejected']), (1, 1, 1))
+        self.assertEqual(result['errors'][0]['line'], 4)
+        self.assertIn('price', result['errors'][0]['errors'])
+
+        self.chair.refresh_from_db()
+        self.assertEqual((self.chair.name, self.chair.description, self.chair.price), ('Armchair', '', Decimal('7.50')))
+        self.assertEqual(Product.objects.get(name='Table').category.name, 'Tables')
+        # bulk_update() skips the signals; the import reprices carts itself.
+        cart.refresh_from_db()
+        self.assertEqual(cart.subtotal, Decimal('15.00'))
+
+    def test_ndjson_import_reuses_categories(self):
+        result = self.upload('products.ndjson', (
+            b'{"name": "Bench", "price": "12", "quantity": 2, "category": "Chairs"}\n'
+            b'not json\n'
+            b'{"name": "Desk", "price": "40", "quantity": 1, "category": "Desks"}\n'
+        ))
+        self.assertEqual((result['created'], result['rejected']), (2, 1))
+        self.assertEqual(result['errors'][0], {'line': 2, 'errors': 'Malformed row.'})
+        self.assertEqual(Category.objects.filter(name='Chairs').count(), 1)
+        self.assertEqual(Product.objects.get(name='Bench').category, self.chairs)
+
+    def test_queries_per_batch_do_not_grow_with_rows(self):
+        def import_queries(count):
+            rows = [(line, {'name': f'Stool {line}', 'price': '1', 'quantity': '1', 'category': 'Chairs'})
+                    for line in range(count)]
+            with CaptureQueriesContext(connection) as queries:
+                catalog_io.import_rows(rows)
+            return len(queries)
+
+        self.assertEqual(import_queries(5), import_queries(50))
+
+    def test_export_round_trips_through_import(self):
+        Product.objects.create(name='Sofa, two seats', description='Says "comfy"', price=90, quantity=1, category=self.chairs)
+        csv_export = self.export('csv')
+        self.assertEqual(csv_export.splitlines()[0], 'id,name,description,price,quantity,category')
+        rows = [json.loads(line) for line in self.export('ndjson').splitlines()]
+        self.assertEqual([row['name'] for row in rows], ['Chair', 'Sofa, two seats'])
+
+        before = list(Product.objects.values_list('id', 'name', 'description', 'price', 'quantity', 'category'))
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as f:
+            f.write(csv_export)
+        self.addCleanup(os.remove, f.name)
+        out = StringIO()
+        call_command('import_products', f.name, '--batch-size', '1', stdout=out)
+        self.assertEqual(out.getvalue().strip(), 'Created 0, updated 2, rejected 0.')
+        self.assertEqual(list(Product.objects.values_list('id', 'name', 'description', 'price', 'quantity', 'category')), before)
+
+        out = StringIO()
+        call_command('export_products', stdout=out)
+        self.assertEqual(out.getvalue(), csv_export)
+
+    def test_admin_only(self):
+        self.assertEqual(APIClient().get('/products/export/?format=csv').status_code, 401)
+        self.assertEqual(client_for(self.user).post('/products/import/', {}, format='multipart').status_code, 403)
+        self.assertEqual(self.client.post('/products/import/', {}, format='multipart').status_code, 400)
+
+
+class OrderExportTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = CustomUser.objects.create_superuser('finance@example.com', 'password', first_name='Fi', last_name='Nance')
+        category = Category.objects.create(name='Lamps')
+        cls.lamp = Product.objects.create(name='Lamp', description='', price=Decimal('5.00'), quantity=10, category=category)
+        cls.recent = Order.objects.create(
+            user=cls.admin, total_amount=15, shipping_address='x', payment_method='cod', coupon_code='SAVE',
+        )
+        OrderItem.objects.create(order=cls.recent, product=cls.lamp, quantity=2, price_at_order=Decimal('5.00'))
+        OrderItem.objects.create(order=cls.recent, product=cls.lamp, quantity=1, price_at_order=Decimal('5.00'))
+        cls.old = Order.objects.create(
+            user=cls.admin, total_amount=5, shipping_address='x', payment_method='cod', order_status='Shipped',
+        )
+        OrderItem.objects.create(order=cls.old, product=cls.lamp, quantity=1, price_at_order=Decimal('5.00'))
+        Order.objects.filter(pk=cls.old.pk).update(created_at=timezone.now() - timedelta(days=40))
+
+    def setUp(self):
+        self.client = client_for(self.admin)
+
+    def export(self, query=''):
+        response = self.client.get(f'/orders/export/?format=ndjson&{query}')
+        self.assertEqual(response.status_code, 200)
+        return [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+
+    def test_one_line_per_item(self):
+        rows = self.export()
+        self.assertEqual([row['order_id'] for row in rows], [self.recent.pk, self.recent.pk, self.old.pk])
+        self.assertEqual(
+            {key: rows[0][key] for key in ('customer_email', 'product_name', 'coupon_code', 'line_total')},
+            {'customer_email': 'finance@example.com', 'product_name': 'Lamp', 'coupon_code': 'SAVE', 'line_total': '10.00'},
+        )
+        response = self.client.get('/orders/export/?format=csv')
+        self.assertTrue(b''.join(response.streaming_content).startswith(b'order_id,created_at,customer_email'))
+
+    def test_filters(self):
+        self.assertEqual(len(self.export('coupon=SAVE')), 2)
+        self.assertEqual(len(self.export('status=Shipped')), 1)
+        day = (timezone.now() - timedelta(days=10)).date()
+        self.assertEqual({row['order_id'] for row in self.export(f'date_from={day}')}, {self.recent.pk})
+        self.assertEqual({row['order_id'] for row in self.export(f'date_to={day}')}, {self.old.pk})
+        self.assertEqual(self.client.get('/orders/export/?format=csv&date_from=nope').status_code, 400)
+        self.assertEqual(client_for(CustomUser.objects.create_user(
+            'clerk@example.com', 'password', first_name='Cl', last_name='Erk',
+        )).get('/orders/export/?format=csv').status_code, 403)
+
+    def test_queries_per_chunk(self):
+        # One streaming query, plus the email and product name lookups per chunk.
+        with CaptureQueriesContext(connection) as queries:
+            rows = list(order_export.export_rows(order_export.filter_items(), chunk_size=2))
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(len(queries), 1 + 2 * 2)
+
+    def test_command(self):
+        out = StringIO()
+        call_command('export_orders', '--status', 'Shipped', stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[1].startswith(f'{self.old.pk},'))
+
+
+class StockReservationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.ann = CustomUser.objects.create_user('ann@example.com', 'password', first_name='Ann', last_name='R')
+        cls.bob = CustomUser.objects.create_user('bob@example.com', 'password', first_name='Bob', last_name='R')
+        category = Category.objects.create(name='Rugs')
+        cls.rug = Product.objects.create(name='Rug', description='', price=Decimal('5.00'), quantity=3, category=category)
+
+    def setUp(self):
+        self.ann_client = client_for(self.ann)
+        self.bob_client = client_for(self.bob)
+
+    def add(self, client, quantity):
+        return client.post('/cart/', {'product_id': self.rug.pk, 'quantity': quantity}, format='json')
+
+    def stock(self):
+        self.rug.refresh_from_db()
+        return self.rug.quantity, self.rug.reserved
+
+    def expire_and_sweep(self):
+        StockReservation.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        call_command('release_expired_reservations', stdout=StringIO())
+
+    def test_carts_hold_stock(self):
+        self.assertEqual(self.add(self.ann_client, 2).status_code, 201)
+        self.assertEqual(self.add(self.bob_client, 2).status_code, 400)
+        self.assertEqual(self.add(self.bob_client, 1).status_code, 201)
+        self.assertEqual(self.stock(), (3, 3))
+        self.assertNotIn('reserved', self.bob_client.get(f'/product_detail/{self.rug.pk}/').data)
+
+        # Saving a stale product instance leaves the holds alone.
+        stale = Product.objects.get(pk=self.rug.pk)
+        stale.reserved = 0
+        stale.name = 'Runner'
+        stale.save()
+        self.assertEqual(self.stock(), (3, 3))
+
+        item = CartItem.objects.get(cart__user=self.bob)
+        self.assertEqual(self.bob_client.delete(f'/cart_items/{item.pk}/').status_code, 204)
+        self.assertEqual(self.stock(), (3, 2))
+        self.ann.delete()
+        self.assertEqual(self.stock(), (3, 0))
+
+    def test_expired_holds_are_released(self):
+        self.add(self.ann_client, 2)
+        self.expire_and_sweep()
+        self.assertEqual(self.stock(), (3, 0))
+        self.assertFalse(StockReservation.objects.exists())
+
+        # Ann's cart still lists the units, but they may be gone by checkout.
+        self.add(self.bob_client, 2)
+        with self.assertRaises(checkout.CheckoutError):
+            checkout.place_order(self.ann, 'x', 'cod')
+        checkout.place_order(self.bob, 'x', 'cod')
+        self.assertEqual(self.stock(), (1, 0))
+
+    def test_checkout_turns_holds_into_sales(self):
+        self.add(self.ann_client, 2)
+        self.add(self.bob_client, 1)
+        checkout.place_order(self.ann, 'x', 'cod')
+        self.assertEqual(self.stock(), (1, 1))
+        checkout.place_order(self.bob, 'x', 'cod')
+        self.assertEqual(self.stock(), (0, 0))
+
+    def test_sweeper_leaves_changed_batches_to_the_next_pass(self):
+        target = 'ecommerce_app.management.commands.release_expired_reservations'
+        with mock.patch(f'{target}.reservations.release_expired', side_effect=reservations.ReservationChanged) as release:
+            call_command('release_expired_reservations', stdout=StringIO(), stderr=StringIO())
+        self.assertEqual(release.call_count, 1)
+
+        passes = [reservations.ReservationChanged(), 2, 0, KeyboardInterrupt()]
+        with mock.patch(f'{target}.reservations.release_expired', side_effect=passes), \
+                mock.patch(f'{target}.time.sleep') as sleep, self.assertRaises(KeyboardInterrupt):
+            call_command('release_expired_reservations', '--loop', '--interval', '5', stdout=StringIO(), stderr=StringIO())
+        self.assertEqual(sleep.call_args_list, [mock.call(5.0), mock.call(5.0)])
+
+
+class RatingAggregateTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user('critic@example.com', 'password', first_name='Cri', last_name='Tic')
+        category = Category.objects.create(name='Clocks')
+        cls.wall = Product.objects.create(name='Wall clock', description='', price=5, quantity=3, category=category)
+        cls.desk = Product.objects.create(name='Desk clock', description='', price=5, quantity=3, category=category)
+
+    def setUp(self):
+        cache.clear()
+        self.client = client_for(self.user)
+
+    def review(self, product, rating):
+        return ProductReview.objects.create(user=self.user, product=product, rating=rating, review_text='x')
+
+    def listed(self, query):
+        response = self.client.get(f'/product_list/?{query}')
+        self.assertEqual(response.status_code, 200)
+        return [product['id'] for product in response.data['results']]
+
+    def test_review_writes_update_the_aggregates(self):
+        self.review(self.desk, 4)
+        review = self.review(self.desk, 5)
+        self.desk.refresh_from_db()
+        self.assertEqual(
+            (self.desk.rating_count, self.desk.rating_sum, self.desk.rating_average, self.desk.rating_4, self.desk.rating_5),
+            (2, 9, 4.5, 1, 1),
+        )
+        review.rating = 1
+        review.save()
+        self.desk.refresh_from_db()
+        self.assertEqual((self.desk.rating_sum, self.desk.rating_1, self.desk.rating_5, self.desk.rating_average), (5, 1, 0, 2.5))
+        review.delete()
+        self.desk.refresh_from_db()
+        self.assertEqual((self.desk.rating_count, self.desk.rating_average, self.desk.rating_4), (1, 4.0, 1))
+
+        # A stale instance doesn't write the counters back.
+        stale = Product.objects.get(pk=self.desk.pk)
+        self.review(self.desk, 3)
+        stale.save()
+        self.desk.refresh_from_db()
+        self.assertEqual(self.desk.rating_count, 2)
+
+    def test_rating_field(self):
+        VerifiedPurchase.objects.create(user=self.user, product=self.desk)
+        response = self.client.post(
+            '/reviews/create/', {'product': self.desk.pk, 'rating': 4, 'review_text': 'ok'}, format='json',
+        )
+        self.assertEqual(response.status_code, 201, response.data)
+        data = self.client.get(f'/product_detail/{self.desk.pk}/').data
+        self.assertEqual(data['rating'], {'average': 4.0, 'count': 1, 'histogram': {'1': 0, '2': 0, '3': 0, '4': 1, '5': 0}})
+        self.assertNotIn('rating_sum', data)
+
+    def test_min_rating_and_ordering(self):
+        self.assertEqual(self.listed('ordering=rating'), [self.wall.pk, self.desk.pk])
+        self.review(self.desk, 4)
+        self.review(self.wall, 2)
+        self.assertEqual(self.listed('ordering=rating'), [self.desk.pk, self.wall.pk])
+        self.assertEqual(self.listed('min_rating=3'), [self.desk.pk])
+        self.assertEqual(self.listed('ordering=rating&cursor='), [self.desk.pk, self.wall.pk])
+        self.assertEqual(self.client.get('/product_list/?min_rating=x').status_code, 400)
+
+
+class VerifiedPurchaseTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user('buyer@example.com', 'password', first_name='Bu', last_name='Yer')
+        category = Category.objects.create(name='Mirrors')
+        cls.mirror = Product.objects.create(name='Mirror', description='', price=5, quantity=10, category=category)
+        cls.frame = Product.objects.create(name='Frame', description='', price=5, quantity=10, category=category)
+
+    def setUp(self):
+        self.client = client_for(self.user)
+
+    def buy(self, product):
+        self.client.post('/cart/', {'product_id': product.pk, 'quantity': 1}, format='json')
+        checkout.place_order(self.user, 'x', 'cod')
+
+    def post_review(self, product):
+        return self.client.post('/reviews/create/', {'product': product.pk, 'rating': 4, 'review_text': 'ok'}, format='json')
+
+    def test_only_purchasers_review_once(self):
+        self.assertEqual(self.post_review(self.mirror).status_code, 403)
+        self.buy(self.mirror)
+        self.buy(self.mirror)
+        self.assertEqual(VerifiedPurchase.objects.count(), 1)
+
+        # The purchase lookup is one indexed read; no order history scan.
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.post_review(self.mirror).status_code, 201)
+        self.assertFalse([query for query in queries if 'ecommerce_app_order' in query['sql']])
+        self.assertEqual(self.post_review(self.mirror).status_code, 400)
+        self.assertEqual(self.post_review(self.frame).status_code, 403)
+        self.assertEqual(ProductReview.objects.count(), 1)
+        self.assertEqual(VerifiedPurchase.objects.get().review, ProductReview.objects.get())
+
+    def test_backfill(self):
+        for _ in range(3):
+            order = Order.objects.create(user=self.user, total_amount=1, shipping_address='x', payment_method='cod')
+            OrderItem.objects.create(order=order, product=self.mirror, quantity=1, price_at_order=1)
+        first = ProductReview.objects.create(user=self.user, product=self.mirror, rating=3, review_text='first')
+        ProductReview.objects.create(user=self.user, product=self.mirror, rating=3, review_text='again')
+        ProductReview.objects.create(user=self.user, product=self.frame, rating=3, review_text='never bought')
+
+        call_command('backfill_verified_purchases', '--batch-size', '1', stdout=StringIO())
+        self.assertEqual(list(VerifiedPurchase.objects.values_list('product', 'review')), [(self.mirror.pk, first.pk)])
+        call_command('backfill_verified_purchases', stdout=StringIO())
+        self.assertEqual(VerifiedPurchase.objects.count(), 1)
+
+
+class CatalogFacetTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user('browser@example.com', 'password', first_name='Bro', last_name='Wser')
+        cls.chairs = Category.objects.create(name='Chairs')
+        cls.tables = Category.objects.create(name='Tables')
+        cls.oak_chair = Product.objects.create(name='oak chair', description='wood', price=20, quantity=2, category=cls.chairs)
+        Product.objects.create(name='pine chair', description='wood', price=60, quantity=0, category=cls.chairs)
+        Product.objects.create(name='oak table', description='wood', price=600, quantity=2, category=cls.tables)
+
+    def setUp(self):
+        cache.clear()
+        self.client = client_for(self.user)
+
+    def facets(self, query=''):
+        response = self.client.get(f'/product_list/facets/?{query}')
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def product_queries(self, query=''):
+        with CaptureQueriesContext(connection) as queries:
+            self.facets(query)
+        return [query for query in queries if 'ecommerce_app_product' in query['sql']]
+
+    def test_counts(self):
+        data = self.facets()
+        self.assertEqual(data['count'], 3)
+        self.assertEqual([(row['name'], row['count']) for row in data['categories']], [('Chairs', 2), ('Tables', 1)])
+        self.assertEqual([row['count'] for row in data['price_buckets']], [1, 0, 1, 0, 0, 1])
+        self.assertEqual(data['price_buckets'][-1], {'min': '500', 'max': None, 'count': 1})
+        self.assertEqual(data['in_stock'], {'true': 2, 'false': 1})
+
+    def test_each_facet_ignores_its_own_filter(self):
+        self.assertEqual(len(self.product_queries(f'category={self.chairs.pk}&in_stock=true&q=oak')), 1)
+        data = self.facets(f'category={self.chairs.pk}&in_stock=true&q=oak')
+        self.assertEqual(data['count'], 1)
+        self.assertEqual([(row['name'], row['count']) for row in data['categories']], [('Chairs', 1), ('Tables', 1)])
+        self.assertEqual(data['in_stock'], {'true': 1, 'false': 0})
+
+        data = self.facets('min_price=10&max_price=100')
+        self.assertEqual(data['count'], 2)
+        self.assertEqual([row['count'] for row in data['price_buckets']], [1, 0, 1, 0, 0, 1])
+        self.assertEqual(self.client.get('/product_list/facets/?min_price=x&max_price=1').status_code, 400)
+        self.assertEqual(self.client.get('/product_list/?category=x').status_code, 400)
+
+    def test_fully_reserved_products_are_out_of_stock(self):
+        self.assertEqual(self.facets()['in_stock'], {'true': 2, 'false': 1})
+        shopper = client_for(CustomUser.objects.create_user('holder@example.com', 'password', first_name='Ho', last_name='Lder'))
+
+        # A hold that leaves units available keeps the cached counts.
+        with self.captureOnCommitCallbacks(execute=True):
+            shopper.post('/cart/', {'product_id': self.oak_chair.pk, 'quantity': 1}, format='json')
+        self.assertEqual(self.product_queries(), [])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            shopper.post('/cart/', {'product_id': self.oak_chair.pk, 'quantity': 1}, format='json')
+        self.assertEqual(self.facets()['in_stock'], {'true': 1, 'false': 2})
+        in_stock = self.client.get('/product_list/?in_stock=true').data['results']
+        self.assertEqual([product['name'] for product in in_stock], ['oak table'])
+        self.assertEqual(self.client.get('/product_list/?in_stock=false').data['count'], 2)
+
+        item = CartItem.objects.get(product=self.oak_chair)
+        with self.captureOnCommitCallbacks(execute=True):
+            shopper.patch(f'/cart_items/{item.pk}/', {'quantity': 1}, format='json')
+        self.assertEqual(self.facets()['in_stock'], {'true': 2, 'false': 1})
+
+
+class ConditionalGetTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = CustomUser.objects.create_superuser('etags@example.com', 'password', first_name='E', last_name='Tag')
+        category = Category.objects.create(name='Shelves')
+        cls.shelf = Product.objects.create(name='Shelf', description='', price=5, quantity=3, category=category)
+        VerifiedPurchase.objects.create(user=cls.admin, product=cls.shelf)
+        ProductReview.objects.create(user=cls.admin, product=cls.shelf, rating=4, review_text='Sturdy')
+
+    def setUp(self):
+        cache.clear()
+        self.client = client_for(self.admin)
+
+    def test_not_modified(self):
+        for url in ('/product_list/', f'/product_detail/{self.shelf.pk}/', '/categories/', '/reviews/'):
+            with self.subTest(url=url):
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+                with CaptureQueriesContext(connection) as queries:
+                    revalidated = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+                self.assertEqual(revalidated.status_code, 304)
+                if url.startswith('/product'):
+                    # Answered from the catalog cache.
+                    self.assertFalse([query for query in queries if 'ecommerce_app_product' in query['sql']])
+
+    def test_etag_follows_the_query_and_the_data(self):
+        etag = self.client.get('/product_list/')['ETag']
+        self.assertNotEqual(self.client.get('/product_list/?page_size=1')['ETag'], etag)
+
+        # Checkout changes stock with update(), bypassing Product.save().
+        self.client.post('/cart/', {'product_id': self.shelf.pk, 'quantity': 1}, format='json')
+        with self.captureOnCommitCallbacks(execute=True):
+            checkout.place_order(self.admin, 'x', 'cod')
+        response = self.client.get('/product_list/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['results'][0]['quantity'], 2)
+
+    def test_last_modified_only_on_details(self):
+        response = self.client.get(f'/product_detail/{self.shelf.pk}/')
+        self.assertEqual(
+            self.client.get(f'/product_detail/{self.shelf.pk}/', HTTP_IF_MODIFIED_SINCE=response['Last-Modified']).status_code,
+            304,
+        )
+        # A deletion leaves the latest timestamp of a list where it was.
+        Product.objects.create(name='Rack', description='', price=5, quantity=3, category=self.shelf.category)
+        response = self.client.get('/product_list/')
+        self.assertNotIn('Last-Modified', response)
+        Product.objects.get(name='Rack').delete()
+        response = self.client.get('/product_list/', HTTP_IF_MODIFIED_SINCE=http_date(time.time() + 60))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['count'], 1)
+
+    def test_review_etag_follows_the_product_name(self):
+        etag = self.client.get('/reviews/')['ETag']
+        self.shelf.name = 'Bookshelf'
+        self.shelf.save()
+        response = self.client.get('/reviews/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['results'][0]['product_name'], 'Bookshelf')
+
+    def test_validators_survive_cache_eviction(self):
+        # Recomputed from the database, the validators match the cached ones.
+        etag = self.client.get('/product_list/?q=shelf')['ETag']
+        cache.clear()
+        self.assertEqual(self.client.get('/product_list/?q=shelf', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertEqual(self.client.get('/product_detail/999/').status_code, 404)
+
+
+class CachedJWTAuthenticationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user('token@example.com', 'password', first_name='To', last_name='Ken')
+        cls.admin = CustomUser.objects.create_superuser('staff@example.com', 'password', first_name='St', last_name='Aff')
+
+    def setUp(self):
+        user_cache.clear()
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(self.user).access_token}')
+
+    def user_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get(url).status_code, 200)
+        return [query for query in queries if 'FROM "ecommerce_app_customuser"' in query['sql']]
+
+    def test_user_is_read_once(self):
+        self.assertEqual(len(self.user_queries('/cart/summary/')), 1)
+        self.assertEqual(self.user_queries('/cart/summary/'), [])
+        self.assertEqual(self.client.get('/profile-update/').data['email'], 'token@example.com')
+
+    def test_saves_and_deletes_evict(self):
+        self.client.get('/cart/summary/')
+        self.assertEqual(self.client.patch('/profile-update/', {'first_name': 'Tim'}, format='json').status_code, 200)
+        self.assertEqual(self.client.get('/profile-update/').data['first_name'], 'Tim')
+        client_for(self.admin).patch(f'/users/{self.user.pk}/', {'last_name': 'Bell'}, format='json')
+        self.assertEqual(self.client.get('/profile-update/').data['last_name'], 'Bell')
+
+        self.user.refresh_from_db()
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.client.get('/cart/summary/').status_code, 401)
+        self.user.delete()
+        self.assertEqual(self.client.get('/cart/summary/').status_code, 401)
+
+    def test_profile_updates_do_not_write_the_cached_user_back(self):
+        self.client.get('/cart/summary/')
+        # Changed by another process: this one's cache doesn't hear of it.
+        CustomUser.objects.filter(pk=self.user.pk).update(password=make_password('new password'), last_name='Smith')
+        self.assertEqual(self.client.patch('/profile-update/', {'first_name': 'Z'}, format='json').status_code, 200)
+        self.user.refresh_from_db()
+        self.assertEqual((self.user.first_name, self.user.last_name), ('Z', 'Smith'))
+        self.assertTrue(self.user.check_password('new password'))
+        self.assertFalse(self.user.check_password('password'))
+
+        CustomUser.objects.filter(pk=self.user.pk).update(is_active=False)
+        self.client.patch('/profile-update/', {'first_name': 'Y'}, format='json')
+        self.user.refresh_from_db()
+        self.assertFalse(self.user.is_active)
+
+    @override_settings(JWT_USER_CACHE_TTL=60, JWT_USER_CACHE_SIZE=2)
+    def test_entries_expire_and_are_bounded(self):
+        with mock.patch('ecommerce_app.authentication.time.monotonic', return_value=1000):
+            user_cache.put(1, 'one')
+            user_cache.put(2, 'two')
+            self.assertEqual(user_cache.get(1), 'one')
+            user_cache.put(3, 'three')
+            # 2 was the least recently used.
+            self.assertEqual([user_cache.get(user_id) for user_id in (1, 2, 3)], ['one', None, 'three'])
+        with mock.patch('ecommerce_app.authentication.time.monotonic', return_value=1060):
+            self.assertIsNone(user_cache.get(1))
+
+
+@override_settings(METRICS_TOKEN='scrape-token')
+class MetricsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user('metrics@example.com', 'password', first_name='Me', last_name='Trics')
+        category = Category.objects.create(name='Stools')
+        Product.objects.create(name='Stool', description='', price=5, quantity=3, category=category)
+
+    def setUp(self):
+        cache.clear()
+
+    def scrape(self):
+        response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer scrape-token')
+        self.assertEqual(response.status_code, 200)
+        return response.content.decode().splitlines()
+
+    def sample(self, lines, name, route):
+        for line in lines:
+            if line.startswith(name + '{') and f'route="{route}"' in line and 'method="GET"' in line:
+                return float(line.split()[-1])
+        return 0
+
+    def test_per_route_metrics(self):
+        before = self.scrape()
+        client = client_for(self.user)
+        for _ in range(3):
+            client.get('/product_list/?q=stool')
+        self.client.get('/no-such-page/')
+        after = self.scrape()
+
+        def grew(name):
+            return self.sample(after, name, 'product_list/') - self.sample(before, name, 'product_list/')
+
+        self.assertEqual(grew('http_request_duration_seconds_count'), 3)
+        self.assertGreater(grew('http_request_db_queries_total'), 0)
+        self.assertGreater(grew('http_request_serializer_seconds_total'), 0)
+        self.assertTrue(any('view="unmatched"' in line for line in after))
+        self.assertTrue(any('le="+Inf"' in line for line in after))
+
+    def test_serializers_are_timed_by_the_mixin(self):
+        # DRF's own classes are left alone.
+        self.assertIs(serializers.Serializer.data, serializers.Serializer.__dict__['data'])
+        self.assertEqual(serializers.Serializer.data.fget.__module__, 'rest_framework.serializers')
+        self.assertTrue(issubclass(ProductSerializer, metrics.TimedSerializerMixin))
+
+        # Nested serializers and list items are counted once.
+        request_stats = metrics.RequestStats()
+        token = metrics.current_request.set(request_stats)
+        self.addCleanup(metrics.current_request.reset, token)
+        with mock.patch('ecommerce_app.metrics.time.perf_counter', side_effect=[0.0, 0.25]):
+            ProductSerializer(Product.objects.all(), many=True).data
+        self.assertEqual(request_stats.serializer_time, 0.25)
+
+    def test_token_required(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer nope').status_code, 403)
+        with override_settings(METRICS_TOKEN=None):
+            self.assertEqual(self.client.get('/metrics').status_code, 403)
+
+
+class BenchmarkApiTests(TransactionTestCase):
+    def benchmark(self, *args):
+        output = os.path.join(tempfile.mkdtemp(), 'results.json')
+        self.addCleanup(shutil.rmtree, os.path.dirname(output))
+        call_command(
+            'benchmark_api', '--concurrency', '2', '--requests', '6', '--warmup', '1', '--products', '100',
+            '--output', output, *args, stdout=StringIO(),
+        )
+        with open(output) as f:
+            return json.load(f)
+
+    def test_every_scenario_runs_cleanly(self):
+        for interface in ('wsgi', 'asgi'):
+            with self.subTest(interface=interface):
+                results = self.benchmark('--interface', interface)
+                self.assertEqual(list(results['scenarios']), benchmark_api.SCENARIOS)
+                for scenario, stats in results['scenarios'].items():
+                    self.assertEqual((stats['requests'], stats['errors']), (6, 0), scenario)
+                self.assertEqual(results['products'], 100)
+        # The runs used scratch databases.
+        self.assertFalse(Product.objects.exists())
+
+    def test_replicas_read_the_benchmark_database(self):
+        # An empty file: reads that reached it would fail.
+        replica = add_sqlite_database(self.addCleanup, 'replica0')
+        with override_settings(DATABASE_REPLICAS=['replica0']):
+            results = self.benchmark('--scenarios', 'catalog', 'search', 'history')
+        self.assertEqual(results['replicas'], 1)
+        for scenario, stats in results['scenarios'].items():
+            self.assertEqual(stats['errors'], 0, scenario)
+        self.assertEqual(connections['replica0'].settings_dict['NAME'], replica)
+        self.assertFalse(os.path.exists(replica))
+
+    def test_compare(self):
+        first = os.path.join(tempfile.mkdtemp(), 'first.json')
+        self.addCleanup(shutil.rmtree, os.path.dirname(first))
+        with open(first, 'w') as f:
+            json.dump(self.benchmark('--scenarios', 'catalog'), f)
+        out = StringIO()
+        call_command(
+            'benchmark_api', '--scenarios', 'catalog', '--requests', '4', '--products', '100', '--compare', first, stdout=out,
+        )
+        self.assertIn(f'Compared with {first}', out.getvalue())
+        self.assertRegex(out.getvalue(), r'catalog +4 +0 .*%\)')
+
+
+class SeedDataTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        call_command(
+            'seed_data', '--products', '60', '--categories', '5', '--users', '30', '--orders', '80', '--coupons', '5',
+            '--review-rate', '0.5', '--coupon-rate', '0.5', '--batch-size', '7', stdout=StringIO(),
+        )
+
+    def test_counts(self):
+        self.assertEqual(
+            [model.objects.count() for model in (Category, Product, CustomUser, Order, Coupon)], [5, 60, 30, 80, 5],
+        )
+        self.assertTrue(Cart.objects.exists())
+        self.assertTrue(ProductReview.objects.exists())
+        self.assertTrue(CouponRedemption.objects.exists())
+
+    def test_derived_data_matches_what_the_app_keeps(self):
+        prices = dict(Product.objects.values_list('pk', 'price'))
+        for cart in Cart.objects.all():
+            items = list(cart.items.values_list('product_id', 'quantity'))
+            self.assertEqual(cart.subtotal, sum(prices[product_id] * quantity for product_id, quantity in items))
+            self.assertEqual(cart.item_count, sum(quantity for _, quantity in items))
+
+        order_totals = {}
+        for order_id, price, quantity in OrderItem.objects.values_list('order_id', 'price_at_order', 'quantity'):
+            order_totals[order_id] = order_totals.get(order_id, 0) + price * quantity
+        for order in Order.objects.all():
+            items_total = order_totals[order.pk]
+            self.assertEqual(order.total_amount_without_coupon, items_total)
+            self.assertEqual(order.total_amount, items_total - (order.discounted_amount or 0))
+            self.assertEqual(order.coupon_applied, CouponRedemption.objects.filter(order_id=order.pk).exists())
+
+        for product in Product.objects.all():
+            ratings = list(ProductReview.objects.filter(product=product).values_list('rating', flat=True))
+            self.assertEqual((product.rating_count, product.rating_sum), (len(ratings), sum(ratings)))
+            self.assertEqual(
+                [getattr(product, f'rating_{rating}') for rating in range(1, 6)],
+                [ratings.count(rating) for rating in range(1, 6)],
+            )
+
+        bought = set(OrderItem.objects.values_list('order__user_id', 'product_id'))
+        self.assertEqual(set(VerifiedPurchase.objects.values_list('user_id', 'product_id')), bought)
+        self.assertEqual(
+            set(VerifiedPurchase.objects.exclude(review=None).values_list('review__user_id', 'review__product_id', 'review')),
+            set(ProductReview.objects.values_list('user_id', 'product_id', 'id')),
+        )
+
+    def test_search_index_is_rebuilt(self):
+        product = Product.objects.order_by('id').last()
+        self.assertIn(product, search.search(Product.objects.all(), name=product.name.split()[-1]))
+
+    def test_seeds(self):
+        with self.assertRaisesMessage(CommandError, 'Seed 1 is already in this database'):
+            call_command('seed_data', '--products', '1', '--categories', '1', '--users', '1', stdout=StringIO())
+        call_command(
+            'seed_data', '--seed', '2', '--products', '3', '--categories', '1', '--users', '2', '--orders', '4',
+            stdout=StringIO(),
+        )
+        self.assertEqual(CustomUser.objects.filter(email__startswith='seed2-').count(), 2)
+        self.assertEqual(Product.objects.count(), 63)
+
+
+class ReplicaRoutingTests(TransactionTestCase):
+    """
+    Runs against a real replica file, kept up to date only when the test
+    calls snapshot_replica, so replica lag is under the test's control.
+    """
+
+    def setUp(self):
+        cache.clear()
+        add_sqlite_database(self.addCleanup, 'replica0')
+        replicas = override_settings(DATABASE_REPLICAS=['replica0'])
+        replicas.enable()
+        self.addCleanup(replicas.disable)
+
+        self.user = CustomUser.objects.create_user('reader@example.com', 'password', first_name='Re', last_name='Ader')
+        category = Category.objects.create(name='Lamps')
+        self.lamp = Product.objects.create(name='Lamp', description='', price=5, quantity=9, category=category)
+        self.review('Bright')
+        self.snapshot()
+
+    def snapshot(self):
+        call_command('snapshot_replica', stdout=StringIO())
+        # The test client keeps connections open across requests; an open one
+        # would go on reading the replaced file.
+        connections['replica0'].close()
+
+    def review(self, text):
+        ProductReview.objects.create(user=self.user, product=self.lamp, rating=4, review_text=text)
+
+    def token_client(self, user):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(user).access_token}')
+        return client
+
+    def reviews_seen(self, client):
+        return [review['review_text'] for review in client.get('/reviews/').data['results']]
+
+    def test_safe_requests_read_the_replica(self):
+        client = self.token_client(self.user)
+        self.review('Dim')
+        self.assertEqual(self.reviews_seen(client), ['Bright'])
+        self.snapshot()
+        self.assertEqual(sorted(self.reviews_seen(client)), ['Bright', 'Dim'])
+
+    def test_writers_are_pinned_to_the_primary(self):
+        writer = self.token_client(self.user)
+        other = self.token_client(
+            CustomUser.objects.create_user('other@example.com', 'password', first_name='Ot', last_name='Her'),
+        )
+        self.assertEqual(writer.post('/cart/', {'product_id': self.lamp.pk, 'quantity': 1}, format='json').status_code, 201)
+        self.review('Dim')
+        self.assertEqual(sorted(self.reviews_seen(writer)), ['Bright', 'Dim'])
+        self.assertEqual(self.reviews_seen(other), ['Bright'])
+
+        with override_settings(REPLICA_PIN_SECONDS=0):
+            writer.post('/cart/', {'product_id': self.lamp.pk, 'quantity': 1}, format='json')
+        self.assertEqual(self.reviews_seen(writer), ['Bright'])
+
+    def test_order_history_on_the_default_shard_reads_the_replica(self):
+        client = self.token_client(self.user)
+        Order.objects.create(user=self.user, total_amount=5, shipping_address='x', payment_method='card')
+        self.assertEqual(client.get('/order_history/').data['count'], 0)
+        self.snapshot()
+        self.assertEqual(client.get('/order_history/').data['count'], 1)
+
+    def test_writes_that_bypass_the_router_pin(self):
+        def view(request):
+            # Like the sharded tables: an explicit alias, no router involved.
+            Product.objects.using(DEFAULT_DB_ALIAS).filter(pk=self.lamp.pk).update(name='Desk lamp')
+            return HttpResponse()
+
+        factory = RequestFactory(HTTP_AUTHORIZATION='Bearer token')
+        middleware = routers.PrimaryPinningMiddleware(view)
+        middleware(factory.delete('/'))
+        self.assertTrue(middleware.start(factory.get('/'))[1].pinned)
+        self.assertFalse(middleware.start(RequestFactory(HTTP_AUTHORIZATION='Bearer other').get('/'))[1].pinned)
+
+    def test_router(self):
+        router = routers.PrimaryReplicaRouter()
+        # Outside a request, e.g. in commands and workers.
+        self.assertEqual(router.db_for_read(Product), DEFAULT_DB_ALIAS)
+        token = routers.current_routing.set(routers.RequestRouting(False))
+        self.addCleanup(routers.current_routing.reset, token)
+        self.assertEqual(router.db_for_read(Product), 'replica0')
+        with transaction.atomic():
+            self.assertEqual(router.db_for_read(Product), DEFAULT_DB_ALIAS)
+        self.assertEqual(router.db_for_read(Product, instance=self.lamp), DEFAULT_DB_ALIAS)
+        self.assertEqual(router.db_for_write(Product), DEFAULT_DB_ALIAS)
+        # The first write moves the rest of the request to the primary.
+        self.assertEqual(router.db_for_read(Product), DEFAULT_DB_ALIAS)
+        self.assertFalse(router.allow_migrate('replica0', 'ecommerce_app'))
+
+
+@override_settings(DATABASE_SHARDS=[DEFAULT_DB_ALIAS, 'shard1', 'shard2'])
+class ShardingTests(TransactionTestCase):
+    """
+    Runs with two more shards, each a SQLite file of its own next to the
+    test database.
+    """
+    shards = [DEFAULT_DB_ALIAS, 'shard1', 'shard2']
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        for alias in cls.shards[1:]:
+            add_sqlite_database(
+                cls.addClassCleanup, alias,
+                ENGINE='ecommerce_project.sqlite_backend', OPTIONS={'transaction_mode': 'IMMEDIATE'},
+            )
+            call_command('migrate', database=alias, verbosity=0)
+
+    def setUp(self):
+        for alias in self.shards[1:]:
+            # Like the test database's own flush, this runs post_migrate, which
+            # puts the id sequences back at the start of the shard's range.
+            self.addCleanup(call_command, 'flush', database=alias, interactive=False, verbosity=0)
+
+        self.admin = CustomUser.objects.create_superuser('shards@example.com', 'password', first_name='Sh', last_name='Ard')
+        category = Category.objects.create(name='Beds')
+        self.bed = Product.objects.create(name='Bed', description='', price=100, quantity=100, category=category)
+        # One customer per shard.
+        self.customers = {}
+        for i in range(50):
+            user = CustomUser.objects.create_user(f'sleeper{i}@example.com', 'password', first_name='Sl', last_name='Eep')
+            self.customers.setdefault(sharding.shard_for_user(user), user)
+            if len(self.customers) == len(self.shards):
+                break
+
+    def buy(self, user):
+        client = client_for(user)
+        client.post('/cart/', {'product_id': self.bed.pk, 'quantity': 1}, format='json')
+        response = client.post('/place_order/', {'shipping_address': 'x', 'payment_method': 'card'}, format='json')
+        self.assertEqual(response.status_code, 201, response.data)
+        return Order.objects.using(sharding.shard_for_user(user)).get(user=user)
+
+    def test_placement(self):
+        self.assertEqual(set(self.customers), set(self.shards))
+        for alias, user in self.customers.items():
+            self.assertEqual(sharding.shard_for_user(user.pk), alias)
+            client_for(user).post('/cart/', {'product_id': self.bed.pk, 'quantity': 1}, format='json')
+            # Stored on the user's shard only.
+            self.assertEqual(
+                [Cart.objects.using(shard).filter(user=user).exists() for shard in self.shards],
+                [shard == alias for shard in self.shards],
+            )
+
+    def test_id_ranges(self):
+        for index, (alias, user) in enumerate(sorted(self.customers.items(), key=lambda item: self.shards.index(item[0]))):
+            order = self.buy(user)
+            self.assertEqual(order.pk // sharding.ID_SPAN, self.shards.index(alias))
+            self.assertEqual(sharding.shard_for_id(order.pk), alias)
+        self.assertIsNone(sharding.shard_for_id(len(self.shards) * sharding.ID_SPAN))
+        self.assertIsNone(sharding.shard_for_id('x'))
+
+        # Migrating again leaves the sequences where they are.
+        call_command('migrate', database='shard2', verbosity=0)
+        order = Order.objects.using('shard2').create(
+            user=self.customers['shard2'], total_amount=1, shipping_address='x', payment_method='card',
+        )
+        self.assertEqual(order.pk, 2 * sharding.ID_SPAN + 2)
+
+    def test_orders_across_shards(self):
+        orders = {alias: self.buy(user) for alias, user in self.customers.items()}
+        for alias, user in self.customers.items():
+            history = client_for(user).get('/order_history/').data['results']
+            self.assertEqual([order['id'] for order in history], [orders[alias].pk])
+
+        # The admin list merges every shard, newest first, on every page.
+        newest_first = sorted(orders.values(), key=lambda order: order.created_at, reverse=True)
+        admin = client_for(self.admin)
+        first_page = admin.get('/orders/?page_size=2')
+        second_page = admin.get('/orders/?page_size=2&page=2')
+        self.assertEqual(first_page.data['count'], 3)
+        self.assertEqual(
+            [order['id'] for order in first_page.data['results'] + second_page.data['results']],
+            [order.pk for order in newest_first],
+        )
+        for order in orders.values():
+            self.assertEqual(admin.get(f'/orders/{order.pk}/').data['id'], order.pk)
+        self.assertEqual(
+            [row['order_id'] for row in order_export.export_rows(order_export.filter_items())],
+            sorted(order.pk for order in orders.values()),
+        )
+
+    def test_sharded_queryset(self):
+        for user in self.customers.values():
+            self.buy(user)
+        orders = sharding.ShardedQuerySet.over_shards(Order.objects.order_by('-created_at', '-id'))
+        expected = sorted(
+            (order for alias in self.shards for order in Order.objects.using(alias).all()),
+            key=lambda order: (order.created_at, order.pk), reverse=True,
+        )
+        self.assertEqual(orders.count(), 3)
+        self.assertEqual(list(orders), expected)
+        self.assertEqual(orders[1:3], expected[1:3])
+        self.assertEqual(orders[0], expected[0])
+        user = self.customers['shard1']
+        self.assertEqual(list(orders.filter(user=user)), [order for order in expected if order.user_id == user.pk])
+
+    def test_atomic_spans_both_databases(self):
+        user = self.customers['shard1']
+        with self.assertRaises(ZeroDivisionError):
+            with sharding.atomic('shard1'):
+                Cart.objects.using('shard1').create(user=user)
+                Product.objects.filter(pk=self.bed.pk).update(quantity=0)
+                1 / 0
+        self.assertFalse(Cart.objects.using('shard1').exists())
+        self.assertEqual(Product.objects.get().quantity, 100)
+
+    def test_a_failed_shard_commit_leaves_the_default_writes(self):
+        # The accepted window described in sharding.atomic().
+        user = self.customers['shard1']
+        client = client_for(user)
+        client.post('/cart/', {'product_id': self.bed.pk, 'quantity': 1}, format='json')
+        client.raise_request_exception = False
+        with mock.patch.object(connections['shard1'], '_commit', side_effect=OperationalError('disk I/O error')), \
+                self.assertLogs('django.request', 'ERROR'):
+            response = client.post('/place_order/', {'shipping_address': 'x', 'payment_method': 'card'}, format='json')
+        self.assertEqual(response.status_code, 500)
+        self.assertFalse(Order.objects.using('shard1').exists())
+        self.assertEqual(Product.objects.get().quantity, 99)
+        self.assertTrue(VerifiedPurchase.objects.filter(user=user).exists())
+        self.assertEqual(OutboxEmail.objects.count(), 2)
+
+    def test_deletes_cascade_to_the_shards(self):
+        user = self.customers['shard2']
+        self.buy(user)
+        client_for(user).post('/cart/', {'product_id': self.bed.pk, 'quantity': 1}, format='json')
+        user.delete()
+        self.assertFalse(Order.objects.using('shard2').exists())
+        self.assertFalse(OrderItem.objects.using('shard2').exists())
+        self.assertFalse(Cart.objects.using('shard2').exists())
+
+
+class ConcurrentCheckoutTests(TransactionTestCase):
+    def setUp(self):
+        self.category = Category.objects.create(name='Chairs')
+        self.clients = [
+            client_for(CustomUser.objects.create_user(f'buyer{i}@example.com', 'password', first_name='B', last_name='Y'))
+            for i in range(4)
+        ]
+
+    def shop(self, product, rounds):
+        def work(client):
+            statuses = []
+            for _ in range(rounds):
+                statuses.append(client.post('/cart/', {'product_id': product.pk, 'quantity': 1}, format='json').status_code)
+                statuses.append(client.post(
+                    '/place_order/', {'shipping_address': 'x', 'payment_method': 'card'}, format='json',
+                ).status_code)
+            return statuses
+        return sum(run_concurrently(self.clients, work), [])
+
+    def test_every_checkout_succeeds(self):
+        product = Product.objects.create(name='Chair', description='', price=10, quantity=100, category=self.category)
+        statuses = self.shop(product, 10)
+        self.assertEqual(set(statuses), {201}, statuses)
+        product.refresh_from_db()
+        self.assertEqual((product.quantity, product.reserved), (60, 0))
+        self.assertEqual(Order.objects.count(), 40)
+
+    def test_no_overselling(self):
+        product = Product.objects.create(name='Chair', description='', price=10, quantity=10, category=self.category)
+        statuses = self.shop(product, 5)
+        self.assertLessEqual(set(statuses), {201, 400}, statuses)
+        product.refresh_from_db()
+        sold = sum(OrderItem.objects.values_list('quantity', flat=True))
+        self.assertEqual(sold, 10 - product.quantity)
+        self.assertGreaterEqual(product.quantity, 0)
+        self.assertEqual(product.reserved, sum(CartItem.objects.values_list('quantity', flat=True)))
+
+
+class ConcurrentReservationTests(TransactionTestCase):
+    def test_concurrent_adds_to_cart(self):
+        category = Category.objects.create(name='Rugs')
+        rug = Product.objects.create(name='Rug', description='', price=10, quantity=40, category=category)
+        clients = [
+            client_for(CustomUser.objects.create_user(f'shopper{i}@example.com', 'password', first_name='S', last_name='H'))
+            for i in range(12)
+        ]
+
+        def work(client):
+            return [
+                client.post('/cart/', {'product_id': rug.pk, 'quantity': 1}, format='json').status_code
+                for _ in range(5)
+            ]
+
+        statuses = sum(run_concurrently(clients, work), [])
+        self.assertEqual(sorted(set(statuses)), [201, 400], statuses)
+        self.assertEqual(statuses.count(201), 40)
+        rug.refresh_from_db()
+        self.assertEqual(rug.reserved, 40)
+        self.assertEqual(sum(StockReservation.objects.values_list('quantity', flat=True)), 40)
+        self.assertEqual(sum(CartItem.objects.values_list('quantity', flat=True)), 40)
+
+
+class ConcurrentReviewTests(TransactionTestCase):
+    def test_one_review_per_purchase(self):
+        user = CustomUser.objects.create_user('buyer@example.com', 'password', first_name='Bu', last_name='Yer')
+        category = Category.objects.create(name='Mirrors')
+        mirror = Product.objects.create(name='Mirror', description='', price=5, quantity=10, category=category)
+        VerifiedPurchase.objects.create(user=user, product=mirror)
+
+        responses = run_concurrently([client_for(user) for _ in range(4)], lambda client: client.post(
+            '/reviews/create/', {'product': mirror.pk, 'rating': 4, 'review_text': 'ok'}, format='json',
+        ))
+        self.assertEqual(sorted(response.status_code for response in responses), [201, 400, 400, 400])
+        self.assertEqual(ProductReview.objects.count(), 1)
+        mirror.refresh_from_db()
+        self.assertEqual(mirror.rating_count, 1)
+
+
+class ConcurrentCouponTests(TransactionTestCase):
+    def test_max_usage_is_not_exceeded(self):
+        category = Category.objects.create(name='Vases')
+        vase = Product.objects.create(name='Vase', description='', price=10, quantity=50, category=category)
+        today = date.today()
+        Coupon.objects.create(
+            coupon_code='FIVE', discount_type='amount', discount_value=5, min_purchase_amount=1,
+            start_date=today, end_date=today, max_usage=2,
+        )
+        coupons.index.invalidate()
+        clients = []
+        for i in range(6):
+            client = client_for(CustomUser.objects.create_user(f'c{i}@example.com', 'pw', first_name='C', last_name='C'))
+            client.post('/cart/', {'product_id': vase.pk, 'quantity': 1}, format='json')
+            clients.append(client)
+
+        responses = run_concurrently(clients, lambda client: client.post(
+            '/place_order/', {'shipping_address': 'x', 'payment_method': 'card', 'coupon_code': 'FIVE'}, format='json',
+        ))
+        self.assertEqual(sorted(response.status_code for response in responses), [201, 201, 400, 400, 400, 400])
+        self.assertEqual(Coupon.objects.get().max_usage, 0)
+        self.assertEqual(CouponRedemption.objects.count(), 2)
+        self.assertEqual(Order.objects.count(), 2)
+        self.assertEqual(Product.objects.get().quantity, 48)
+
+
+@override_settings(ROOT_URLCONF='ecommerce_project.urls_asgi')
+class AsyncViewTests(TransactionTestCase):
+    """
+    The async read endpoints, through the ASGI URLs. A TransactionTestCase:
+    their queries run on connections of other threads, which don't see the
+    data of a TestCase's open transaction.
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.user = CustomUser.objects.create_user('async@example.com', 'password', first_name='As', last_name='Ync')
+        category = Category.objects.create(name='Lights')
+        self.lamp = Product.objects.create(name='Lamp', description='oak lamp', price=10, quantity=5, category=category)
+        for i in range(3):
+            Product.objects.create(name=f'Chair {i}', description='', price=5 + i, quantity=5, category=category)
+        order = Order.objects.create(user=self.user, total_amount=10, shipping_address='x', payment_method='card')
+        OrderItem.objects.create(order=order, product=self.lamp, quantity=1, price_at_order=10)
+        ProductReview.objects.create(user=self.user, product=self.lamp, rating=4, review_text='Bright')
+        self.headers = {'Authorization': f'Bearer {RefreshToken.for_user(self.user).access_token}'}
+
+    def request(self, method, path, data=None, **headers):
+        async def request():
+            return await getattr(AsyncClient(), method)(path, data, headers=headers)
+
+        return async_to_sync(request)()
+
+    def get(self, path, data=None, **headers):
+        return self.request('get', path, data, **headers)
+
+    def test_product_list(self):
+        response = self.get('/product_list/', {'page_size': 2}, **self.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['count'], 4)
+        self.assertEqual(len(response.json()['results']), 2)
+        self.assertEqual(
+            self.get('/product_list/', {'page_size': 2}, **self.headers, **{'If-None-Match': response['ETag']}).status_code, 304,
+        )
+
+        response = self.get('/product_list/', {'cursor': '', 'page_size': 2, 'q': 'chair'}, **self.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['results']), 2)
+        self.assertIsNotNone(response.json()['next'])
+
+        self.assertEqual(self.get('/product_list/', {'page': 9}, **self.headers).status_code, 404)
+        self.assertEqual(self.get('/product_list/').status_code, 401)
+
+    def test_product_detail(self):
+        response = self.get(f'/product_detail/{self.lamp.pk}/', **self.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['name'], 'Lamp')
+        self.assertEqual(self.get('/product_detail/999999/', **self.headers).status_code, 404)
+
+    def test_order_history(self):
+        response = self.get('/order_history/', **self.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['results'][0]['order_items'][0]['product']['name'], 'Lamp')
+        stats = [
+            endpoint for (name, route, method), endpoint in metrics.merged_endpoints().items()
+            if route == 'order_history/'
+        ]
+        self.assertEqual(len(stats), 1)
+        self.assertGreater(stats[0].queries, 0)
+
+    def test_reviews(self):
+        response = self.get('/reviews/', {'product_id': self.lamp.pk})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['results'][0]['product_name'], 'Lamp')
+        self.assertEqual(self.request('post', '/reviews/', {}).status_code, 405)
+        self.assertEqual(self.request('options', '/reviews/').status_code, 200)
+
+    def test_sync_views_still_work(self):
+        self.assertEqual(self.get('/cart/summary/', **self.headers).status_code, 200)
+
+
+@override_settings(EMAIL_BACKEND='ecommerce_app.tests.CountingEmailBackend')
+class AsyncOutboxTests(TransactionTestCase):
+    def test_adrain(self):
+        for i in range(7):
+            outbox.enqueue_mail(
+                f'subject {i}', 'body', 'shop@example.com', [f'to{i}@example.com'],
+                html_message='<p>body</p>' if i == 0 else None,
+            )
+        # Not SMTP, so the backend's blocking calls run in threads.
+        self.assertIsInstance(outbox.get_async_connection(), outbox.ThreadedConnection)
+        self.assertEqual(async_to_sync(outbox.adrain)(batch_size=5, connections=3), 5)
+        self.assertEqual(len(mail.outbox), 5)
+        self.assertTrue(any(message.alternatives for message in mail.outbox))
+        self.assertEqual(OutboxEmail.objects.filter(status='sent').count(), 5)
+
+    def test_failures_are_retried(self):
+        for i in range(3):
+            outbox.enqueue_mail(f'subject {i}', 'body', 'shop@example.com', [f'to{i}@example.com'])
+        send = outbox.ThreadedConnection._send
+
+        def refuse_one(connection, message):
+            if message.subject == 'subject 1':
+                raise OSError('connection refused')
+            return send(connection, message)
+
+        with mock.patch.object(outbox.ThreadedConnection, '_send', refuse_one):
+            call_command('mail_worker', '--once', '--connections', '4', stdout=StringIO())
+        failed = OutboxEmail.objects.get(subject='subject 1')
+        self.assertEqual((failed.status, failed.attempts), ('pending', 1))
+        self.assertIn('connection refused', failed.last_error)
+        self.assertEqual(OutboxEmail.objects.filter(status='sent').count(), 2)
+        self.assertEqual(len(mail.outbox), 2)
+        # Backing off, so nothing is due.
+        self.assertEqual(async_to_sync(outbox.adrain)(), 0)
+
+
+@override_settings(
+    EMAIL_BACKEND=outbox.SMTP_BACKEND, EMAIL_HOST='smtp.example.com', EMAIL_PORT='2525',
+    EMAIL_HOST_USER='shop', EMAIL_HOST_PASSWORD='secret', EMAIL_USE_TLS=True,
+)
+class AsyncSMTPConnectionTests(TransactionTestCase):
+    """
+    adrain() with the SMTP backend, over a stand-in for aiosmtplib.SMTP that
+    has its signatures (autospec) but no network.
+    """
+
+    def setUp(self):
+        patcher = mock.patch.object(outbox.aiosmtplib, 'SMTP', autospec=True)
+        self.smtp = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = self.smtp.return_value
+        for i in range(3):
+            outbox.enqueue_mail(
+                f'subject {i}', 'body', 'shop@example.com', [f'to{i}@example.com'],
+                html_message='<p>body</p>' if i == 0 else None,
+            )
+
+    def sent_subjects(self):
+        return sorted(call.args[0]['Subject'] for call in self.client.send_message.call_args_list)
+
+    def test_sends_over_aiosmtplib(self):
+        async def send_message(message, **kwargs):
+            # Waiting on the server lets the other session take the next email.
+            await asyncio.sleep(0)
+
+        self.client.send_message.side_effect = send_message
+        self.assertIsInstance(outbox.get_async_connection(), outbox.AsyncSMTPConnection)
+        self.assertEqual(async_to_sync(outbox.adrain)(batch_size=5, connections=2), 3)
+
+        # One session per connection, each logged in once and closed with QUIT.
+        self.assertEqual(self.smtp.call_count, 2)
+        self.smtp.assert_called_with(hostname='smtp.example.com', port=2525, use_tls=False, start_tls=True, timeout=None)
+        self.assertEqual(self.client.connect.await_count, 2)
+        self.client.login.assert_awaited_with('shop', 'secret')
+        self.assertEqual(self.client.quit.await_count, 2)
+        self.client.close.assert_not_called()
+
+        self.assertEqual(self.sent_subjects(), ['subject 0', 'subject 1', 'subject 2'])
+        message = min(self.client.send_message.call_args_list, key=lambda call: call.args[0]['Subject'])
+        self.assertEqual(message.kwargs, {'sender': 'shop@example.com', 'recipients': ['to0@example.com']})
+        self.assertTrue(message.args[0].is_multipart())
+        self.assertEqual(OutboxEmail.objects.filter(status='sent').count(), 3)
+        self.assertEqual(len(mail.outbox), 0)
+
+    def test_smtp_errors(self):
+        def send_message(message, **kwargs):
+            if message['Subject'] == 'subject 1':
+                raise aiosmtplib.SMTPResponseException(550, 'Mailbox unavailable')
+
+        self.client.send_message.side_effect = send_message
+        # The server hung up after the refusal.
+        self.client.quit.side_effect = aiosmtplib.SMTPServerDisconnected('Connection lost')
+        self.assertEqual(async_to_sync(outbox.adrain)(batch_size=5, connections=1), 3)
+
+        failed = OutboxEmail.objects.get(subject='subject 1')
+        self.assertEqual((failed.status, failed.attempts), ('pending', 1))
+        self.assertIn('Mailbox unavailable', failed.last_error)
+        self.assertEqual(OutboxEmail.objects.filter(status='sent').count(), 2)
+        # The session is dropped after the error and the rest go over a new one.
+        self.assertEqual(self.smtp.call_count, 2)
+        self.assertEqual(self.client.close.call_count, 2)
+
+    def test_refused_login(self):
+        self.client.login.side_effect = aiosmtplib.SMTPAuthenticationError(535, 'Authentication failed')
+        self.assertEqual(async_to_sync(outbox.adrain)(batch_size=5, connections=1), 3)
+        self.assertFalse(OutboxEmail.objects.filter(status='sent').exists())
+        self.assertEqual(set(OutboxEmail.objects.values_list('attempts', flat=True)), {1})
+        self.client.send_message.assert_not_called()
+        # Every attempt's connection was closed, without a QUIT it can't send.
+        self.assertEqual(self.client.close.call_count, 3)
+        self.client.quit.assert_not_called()
 
-# Create your tests here.
@@ -1,7 +1,7 @@
 from django.urls import path
 
 
-from .views import AddCartView, AdminOrderView, CartItemDetailView, CategoryDetailView, CategoryListView, CreateCouponView, CustomEmailView, CustomerProductDetailView, CustomerProductListView, CustomerRegistrationView, AdminRegistrationView, ListCouponsView, LoginView, OrderHistoryView,PasswordResetRequestView, PasswordResetView, PlaceOrderView, ProductDetailView, ProductListView, ProductReviewCreateView, ProductReviewListView, UserDetailView, UserListView, UserProfileUpdateView, ValidateCouponForCartView, WishlistAddProductView, WishlistMoveToCartView, WishlistView
+from .views import AddCartView, AdminOrderView, BroadcastJobView, CartItemDetailView, CartSummaryView, CategoryDetailView, CategoryListView, CreateCouponView, CustomEmailView, CustomerProductDetailView, CustomerProductFacetsView, CustomerProductListView, CustomerRegistrationView, AdminRegistrationView, ListCouponsView, LoginView, OrderExportView, OrderHistoryView,PasswordResetRequestView, PasswordResetView, PlaceOrderView, ProductDetailView, ProductExportView, ProductImportView, ProductListView, ProductReviewCreateView, ProductReviewListView, UserDetailView, UserListView, UserProfileUpdateView, ValidateCouponForCartView, WishlistAddProductView, WishlistMoveToCartView, WishlistView
 
 urlpatterns = [
     path('register/customer/', CustomerRegistrationView.as_view(), name='customer-register'),
@@ -11,20 +11,26 @@ urlpatterns = [
     path('password-reset/<str:uidb64>/<str:token>/', PasswordResetView.as_view(), name='password-reset'),
     path('products/', ProductListView.as_view(), name='product-list'),
     path('products/<int:pk>/', ProductDetailView.as_view(), name='product-detail'),
+    path('products/import/', ProductImportView.as_view(), name='product-import'),
+    path('products/export/', ProductExportView.as_view(), name='product-export'),
     path('categories/', CategoryListView.as_view(), name='category-list'),
     path('categories/<int:pk>/', CategoryDetailView.as_view(), name='category-detail'),
     path('users/', UserListView.as_view(), name='user-list'),
     path('users/<int:pk>/', UserDetailView.as_view(), name='user-detail'),
     path('product_list/', CustomerProductListView.as_view(), name='product-list'),
+    path('product_list/facets/', CustomerProductFacetsView.as_view(), name='product-facets'),
     path('product_detail/<int:pk>/', CustomerProductDetailView.as_view(), name='product-list'),
     # Add a product to the cart
     path('cart/', AddCartView.as_view(), name='add-to-cart'),
     path('cart_items/<int:pk>/', CartItemDetailView.as_view(), name='cart-item-detail'),
+    path('cart/summary/', CartSummaryView.as_view(), name='cart-summary'),
     path('place_order/', PlaceOrderView.as_view(), name='place-order'),
     path('orders/', AdminOrderView.as_view(), name='admin_orders'),
     path('orders/<int:order_id>/', AdminOrderView.as_view(), name='admin_order_detail'),
+    path('orders/export/', OrderExportView.as_view(), name='admin_order_export'),
     path('order_history/', OrderHistoryView.as_view(), name='order_history'),
     path("custom_email/",CustomEmailView.as_view(), name="custom_email"),
+    path("custom_email/<int:pk>/", BroadcastJobView.as_view(), name="custom_email_job"),
     path('profile-update/', UserProfileUpdateView.as_view(), name='user-profile-update'),
     path('wishlist/', WishlistView.as_view(), name='wishlist'),
     path('wishlist/add/', WishlistAddProductView.as_view(), name='wishlist-add-product'),
@@ -1,5 +1,6 @@
 from rest_framework import generics, permissions, status
 from rest_framework.pagination import PageNumberPagination
+from rest_framework.exceptions import PermissionDenied, ValidationError
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from django.utils.http import urlsafe_base64_decode, urlsafe_base64_encode
@@ -8,25 +9,31 @@ from django.contrib.auth.tokens import default_token_generator
 from django.contrib.auth import get_user_model, authenticate
 from django.utils.html import strip_tags
 from django.template.loader import render_to_string
-from django.core.mail import send_mail
-from .models import Coupon, CustomUser, Product, Category, CartItem, Order, OrderItem,Cart, ProductReview, Wishlist
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, transaction
+from .models import BroadcastJob, Coupon, CustomUser, Product, Category, CartItem, Order,Cart, ProductReview, VerifiedPurchase, Wishlist
 from .serializers import (
-    CouponSerializer, CustomUserSerializer, PasswordResetRequestSerializer,
+    BroadcastJobSerializer, CartSummarySerializer, CouponSerializer, CustomUserSerializer, PasswordResetRequestSerializer,
     LoginSerializer, PasswordResetSerializer, ProductReviewSerializer, ProductSerializer,
     CategorySerializer, UserProfileUpdateSerializer, UserSerializer, CartItemSerializer,
-    OrderSerializer, WishlistAddProductSerializer, WishlistSerializer,
+    OrderExportFilterSerializer, OrderSerializer, WishlistAddProductSerializer, WishlistSerializer,
 )
 from rest_framework_simplejwt.tokens import RefreshToken
 from rest_framework.permissions import IsAuthenticated
 from .permissions import IsCartOwner, IsSuperuserOrAdmin
-from django.core.mail import EmailMultiAlternatives
-from django.utils import timezone
+from . import (
+    broadcast, catalog_cache, catalog_filters, catalog_io, checkout, coupons, order_export, outbox, reservations, sharding,
+    streaming,
+)
+from .conditional import ConditionalGetMixin
+from .pagination import PageNumberOrKeysetPagination
+from .renderers import CSVRenderer, NDJSONRenderer
 
 # Create your views here.
 class CustomerRegistrationView(generics.CreateAPIView):
     queryset = CustomUser.objects.all()
     serializer_class = CustomUserSerializer
 
+    @transaction.atomic
     def post(self, request, *args, **kwargs):
         response = super().post(request, *args, **kwargs)
         if response.status_code == status.HTTP_201_CREATED:
@@ -35,7 +42,7 @@ class CustomerRegistrationView(generics.CreateAPIView):
             subject = 'Welcome to our Website!'
             html_message = render_to_string('ecommerce_app/welcome_email.html')
             plain_message = strip_tags(html_message)
-            send_mail(subject, plain_message, 'noreply@yourwebsite.com', [email], html_message=html_message)
+            outbox.enqueue_mail(subject, plain_message, 'noreply@yourwebsite.com', [email], html_message=html_message)
         return response
 
 class AdminRegistrationView(generics.CreateAPIView):
@@ -75,7 +82,7 @@ class PasswordResetRequestView(generics.CreateAPIView):
             from_email = 'noreply@yourwebsite.com'
             recipient_list = [email]
             
-            send_mail(subject, plain_message, from_email, recipient_list, html_message=html_message)
+            outbox.enqueue_mail(subject, plain_message, from_email, recipient_list, html_message=html_message)
 
 
 class LoginView(APIView):
@@ -128,7 +135,30 @@ class ProductDetailView(generics.RetrieveUpdateDestroyAPIView):
     serializer_class = ProductSerializer
     permission_classes = [permissions.IsAdminUser]
 
-class CategoryListView(generics.ListCreateAPIView):
+class ProductImportView(APIView):
+    permission_classes = [permissions.IsAdminUser]
+
+    def post(self, request):
+        upload = request.FILES.get('file')
+        if upload is None:
+            return Response({'error': 'Upload a CSV or NDJSON file as "file".'}, status=status.HTTP_400_BAD_REQUEST)
+        file_format = request.data.get('format') or upload.name.rsplit('.', 1)[-1].lower()
+        if file_format not in streaming.FORMATS:
+            return Response({'error': 'Format must be csv or ndjson.'}, status=status.HTTP_400_BAD_REQUEST)
+        result = catalog_io.import_rows(streaming.read_rows(upload.file, file_format))
+        return Response(result, status=status.HTTP_200_OK)
+
+class ProductExportView(APIView):
+    permission_classes = [permissions.IsAdminUser]
+    # Picked with ?format=csv or ?format=ndjson (or the Accept header).
+    renderer_classes = [CSVRenderer, NDJSONRenderer]
+
+    def get(self, request):
+        return streaming.streaming_response(
+            catalog_io.export_rows(), catalog_io.FIELDS, request.accepted_renderer.format, 'products',
+        )
+
+class CategoryListView(ConditionalGetMixin, generics.ListCreateAPIView):
     queryset = Category.objects.all()
     serializer_class = CategorySerializer
     permission_classes = [permissions.IsAdminUser]
@@ -139,44 +169,57 @@ class CategoryDetailView(generics.RetrieveUpdateDestroyAPIView):
     permission_classes = [permissions.IsAdminUser]
 
 class UserListView(generics.ListCreateAPIView):
-    queryset = CustomUser.objects.filter(is_staff=False)
+    queryset = CustomUser.objects.filter(is_staff=False).order_by('id')
     serializer_class = UserSerializer
     permission_classes = [permissions.IsAdminUser]
-    pagination_class = PageNumberPagination
+    pagination_class = PageNumberOrKeysetPagination
 
 class UserDetailView(generics.RetrieveUpdateDestroyAPIView):
     queryset = CustomUser.objects.filter(is_staff=False)
     serializer_class = UserSerializer
     permission_classes = [permissions.IsAdminUser]
 
-class CustomerProductListView(generics.ListAPIView):
+class CustomerProductListView(ConditionalGetMixin, generics.ListAPIView):
     serializer_class = ProductSerializer
     permission_classes = [IsAuthenticated]
-    pagination_class = PageNumberPagination
+    pagination_class = PageNumberOrKeysetPagination
 
     def get_queryset(self):
-        queryset = Product.objects.all()
+        filters = catalog_filters.parse(self.request.query_params)
+        queryset = catalog_filters.apply(Product.objects.order_by('id'), filters)
 
-        category_id = self.request.query_params.get('category')
-        if category_id:
-            queryset = queryset.filter(category__id=category_id)
+        if self.request.query_params.get('ordering') == 'rating':
+            queryset = queryset.order_by('-rating_average', '-rating_count', 'id')
 
-        min_price = self.request.query_params.get('min_price')
-        max_price = self.request.query_params.get('max_price')
-        if min_price and max_price:
-            queryset = queryset.filter(price__gte=min_price, price__lte=max_price)
+        return queryset
 
-        product_name = self.request.query_params.get('name')
-        if product_name:
-            queryset = queryset.filter(name__icontains=product_name)
+    def get_cache_key(self):
+        # Built before querying, so that a write landing in between bumps the
+        # generation and the stored page is never served.
+        return catalog_cache.list_key(self.request)
 
-        return queryset
+class CustomerProductFacetsView(APIView):
+    permission_classes = [IsAuthenticated]
 
-class CustomerProductDetailView(generics.RetrieveAPIView):
+    def get(self, request):
+        cache_key = catalog_cache.facets_key(request)
+        if cache_key:
+            data = catalog_cache.get_cached(cache_key)
+            if data is not None:
+                return Response(data)
+        data = catalog_filters.facets(Product.objects.all(), catalog_filters.parse(request.query_params))
+        if cache_key:
+            catalog_cache.store(cache_key, data)
+        return Response(data)
+
+class CustomerProductDetailView(ConditionalGetMixin, generics.RetrieveAPIView):
     queryset = Product.objects.all()
     serializer_class = ProductSerializer
     permission_classes = [IsAuthenticated]
 
+    def get_cache_key(self):
+        return catalog_cache.detail_key(self.request, self.kwargs['pk'])
+
 class AddCartView(generics.CreateAPIView, generics.ListAPIView):
     queryset = Product.objects.all()
     permission_classes = [IsAuthenticated]
@@ -185,7 +228,7 @@ class AddCartView(generics.CreateAPIView, generics.ListAPIView):
 
     def get_queryset(self):
         user = self.request.user
-        return CartItem.objects.filter(cart__user=user)
+        return CartItem.objects.using(sharding.shard_for_user(user)).filter(cart__user=user)
     def post(self, request, *args, **kwargs):
         user = request.user
         product_id = request.data.get('product_id')
@@ -195,28 +238,76 @@ class AddCartView(generics.CreateAPIView, generics.ListAPIView):
             product = Product.objects.get(pk=product_id)
         except Product.DoesNotExist:
             return Response({"message": "Product not found"}, status=status.HTTP_400_BAD_REQUEST)
-        cart, created = Cart.objects.get_or_create(user=user)
-
-        cart_item, created = CartItem.objects.get_or_create(cart=cart, product=product)
+        shard = sharding.shard_for_user(user)
+        cart, created = Cart.objects.using(shard).get_or_create(user=user)
 
-        if not created:
-            cart_item.quantity += quantity  
-        else:
-            cart_item.quantity = quantity
-
-        if cart_item.quantity > product.quantity:
-            return Response({"message": "Requested quantity exceeds available quantity"}, status=status.HTTP_400_BAD_REQUEST)
+        for attempt in range(2):
+            cart_item = CartItem.objects.using(shard).filter(cart=cart, product=product).first()
+            if cart_item is None:
+                cart_item = CartItem(cart=cart, product=product, quantity=0)
+            cart_item.quantity += quantity
 
-        cart_item.save()
+            try:
+                with sharding.atomic(shard):
+                    try:
+                        reservations.hold(cart, product.pk, cart_item.quantity)
+                    except reservations.InsufficientStock as e:
+                        return Response({"message": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+                    cart_item.save()
+                    cart.add_to_totals(product.price * quantity, quantity)
+                break
+            except IntegrityError:
+                # A concurrent request added the product first; add to its row.
+                if attempt:
+                    raise
 
         serializer = CartItemSerializer(cart_item)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
 class CartItemDetailView(generics.RetrieveUpdateDestroyAPIView):
-    queryset = CartItem.objects.all()
     serializer_class = CartItemSerializer
     permission_classes = [IsAuthenticated, IsCartOwner]
 
+    def get_queryset(self):
+        return CartItem.objects.using(sharding.shard_for_user(self.request.user))
+
+    def perform_update(self, serializer):
+        instance = serializer.instance
+        with sharding.atomic(instance._state.db):
+            previous_amount = instance.product.price * instance.quantity
+            previous_quantity = instance.quantity
+            product = serializer.validated_data.get('product', instance.product)
+            if product.pk != instance.product_id:
+                reservations.hold(instance.cart, instance.product_id, 0)
+            try:
+                reservations.hold(instance.cart, product.pk, serializer.validated_data.get('quantity', instance.quantity))
+            except reservations.InsufficientStock as e:
+                raise ValidationError({'message': str(e)})
+            try:
+                with transaction.atomic(using=instance._state.db):
+                    cart_item = serializer.save()
+            except IntegrityError:
+                raise ValidationError({'message': 'Product is already in the cart'})
+            cart_item.cart.add_to_totals(
+                cart_item.product.price * cart_item.quantity - previous_amount,
+                cart_item.quantity - previous_quantity,
+            )
+
+    def perform_destroy(self, instance):
+        with sharding.atomic(instance._state.db):
+            reservations.hold(instance.cart, instance.product_id, 0)
+            instance.delete()
+            instance.cart.add_to_totals(-instance.product.price * instance.quantity, -instance.quantity)
+
+class CartSummaryView(generics.RetrieveAPIView):
+    serializer_class = CartSummarySerializer
+    permission_classes = [IsAuthenticated]
+
+    def get_object(self):
+        # Answered from the cart's running totals without touching its items.
+        user = self.request.user
+        return Cart.objects.using(sharding.shard_for_user(user)).filter(user=user).first() or Cart(user=user)
+
 # class PlaceOrderView(generics.CreateAPIView):
 #     queryset = Order.objects.all()
 #     serializer_class = OrderSerializer
@@ -283,18 +374,35 @@ class CartItemDetailView(generics.RetrieveUpdateDestroyAPIView):
 
 class AdminOrderView(APIView):
     permission_classes = [permissions.IsAdminUser]
-    pagination_class = PageNumberPagination
+    pagination_class = PageNumberOrKeysetPagination
 
-    def get(self, request,order_id):
+    def get_queryset(self):
+        # Every shard's newest orders, merged.
+        return sharding.ShardedQuerySet.over_shards(Order.objects.with_details().order_by('-created_at', '-id'))
+
+    def get(self, request, order_id=None):
+        if order_id is None:
+            queryset = self.get_queryset()
+            paginator = self.pagination_class()
+            page = paginator.paginate_queryset(queryset, request, view=self)
+            serializer = OrderSerializer(page, many=True)
+            return paginator.get_paginated_response(serializer.data)
         try:
-            order = Order.objects.get(id=order_id)
+            order = self.get_order(order_id, Order.objects.with_details())
             serializer = OrderSerializer(order)
             return Response(serializer.data)
         except Order.DoesNotExist:
             return Response({'message': 'Order not found'}, status=status.HTTP_404_NOT_FOUND)
 
+    def get_order(self, order_id, queryset=Order.objects):
+        # Order ids say which shard they were created on.
+        shard = sharding.shard_for_id(order_id)
+        if shard is None:
+            raise Order.DoesNotExist
+        return queryset.using(shard).get(id=order_id)
+
     def patch(self, request, order_id):
-        order = Order.objects.get(id=order_id)
+        order = self.get_order(order_id)
         order_status = request.data.get('order_status')
 
         if order_status:
@@ -304,14 +412,31 @@ class AdminOrderView(APIView):
         else:
             return Response({'message': 'Please provide the order_status field.'})
 
+class OrderExportView(APIView):
+    permission_classes = [permissions.IsAdminUser]
+    renderer_classes = [CSVRenderer, NDJSONRenderer]
+
+    def get(self, request):
+        filters = OrderExportFilterSerializer(data=request.query_params)
+        filters.is_valid(raise_exception=True)
+        items = order_export.filter_items(**filters.validated_data)
+        return streaming.streaming_response(
+            order_export.export_rows(items), order_export.FIELDS, request.accepted_renderer.format, 'orders',
+        )
+
 class OrderHistoryView(generics.ListAPIView):
     serializer_class = OrderSerializer
     permission_classes = [IsAuthenticated]
-    pagination_class = PageNumberPagination
+    pagination_class = PageNumberOrKeysetPagination
 
     def get_queryset(self):
         user = self.request.user
-        return Order.objects.filter(user=user)
+        # Newest first, for page numbers as well as cursors. These lists used
+        # to be unordered, which SQLite served oldest first.
+        return (
+            Order.objects.using(sharding.read_shard_for_user(user)).filter(user=user)
+            .with_details().order_by('-created_at', '-id')
+        )
     
 
 
@@ -321,32 +446,21 @@ class CustomEmailView(APIView):
     def post(self, request, *args, **kwargs):
         subject = request.data.get('subject')
         message = request.data.get('message')
-        recipients = CustomUser.objects.filter(is_staff=False, email__isnull=False)
         files = request.FILES.getlist('files')
-        if not subject or not message or not recipients:
+        if not subject or not message or not broadcast.recipients().exists():
             return Response({'message': 'Subject, message, and recipient(s) are required.'}, status=status.HTTP_400_BAD_REQUEST)
 
-        context = {'subject': subject, 'message': message,"files":files}
-        html_message = render_to_string('ecommerce_app/custom_email.html', context)
+        # The mail_worker command sends the job in batches; poll
+        # custom_email/<job_id>/ for progress.
+        job = broadcast.create_job(subject, message, files, created_by=request.user)
+        serializer = BroadcastJobSerializer(job)
+        return Response(serializer.data, status=status.HTTP_202_ACCEPTED)
 
-        email = EmailMultiAlternatives(
-            subject=subject,
-            body=html_message,  
-            from_email='noreply@yourwebsite.com',
-            to=[user.email for user in recipients],
-        )
-        for file in files:
-            email.attach(file.name, file.read(), file.content_type)
-        email.content_subtype = 'html'
 
-        
-        try:
-            email.send()
-            return Response({'message': 'Custom email sent successfully.'}, status=status.HTTP_200_OK)
-        except Exception as e:
-            # Log the error for debugging
-            print(e)
-            return Response({'message': 'An error occurred while sending the email.'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+class BroadcastJobView(generics.RetrieveAPIView):
+    queryset = BroadcastJob.objects.all()
+    serializer_class = BroadcastJobSerializer
+    permission_classes = [IsAuthenticated, permissions.IsAdminUser]
 
 
 class UserProfileUpdateView(generics.RetrieveUpdateAPIView):
@@ -354,7 +468,9 @@ class UserProfileUpdateView(generics.RetrieveUpdateAPIView):
     permission_classes = [IsAuthenticated]
 
     def get_object(self):
-        return self.request.user
+        # request.user can come from the token user cache and lag the table
+        # by up to its TTL; saving it would write the stale columns back.
+        return CustomUser.objects.using(DEFAULT_DB_ALIAS).get(pk=self.request.user.pk)
 
     def update(self, request, *args, **kwargs):
         instance = self.get_object()
@@ -363,7 +479,7 @@ class UserProfileUpdateView(generics.RetrieveUpdateAPIView):
         # Update password if a new one is provided
         if new_password:
             instance.set_password(new_password)
-            instance.save()
+            instance.save(update_fields=['password'])
 
         serializer = self.get_serializer(instance, data=request.data, partial=True)
         serializer.is_valid(raise_exception=True)
@@ -376,14 +492,15 @@ class WishlistView(generics.RetrieveAPIView):
     permission_classes = [permissions.IsAuthenticated]
 
     def get_object(self):
-        return Wishlist.objects.get_or_create(user=self.request.user)[0]
+        user = self.request.user
+        return Wishlist.objects.using(sharding.shard_for_user(user)).get_or_create(user=user)[0]
 
 class WishlistAddProductView(generics.CreateAPIView):
     serializer_class = WishlistAddProductSerializer
     permission_classes = [permissions.IsAuthenticated]
 
     def post(self, request, *args, **kwargs):
-        wishlist = Wishlist.objects.get_or_create(user=request.user)[0]
+        wishlist = Wishlist.objects.using(sharding.shard_for_user(request.user)).get_or_create(user=request.user)[0]
         product_id = request.data.get('product_id')
 
         try:
@@ -399,21 +516,30 @@ class WishlistMoveToCartView(generics.CreateAPIView):
     permission_classes = [permissions.IsAuthenticated]
 
     def post(self, request, *args, **kwargs):
-        wishlist = Wishlist.objects.get_or_create(user=request.user)[0]
+        shard = sharding.shard_for_user(request.user)
+        wishlist = Wishlist.objects.using(shard).get_or_create(user=request.user)[0]
         product_id = request.data.get('product_id')
 
-        try:
-            product = wishlist.products.get(pk=product_id)
-        except Product.DoesNotExist:
+        product = Product.objects.filter(pk=product_id).first()
+        if product is None or product.pk not in wishlist.product_ids():
             return Response({"message": "Product not found in wishlist"}, status=status.HTTP_400_BAD_REQUEST)
 
         # Check if the product is already in the cart
-        if CartItem.objects.filter(cart__user=request.user, product=product).exists():
+        if CartItem.objects.using(shard).filter(cart__user=request.user, product=product).exists():
             return Response({"message": "Product is already in the cart"}, status=status.HTTP_400_BAD_REQUEST)
 
         # Add the product to the cart
-        cart, _ = Cart.objects.get_or_create(user=request.user)
-        CartItem.objects.create(cart=cart, product=product, quantity=1)
+        cart, _ = Cart.objects.using(shard).get_or_create(user=request.user)
+        try:
+            with sharding.atomic(shard):
+                try:
+                    reservations.hold(cart, product.pk, 1)
+                except reservations.InsufficientStock as e:
+                    return Response({"message": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+                CartItem.objects.using(shard).create(cart=cart, product=product, quantity=1)
+                cart.add_to_totals(product.price, 1)
+        except IntegrityError:
+            return Response({"message": "Product is already in the cart"}, status=status.HTTP_400_BAD_REQUEST)
 
         # Remove the product from the wishlist
         wishlist.products.remove(product)
@@ -426,27 +552,39 @@ class ProductReviewCreateView(generics.CreateAPIView):
     serializer_class = ProductReviewSerializer
     permission_classes = [permissions.IsAuthenticated]  # User must be authenticated to leave a review
 
+    @transaction.atomic
     def perform_create(self, serializer):
-        product_id = self.request.data.get('product')
         user = self.request.user
-        purchased_products = OrderItem.objects.filter(order__user=user, product_id=product_id)
-        
-        if purchased_products.exists():
-            serializer.save(user=user)
-        else:
-            # You can raise a PermissionDenied exception or return an error response
-            raise permissions.PermissionDenied("You can only review products that you have purchased.")
+        purchase = VerifiedPurchase.objects.filter(
+            user=user, product=serializer.validated_data['product'],
+        ).values_list('pk', 'review_id').first()
 
+        if purchase is None:
+            raise PermissionDenied("You can only review products that you have purchased.")
+        if purchase[1] is not None:
+            raise ValidationError({'message': 'You have already reviewed this product.'})
 
-class ProductReviewListView(generics.ListAPIView):
+        review = serializer.save(user=user)
+        # Claims the purchase's review slot; loses to a concurrent review of the same purchase.
+        claimed = VerifiedPurchase.objects.filter(pk=purchase[0], review__isnull=True).update(review=review)
+        if not claimed:
+            raise ValidationError({'message': 'You have already reviewed this product.'})
+
+
+class ProductReviewListView(ConditionalGetMixin, generics.ListAPIView):
     serializer_class = ProductReviewSerializer
     permission_classes = [permissions.AllowAny]  # Allow anyone to view reviews
+    pagination_class = PageNumberOrKeysetPagination
+    # The reviews show their product's name.
+    last_modified_fields = ('created_at', 'product__updated_at')
 
     def get_queryset(self):
+        # Newest first, like the order history.
+        queryset = ProductReview.objects.order_by('-created_at', '-id')
         product_id = self.request.query_params.get('product_id')
         if product_id:
-            return ProductReview.objects.filter(product_id=product_id)
-        return ProductReview.objects.all()
+            return queryset.filter(product_id=product_id)
+        return queryset
 
 
 class CreateCouponView(generics.CreateAPIView):
@@ -456,63 +594,37 @@ class CreateCouponView(generics.CreateAPIView):
 
 
 class ListCouponsView(generics.ListAPIView):
-    queryset = Coupon.objects.filter(start_date__lte=timezone.now(), end_date__gte=timezone.now())
     serializer_class = CouponSerializer
     permission_classes = [IsAuthenticated]
 
+    def get_queryset(self):
+        return coupons.index.active()
+
 class ValidateCouponForCartView(generics.CreateAPIView):
     serializer_class = CouponSerializer
     permission_classes = [IsAuthenticated, IsCartOwner]
     def get_object(self):
-        coupon_code = self.kwargs['coupon_code']
-        try:
-            coupon = Coupon.objects.get(coupon_code=coupon_code, start_date__lte=timezone.now(), end_date__gte=timezone.now())
-            return coupon
-        except Coupon.DoesNotExist:
-            return None
-    def calculate_discount(self, coupon, cart_items):
-        discount_details = {
-            'discount_type': coupon.discount_type,
-            'discount_value': coupon.discount_value,
-            'discount_amount': 0, 
-        }
-        cart_total = sum(cart_item.product.price * cart_item.quantity for cart_item in cart_items)
-        if coupon.discount_type == 'percentage':
-        # Calculate discount for percentage type coupon
-            if cart_total >= coupon.min_purchase_amount:
-                discount_details['discount_amount'] = (coupon.discount_value / 100) * cart_total
-                return discount_details
-
-        elif coupon.discount_type == 'amount':
-            # Calculate discount for fixed amount type coupon
-            if cart_total >= coupon.min_purchase_amount:
-                discount_details['discount_amount'] = coupon.discount_value
-                return discount_details
-
-        return None  # Return None if the coupon doesn't apply to the cart
+        return coupons.get_active(self.kwargs['coupon_code'])
     def create(self, request, *args, **kwargs):
         coupon_code = request.data.get('coupon_code', '')  # Get the coupon code from the request body
 
         if not coupon_code:
             return Response({"message": "Coupon code is required in the request body"}, status=status.HTTP_400_BAD_REQUEST)
 
-        try:
-            coupon = Coupon.objects.get(
-                coupon_code=coupon_code,
-                start_date__lte=timezone.now(),
-                end_date__gte=timezone.now(),
-            )
-        except Coupon.DoesNotExist:
+        coupon = coupons.get_active(coupon_code)
+        if coupon is None:
             return Response({"message": "Invalid or expired coupon code"}, status=status.HTTP_400_BAD_REQUEST)
 
-        # Get the authenticated user's cart items.
-        cart_items = CartItem.objects.filter(cart__user=request.user)
+        # The cart keeps a running total, so its items don't need loading.
+        cart_total = (
+            Cart.objects.using(sharding.shard_for_user(request.user)).filter(user=request.user)
+            .values_list('subtotal', flat=True).first()
+        ) or 0
 
-        discount_details = self.calculate_discount(coupon, cart_items)
+        discount_details = checkout.calculate_discount(coupon, cart_total)
 
         if not discount_details:
             return Response({"message": "Coupon does not apply to the cart items"}, status=status.HTTP_400_BAD_REQUEST)
-        cart_total = sum(cart_item.product.price * cart_item.quantity for cart_item in cart_items)
         final_price = cart_total - discount_details["discount_amount"]
         response_data = {
             "original_total_amount": cart_total,
@@ -526,114 +638,37 @@ class PlaceOrderView(generics.CreateAPIView):
     queryset = Order.objects.all()
     serializer_class = OrderSerializer
     permission_classes = [IsAuthenticated, IsCartOwner]
-    def calculate_discount(self, coupon, cart_items):
-        discount_details = {
-            'discount_type': coupon.discount_type,
-            'discount_value': coupon.discount_value,
-            'discount_amount': 0, 
-        }
-        cart_total = sum(cart_item.product.price * cart_item.quantity for cart_item in cart_items)
-        if coupon.discount_type == 'percentage':
-        # Calculate discount for percentage type coupon
-            if cart_total >= coupon.min_purchase_amount:
-                discount_details['discount_amount'] = (coupon.discount_value / 100) * cart_total
-                return discount_details
-
-        elif coupon.discount_type == 'amount':
-            # Calculate discount for fixed amount type coupon
-            if cart_total >= coupon.min_purchase_amount:
-                discount_details['discount_amount'] = coupon.discount_value
-                return discount_details
-
-        return None  # Return None if the coupon doesn't apply to the cart
+
     def create(self, request, *args, **kwargs):
         user = request.user
-        cart_items = CartItem.objects.filter(cart__user=user)
-
-        if not cart_items:
-            return Response({"message": "No cart items found"}, status=status.HTTP_400_BAD_REQUEST)
-        # Check if the coupon code has already been applied to any order
-        coupon_code = request.data.get("coupon_code")
-        if coupon_code and Order.objects.filter(coupon_code=coupon_code, coupon_applied=True).exists():
-            return Response({"message": "Coupon has already been used"}, status=status.HTTP_400_BAD_REQUEST)
-        # Calculate the total amount for the order without applying the coupon
-        total_amount_without_coupon = sum(cart_item.product.price * cart_item.quantity for cart_item in cart_items)
-
-        # Get the coupon code from the request data
-        coupon_code = request.data.get("coupon_code")
-        # Initialize discount_amount to zero
-        discount_amount = 0
-        # Apply the coupon discount if a valid coupon code is provided
-        if coupon_code:
-            try:
-                coupon = Coupon.objects.get(
-                    coupon_code=coupon_code,
-                    start_date__lte=timezone.now(),
-                    end_date__gte=timezone.now(),
+        try:
+            # The confirmation emails go to the outbox in the same transaction,
+            # so a checkout that fails sends none. On another shard, see
+            # sharding.atomic() for the one window where they outlive the order.
+            with sharding.atomic(sharding.shard_for_user(user)):
+                order, order_items = checkout.place_order(
+                    user,
+                    shipping_address=request.data.get("shipping_address"),
+                    payment_method=request.data.get("payment_method"),
+                    coupon_code=request.data.get("coupon_code"),
                 )
-                
-                # Check if the coupon can still be used (max_usage check)
-                if coupon.max_usage is not None and coupon.max_usage <= 0:
-                    return Response({"message": "Coupon has reached its maximum usage limit"}, status=status.HTTP_400_BAD_REQUEST)
-
-                # Calculate discount details
-                discount_details = self.calculate_discount(coupon, cart_items)
-
-                if discount_details:
-                    discount_amount = discount_details["discount_amount"]
-                    total_amount = total_amount_without_coupon - discount_amount
-
-                    # Decrease the max_usage of the coupon by 1
-                    if coupon.max_usage is not None:
-                        coupon.max_usage -= 1
-                        coupon.save()
-                else:
-                    return Response({"message": "Coupon does not apply to the cart items"}, status=status.HTTP_400_BAD_REQUEST)
-            except Coupon.DoesNotExist:
-                return Response({"message": "Invalid or expired coupon code"}, status=status.HTTP_400_BAD_REQUEST)
-        else:
-            total_amount = total_amount_without_coupon
-
-        shipping_address = request.data.get("shipping_address")
-        payment_method = request.data.get("payment_method")
-
-        order = Order.objects.create(
-            user=user,
-            total_amount_without_coupon=total_amount_without_coupon,
-            total_amount=total_amount,
-            shipping_address=shipping_address,
-            payment_method=payment_method,
-            coupon_code=coupon_code,  # Add the coupon code to the order
-            discounted_amount=discount_amount,  # Add the discounted amount to the order
-        )
-        order.coupon_applied = True
-        order.save()
-        order_items = []
-        for cart_item in cart_items:
-            product = cart_item.product
-            quantity = cart_item.quantity
-            price_at_order = product.price
-            product.quantity -= quantity
-            product.save()
-
-            order_item = OrderItem.objects.create(order=order, product=product, quantity=quantity, price_at_order=price_at_order)
-            order_items.append(order_item)
-            cart_item.delete()
-
-        user_subject = 'Order Confirmation'
-        user_message = render_to_string('ecommerce_app/order_confirmation.html', {
-            'user': user,
-            'order_items': order_items,
-            'order': order,
-            'discounted_amount': discount_amount,
-        })
-        user_message_plain = strip_tags(user_message)
-        send_mail(user_subject, user_message_plain, 'your-email@example.com', [user.email], html_message=user_message)
-
-        admin_subject = 'New Order'
-        admin_message = f"A new order has been placed. Order ID: {order.id}"
-        send_mail(admin_subject, admin_message, 'your-email@example.com', ['admin-email@example.com'])
-
-        serializer = self.get_serializer(order)
+
+                user_subject = 'Order Confirmation'
+                user_message = render_to_string('ecommerce_app/order_confirmation.html', {
+                    'user': user,
+                    'order_items': order_items,
+                    'order': order,
+                    'discounted_amount': order.discounted_amount,
+                })
+                user_message_plain = strip_tags(user_message)
+                outbox.enqueue_mail(user_subject, user_message_plain, 'your-email@example.com', [user.email], html_message=user_message)
+
+                admin_subject = 'New Order'
+                admin_message = f"A new order has been placed. Order ID: {order.id}"
+                outbox.enqueue_mail(admin_subject, admin_message, 'your-email@example.com', ['admin-email@example.com'])
+        except checkout.CheckoutError as e:
+            return Response({"message": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        serializer = self.get_serializer(Order.objects.using(order._state.db).with_details().get(pk=order.pk))
 
         return Response(serializer.data, status=status.HTTP_201_CREATED)
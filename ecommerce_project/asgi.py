@@ -12,5 +12,7 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ecommerce_project.settings')
+# Serve the async versions of the hot read endpoints.
+os.environ.setdefault('DJANGO_ROOT_URLCONF', 'ecommerce_project.urls_asgi')
 
 application = get_asgi_application()
@@ -48,7 +48,7 @@ REST_FRAMEWORK = {
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
     'PAGE_SIZE': 3,  # Number of items per page
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'ecommerce_app.authentication.CachedJWTAuthentication',
     ),
 }
 SIMPLE_JWT = {
@@ -58,7 +58,13 @@ SIMPLE_JWT = {
     "ROTATE_REFRESH_TOKENS": True,
     "BLACKLIST_AFTER_ROTATION": True,
 }
+# CachedJWTAuthentication keeps user rows per process for this long; saves in
+# other processes only show up once it has passed.
+JWT_USER_CACHE_TTL = 60  # seconds
+JWT_USER_CACHE_SIZE = 10000
 MIDDLEWARE = [
+    'ecommerce_app.metrics.MetricsMiddleware',
+    'ecommerce_app.routers.PrimaryPinningMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -68,7 +74,8 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
-ROOT_URLCONF = 'ecommerce_project.urls'
+# ecommerce_project/asgi.py switches this to ecommerce_project.urls_asgi.
+ROOT_URLCONF = os.environ.get('DJANGO_ROOT_URLCONF', 'ecommerce_project.urls')
 
 TEMPLATES = [
     {
@@ -87,6 +94,7 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'ecommerce_project.wsgi.application'
+ASGI_APPLICATION = 'ecommerce_project.asgi.application'
 
 
 # Database
@@ -94,10 +102,31 @@ WSGI_APPLICATION = 'ecommerce_project.wsgi.application'
 
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
+        # Django's SQLite backend with Django 5.1's transaction_mode option.
+        # Transactions take the write lock up front, so one that reads before
+        # it writes waits its turn instead of failing with "database is locked".
+        'ENGINE': 'ecommerce_project.sqlite_backend',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'OPTIONS': {'transaction_mode': 'IMMEDIATE'},
+        # A file rather than Django's shared-cache in-memory database, whose
+        # table locks fail at once instead of waiting: the concurrency tests
+        # need SQLite's real locking.
+        'TEST': {'NAME': BASE_DIR / 'test_db.sqlite3'},
+    }
+}
+
+# The catalog cache keeps its generation counters in here, so multi-process
+# deployments should point this at a shared backend (Redis, Memcached).
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'ecommerce',
     }
 }
+CATALOG_CACHE_ALIAS = 'default'
+CATALOG_CACHE_TIMEOUT = 300  # seconds
+# Upper bounds of the price facet's buckets; the last bucket is open-ended.
+CATALOG_PRICE_BUCKETS = [25, 50, 100, 250, 500]
 
 
 # Password validation
@@ -148,3 +177,44 @@ EMAIL_HOST = 'sandbox.smtp.mailtrap.io'
 EMAIL_HOST_USER = '216b54d0cf34c4'
 EMAIL_HOST_PASSWORD = '1cc367ae32d355'
 EMAIL_PORT = '2525'
+
+# Outbox delivery (see `manage.py mail_worker`).
+EMAIL_OUTBOX_MAX_ATTEMPTS = 5
+EMAIL_OUTBOX_RETRY_BACKOFF = 30  # seconds, doubled on every failed attempt
+EMAIL_OUTBOX_MAX_BACKOFF = 3600  # seconds
+EMAIL_OUTBOX_LEASE = 300  # seconds a worker may hold a claimed email
+BROADCAST_BATCH_SIZE = 100  # recipients per message sent by CustomEmailView jobs
+BROADCAST_LEASE = 300  # seconds
+COUPON_INDEX_TTL = 60  # seconds before a process reloads its coupon index
+CART_RESERVATION_TTL = 900  # seconds a cart holds the stock it was given
+# /metrics requires "Authorization: Bearer <token>"; it answers 403 while this is unset.
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+# Read replicas: a comma-separated list of SQLite files in DATABASE_REPLICAS,
+# e.g. kept fresh with `manage.py snapshot_replica --interval 5`. They lag the
+# primary by up to the snapshot interval; see ecommerce_app.routers for what
+# still reads from the primary. They copy the default database only, so the
+# per-user tables of the other DATABASE_SHARDS are always read from their
+# shard. Tests mirror them onto the test database.
+REPLICA_PIN_SECONDS = 10  # a client that wrote reads from the primary this long
+DATABASE_REPLICAS = []
+for index, replica_name in enumerate(filter(None, os.environ.get('DATABASE_REPLICAS', '').split(','))):
+    DATABASES[f'replica{index}'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': replica_name,
+        'TEST': {'MIRROR': 'default'},
+    }
+    DATABASE_REPLICAS.append(f'replica{index}')
+# Shards for the per-user tables (carts, orders, wishlists): a comma-separated
+# list of SQLite files in DATABASE_SHARDS, migrated with
+# `manage.py migrate --database shardN`. The default database is always the
+# first shard; see ecommerce_app.sharding. Changing the number of shards moves
+# users between them, which needs a data migration.
+DATABASE_SHARDS = ['default']
+for index, shard_name in enumerate(filter(None, os.environ.get('DATABASE_SHARDS', '').split(',')), start=1):
+    DATABASES[f'shard{index}'] = {
+        'ENGINE': 'ecommerce_project.sqlite_backend',
+        'NAME': shard_name,
+        'OPTIONS': {'transaction_mode': 'IMMEDIATE'},
+    }
+    DATABASE_SHARDS.append(f'shard{index}')
+DATABASE_ROUTERS = ['ecommerce_app.sharding.ShardRouter', 'ecommerce_app.routers.PrimaryReplicaRouter']
@@ -0,0 +1,34 @@
+from django.core.exceptions import ImproperlyConfigured
+from django.db.backends.sqlite3 import base
+
+TRANSACTION_MODES = ('DEFERRED', 'IMMEDIATE', 'EXCLUSIVE')
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    """
+    Django's SQLite backend plus the ``transaction_mode`` option of Django
+    5.1. With OPTIONS['transaction_mode'] = 'IMMEDIATE', atomic() takes the
+    write lock when it begins. A deferred transaction that reads before it
+    writes (checkout, stock holds) has to upgrade its lock later, and SQLite
+    fails the upgrade with "database is locked" at once, without waiting
+    out the busy timeout, whenever another connection is writing.
+    """
+
+    transaction_mode = None
+
+    def get_connection_params(self):
+        kwargs = super().get_connection_params()
+        transaction_mode = kwargs.pop('transaction_mode', None)
+        if transaction_mode is not None and transaction_mode.upper() not in TRANSACTION_MODES:
+            raise ImproperlyConfigured(
+                f"settings.DATABASES['{self.alias}']['OPTIONS']['transaction_mode'] must be one of "
+                f"{', '.join(TRANSACTION_MODES)}."
+            )
+        self.transaction_mode = transaction_mode and transaction_mode.upper()
+        return kwargs
+
+    def _start_transaction_under_autocommit(self):
+        if self.transaction_mode is None:
+            super()._start_transaction_under_autocommit()
+        else:
+            self.cursor().execute(f'BEGIN {self.transaction_mode}')
@@ -0,0 +1,19 @@
+"""
+URL configuration of the ASGI deployment (see asgi.py): the WSGI routes, with
+the hot read endpoints served by their async versions from
+ecommerce_app.async_views. The first matching route wins, so these shadow the
+sync ones.
+"""
+from django.urls import path
+
+from ecommerce_app import async_views
+
+from .urls import urlpatterns as wsgi_urlpatterns
+
+urlpatterns = [
+    path('product_list/', async_views.AsyncCustomerProductListView.as_view(), name='product-list'),
+    path('product_detail/<int:pk>/', async_views.AsyncCustomerProductDetailView.as_view(), name='product-list'),
+    path('order_history/', async_views.AsyncOrderHistoryView.as_view(), name='order_history'),
+    path('reviews/', async_views.AsyncProductReviewListView.as_view(), name='product-review-list'),
+    *wsgi_urlpatterns,
+]